@@ -5,22 +5,28 @@ Admin панель для управления пользователями и 
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
-from .models import CompressionSession, CompressionFile
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html_join
+from .models import CompressionSession, CompressionFile, ProfilingTarget
+from .profiling import PROFILE_FILES
+from .storage import get_session_path
 
 
 class CompressionFileInline(admin.TabularInline):
     model = CompressionFile
     extra = 0
-    readonly_fields = ['original_name', 'output_name', 'original_size_mb', 'compressed_size_mb', 'savings_percent', 'category']
+    readonly_fields = ['original_name', 'output_name', 'original_size_mb', 'compressed_size_mb', 'savings_percent', 'category', 'preset']
     can_delete = False
 
 
 @admin.register(CompressionSession)
 class CompressionSessionAdmin(admin.ModelAdmin):
     list_display = ['user', 'archive_name', 'status', 'files_count', 'savings_percent', 'created_at', 'downloaded_at']
-    list_filter = ['status', 'created_at', 'user']
+    list_filter = ['status', 'profiling', 'created_at', 'user']
     search_fields = ['session_id', 'archive_name', 'user__username']
-    readonly_fields = ['session_id', 'created_at', 'completed_at', 'downloaded_at']
+    readonly_fields = ['session_id', 'created_at', 'completed_at', 'downloaded_at', 'profiling_reports']
     inlines = [CompressionFileInline]
     
     fieldsets = (
@@ -44,7 +50,60 @@ class CompressionSessionAdmin(admin.ModelAdmin):
             'fields': ('error_message',),
             'classes': ('collapse',)
         }),
+        ('Profiling', {
+            'fields': ('profiling', 'profiling_reports'),
+            'description': 'cProfile and tracemalloc reports are written next to results.json '
+                           'when the session is compressed (or resumed) with profiling enabled'
+        }),
     )
+    
+    def get_urls(self):
+        urls = [
+            path(
+                '<path:object_id>/profile/<str:file_name>/',
+                self.admin_site.admin_view(self.download_profile),
+                name='compressor_compressionsession_profile'
+            ),
+        ]
+        return urls + super().get_urls()
+    
+    def profiling_reports(self, obj):
+        if not obj.pk:
+            return '-'
+        session_path = get_session_path(obj.session_id)
+        reports = [name for name in PROFILE_FILES if (session_path / name).exists()]
+        if not reports:
+            return '-'
+        return format_html_join(
+            ' | ', '<a href="{}">{}</a>',
+            ((reverse('admin:compressor_compressionsession_profile', args=[obj.pk, name]), name) for name in reports)
+        )
+    profiling_reports.short_description = 'Profiling reports'
+    
+    def download_profile(self, request, object_id, file_name):
+        """Скачать отчет профилирования сессии"""
+        db_session = get_object_or_404(CompressionSession, pk=object_id)
+        if not self.has_view_permission(request, db_session):
+            raise Http404
+        if file_name not in PROFILE_FILES:
+            raise Http404
+        
+        report_path = get_session_path(db_session.session_id) / file_name
+        if not report_path.exists():
+            raise Http404
+        
+        return FileResponse(
+            open(report_path, 'rb'),
+            as_attachment=True,
+            filename=f"{db_session.session_id[:8]}_{file_name}"
+        )
+
+
+@admin.register(ProfilingTarget)
+class ProfilingTargetAdmin(admin.ModelAdmin):
+    list_display = ['user', 'note', 'created_at']
+    search_fields = ['user__username', 'note']
+    autocomplete_fields = ['user']
 
 
 # Расширяем стандартный UserAdmin для удобства
@@ -0,0 +1,192 @@
+"""
+Асинхронные (ASGI) версии API для опроса статуса и скачивания.
+
+Используются вместо синхронных views при ASYNC_API = True: запросы к БД
+идут через async ORM, чтение файлов не блокирует event loop, поэтому
+один процесс держит тысячи одновременных опросов и скачиваний.
+"""
+
+import asyncio
+import json
+
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods
+
+from .compressor_engine import WebCompressor
+from .manifest import artifact_paths, read_manifest
+from .models import CompressionSession
+from .storage import get_session_path
+from .tasks import is_stale, read_summary
+from .zip_stream import ZipLimitError, ZipStream, aiter_sync, iter_file
+
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+async def read_json(path):
+    """Прочитать JSON файл, не блокируя event loop"""
+    return await asyncio.to_thread(_read_json, path)
+
+
+async def path_exists(path):
+    return await asyncio.to_thread(path.exists)
+
+
+async def session_path_for(session_id):
+    """Каталог сессии: поиск по корням - это stat на диске, в потоке"""
+    return await asyncio.to_thread(get_session_path, session_id)
+
+
+async def get_user_session(request, session_id):
+    """Сессия текущего пользователя (CompressionSession.DoesNotExist если нет доступа)"""
+    user = await request.auser()
+    return await CompressionSession.objects.aget(session_id=session_id, user=user)
+
+
+@login_required
+@require_http_methods(["GET"])
+async def get_status(request, session_id):
+    """Получить статус обработки"""
+    try:
+        db_session = await get_user_session(request, session_id)
+        
+        if db_session.status == 'canceled':
+            return JsonResponse({'progress': 0, 'stage': 'canceled'})
+        
+        session_path = await session_path_for(session_id)
+        
+        if not await path_exists(session_path):
+            return JsonResponse({'error': 'Session not found'}, status=404)
+        
+        progress_file = session_path / 'progress.json'
+        if await path_exists(progress_file):
+            progress_data = await read_json(progress_file)
+        else:
+            progress_data = {'progress': 0, 'stage': 'waiting'}
+        
+        # Обработка прервана (heartbeat просрочен): возобновит cron
+        # reset_stuck_sessions или POST api/compress/, а не опрос статуса
+        if is_stale(db_session):
+            progress_data['stalled'] = True
+        
+        # Только итоги - записи по файлам отдает api/results/
+        summary = await asyncio.to_thread(read_summary, session_path)
+        if summary is not None:
+            progress_data['results'] = summary
+            progress_data['stage'] = 'completed'
+        
+        return JsonResponse(progress_data)
+    
+    except CompressionSession.DoesNotExist:
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@login_required
+@require_http_methods(["GET"])
+async def get_summary(request, session_id):
+    """Получить итоговую статистику"""
+    try:
+        await get_user_session(request, session_id)
+        
+        summary = await asyncio.to_thread(read_summary, await session_path_for(session_id))
+        if summary is None:
+            return JsonResponse({'error': 'Results not found'}, status=404)
+        
+        return JsonResponse(summary)
+    
+    except CompressionSession.DoesNotExist:
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+def _find_download(session_path):
+    """Готовый архив или ZipStream из сжатых файлов (None если скачивать нечего)"""
+    manifest = read_manifest(session_path)
+    archives = artifact_paths(session_path, 'archives', manifest)
+    if archives:
+        return archives[0]
+    
+    files = artifact_paths(session_path, 'outputs', manifest)
+    if files:
+        return ZipStream(files)
+    return None
+
+
+def _stream_outputs(session_path):
+    """ZipStream из сжатых файлов сессии (None, если их нет)"""
+    files = artifact_paths(session_path, 'outputs')
+    return ZipStream(files) if files else None
+
+
+@login_required
+@require_http_methods(["GET"])
+async def download_archive(request, session_id):
+    """Скачать архив"""
+    try:
+        db_session = await get_user_session(request, session_id)
+        
+        download = await asyncio.to_thread(_find_download, await session_path_for(session_id))
+        
+        if download is None:
+            if db_session.evicted_at:
+                return HttpResponse('Archive was removed to free disk space', status=410)
+            return HttpResponse('Archive not found', status=404)
+        
+        if isinstance(download, ZipStream):
+            archive_name = f"{WebCompressor.sanitize_archive_name(db_session.archive_name)}.zip"
+            content_length = download.content_length()
+            content = aiter_sync(iter(download))
+        else:
+            archive_name = download.name
+            content_length = (await asyncio.to_thread(download.stat)).st_size
+            content = aiter_sync(iter_file(download))
+        
+        # Отмечаем как скачанное
+        await db_session.amark_as_downloaded()
+        
+        response = StreamingHttpResponse(content, content_type='application/zip')
+        response['Content-Length'] = str(content_length)
+        response['Content-Disposition'] = f'attachment; filename="{archive_name}"'
+        return response
+    
+    except CompressionSession.DoesNotExist:
+        return HttpResponse('Access denied', status=403)
+    except ZipLimitError as e:
+        return HttpResponse(str(e), status=400)
+    except Exception as e:
+        return HttpResponse(f'Error: {str(e)}', status=500)
+
+
+@login_required
+@require_http_methods(["GET"])
+async def download_stream(request, session_id):
+    """Скачать архив потоком, без сборки на диске"""
+    try:
+        db_session = await get_user_session(request, session_id)
+        
+        stream = await asyncio.to_thread(_stream_outputs, await session_path_for(session_id))
+        if stream is None:
+            if db_session.evicted_at:
+                return HttpResponse('Archive was removed to free disk space', status=410)
+            return HttpResponse('Archive not found', status=404)
+        
+        archive_name = WebCompressor.sanitize_archive_name(db_session.archive_name)
+        await db_session.amark_as_downloaded()
+        
+        response = StreamingHttpResponse(aiter_sync(iter(stream)), content_type='application/zip')
+        response['Content-Length'] = str(stream.content_length())
+        response['Content-Disposition'] = f'attachment; filename="{archive_name}.zip"'
+        return response
+    
+    except CompressionSession.DoesNotExist:
+        return HttpResponse('Access denied', status=403)
+    except ZipLimitError as e:
+        return HttpResponse(str(e), status=400)
+    except Exception as e:
+        return HttpResponse(f'Error: {str(e)}', status=500)
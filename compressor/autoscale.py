@@ -0,0 +1,145 @@
+"""
+Подбор числа слотов сжатия по нагрузке машины
+"""
+
+import os
+import threading
+import time
+
+from . import metrics
+
+
+# Прирост пропускной способности, при котором добавленный слот остается
+THROUGHPUT_GAIN = 0.05
+
+# Рост времени сжатия файла, после которого слоты мешают друг другу
+# (память, кэши) и один убирается
+LATENCY_LIMIT = 1.5
+
+# Сколько интервалов не добавлять слоты после отката
+HOLD_INTERVALS = 6
+
+# Минимум файлов за интервал для сравнения пропускной способности
+MIN_WINDOW_FILES = 2
+
+
+def cpu_times():
+    """(занято, всего) jiffies всех ядер из /proc/stat; None без /proc"""
+    try:
+        with open('/proc/stat') as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    total = sum(values)
+    return total - idle, total
+
+
+def available_memory():
+    """Доля доступной памяти (MemAvailable / MemTotal); None без /proc"""
+    try:
+        with open('/proc/meminfo') as f:
+            info = dict(line.split(':', 1) for line in f)
+        return int(info['MemAvailable'].split()[0]) / int(info['MemTotal'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class SlotController:
+    """
+    Число слотов планировщика по загрузке CPU, свободной памяти и времени
+    сжатия файла.
+    
+    Раз в interval секунд: при нехватке памяти слот убирается; пока спрос
+    больше слотов, а CPU загружен меньше cpu_target, слот добавляется.
+    Если добавленный слот не увеличил число файлов в секунду или время
+    файла выросло в LATENCY_LIMIT раз, слот убирается и новые не
+    добавляются HOLD_INTERVALS интервалов. Так число слотов держится у
+    точки насыщения машины: ночью пакетные задачи занимают все ядра,
+    а в пик параллельные уменьшения и кодирования не мешают друг другу.
+    """
+    
+    def __init__(self, scheduler, min_slots, max_slots, interval, cpu_target, min_available_memory):
+        self.scheduler = scheduler
+        self.min_slots = min_slots
+        self.max_slots = max(min_slots, max_slots)
+        self.interval = interval
+        self.cpu_target = cpu_target
+        self.min_available_memory = min_available_memory
+        
+        self._cpu = cpu_times()
+        self._last_step = time.monotonic()
+        self._baseline = None
+        self._probing = False
+        self._hold = 0
+        
+        self.scheduler.set_slots(min(self.max_slots, max(self.min_slots, scheduler.slots)))
+    
+    def start(self):
+        thread = threading.Thread(target=self._run, name='slot-controller', daemon=True)
+        thread.start()
+    
+    def cpu_busy(self):
+        """Загрузка CPU с прошлого замера (0..1)"""
+        current = cpu_times()
+        previous, self._cpu = self._cpu, current
+        if current and previous and current[1] > previous[1]:
+            return (current[0] - previous[0]) / (current[1] - previous[1])
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    
+    def step(self):
+        """Один шаг регулятора; возвращает (слотов, причина изменения или None)"""
+        now = time.monotonic()
+        elapsed, self._last_step = now - self._last_step, now
+        window = self.scheduler.take_window()
+        cpu = self.cpu_busy()
+        memory = available_memory()
+        slots = self.scheduler.slots
+        
+        throughput = window['files'] / elapsed if elapsed > 0 else 0
+        latency = window['busy_seconds'] / window['files'] if window['files'] else None
+        measured = window['files'] >= MIN_WINDOW_FILES
+        
+        probing, self._probing = self._probing, False
+        self._hold = max(0, self._hold - 1)
+        
+        if memory is not None and memory < self.min_available_memory and slots > self.min_slots:
+            return self.change(slots - 1, 'memory')
+        
+        if not window['saturated'] or not measured:
+            # Нет спроса или мало данных - сравнивать не с чем
+            return slots, None
+        
+        baseline = self._baseline
+        self._baseline = {'throughput': throughput, 'latency': latency}
+        
+        if probing and baseline and throughput < baseline['throughput'] * (1 + THROUGHPUT_GAIN):
+            self._hold = HOLD_INTERVALS
+            self._baseline = baseline
+            return self.change(slots - 1, 'no_gain')
+        
+        if baseline and latency > baseline['latency'] * LATENCY_LIMIT and slots > self.min_slots:
+            self._hold = HOLD_INTERVALS
+            return self.change(slots - 1, 'latency')
+        
+        if cpu < self.cpu_target and not self._hold and slots < self.max_slots:
+            self._probing = True
+            return self.change(slots + 1, 'cpu_idle')
+        
+        return slots, None
+    
+    def change(self, slots, reason):
+        slots = min(self.max_slots, max(self.min_slots, slots))
+        if slots != self.scheduler.slots:
+            print(f"Autoscale: {self.scheduler.slots} -> {slots} compression slots ({reason})")
+            self.scheduler.set_slots(slots)
+            metrics.AUTOSCALE_CHANGES.labels(reason=reason).inc()
+        return slots, reason
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.step()
+            except Exception as e:
+                print(f"Autoscale step failed: {e}")
@@ -0,0 +1,159 @@
+"""
+Пакетная обработка: ZIP/TAR архив с изображениями на входе, ZIP на выходе
+"""
+
+from pathlib import Path
+import io
+import json
+import shutil
+import tarfile
+import zipfile
+
+
+ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+
+
+def safe_entry_name(entry_path, used_names):
+    """
+    Плоское безопасное имя для файла из архива.
+    
+    Каталоги становятся частью имени (photos/a.jpg -> photos_a.jpg),
+    совпадения после санитизации получают числовой суффикс.
+    """
+    path = Path(entry_path)
+    stem = "_".join(path.parent.parts + (path.stem,))
+    stem = "".join(c for c in stem if c.isalnum() or c in ('_', '-', '.')).strip('._') or 'file'
+    suffix = path.suffix.lower()
+    
+    name = f"{stem}{suffix}"
+    counter = 1
+    while name in used_names:
+        counter += 1
+        name = f"{stem}_{counter}{suffix}"
+    used_names.add(name)
+    return name
+
+
+class ImageArchive:
+    """Изображения внутри ZIP или TAR архива (читаются по одному)"""
+    
+    def __init__(self, archive_path, max_entry_size):
+        self.archive_path = Path(archive_path)
+        self.max_entry_size = max_entry_size
+        
+        if zipfile.is_zipfile(self.archive_path):
+            self._zip = zipfile.ZipFile(self.archive_path)
+            self._tar = None
+            members = [
+                (info, info.filename, info.file_size)
+                for info in self._zip.infolist() if not info.is_dir()
+            ]
+        elif tarfile.is_tarfile(self.archive_path):
+            self._zip = None
+            self._tar = tarfile.open(self.archive_path, 'r:*')
+            members = [
+                (info, info.name, info.size)
+                for info in self._tar.getmembers() if info.isfile()
+            ]
+        else:
+            raise ValueError('Unsupported archive format (expected ZIP or TAR)')
+        
+        used_names = set()
+        self.entries = []
+        self.skipped = []
+        for member, entry_path, size in members:
+            name = Path(entry_path).name
+            if name.startswith('.') or '__MACOSX' in Path(entry_path).parts:
+                continue
+            if Path(entry_path).suffix.lower() not in ALLOWED_EXTENSIONS:
+                self.skipped.append({'name': entry_path, 'reason': 'unsupported format'})
+                continue
+            if size > self.max_entry_size:
+                self.skipped.append({'name': entry_path, 'reason': 'file too large'})
+                continue
+            self.entries.append((member, safe_entry_name(entry_path, used_names)))
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def close(self):
+        if self._zip:
+            self._zip.close()
+        if self._tar:
+            self._tar.close()
+    
+    def _open_member(self, member):
+        if self._zip:
+            return self._zip.open(member)
+        return self._tar.extractfile(member)
+    
+    def iter_files(self, scratch_path, skip=()):
+        """
+        Извлекать файлы по одному в scratch_path (лениво, по мере запроса).
+        
+        Извлеченный файл удаляет потребитель после обработки, поэтому на
+        диске лежат только записи, которые сейчас в работе.
+        Для имен из skip (уже обработаны) возвращается путь без извлечения.
+        """
+        scratch_path = Path(scratch_path)
+        scratch_path.mkdir(parents=True, exist_ok=True)
+        
+        for member, name in self.entries:
+            file_path = scratch_path / name
+            if name in skip:
+                yield file_path
+                continue
+            
+            with self._open_member(member) as src, open(file_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            yield file_path
+
+
+class _ChunkSink(io.RawIOBase):
+    """Неперематываемый приемник для zipfile: накопленное забирается через drain()"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_compressed_zip(compressor, archive, scratch_path, results):
+    """
+    Сжимать файлы архива по одному и сразу отдавать результат частями ZIP.
+    
+    Выходной файл удаляется сразу после записи в поток; итоговая
+    статистика попадает в results и последней записью results.json.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zipf:
+        for file_path in archive.iter_files(scratch_path):
+            with compressor.acquire_slot():
+                outcome = compressor.process_file(file_path)
+            file_path.unlink(missing_ok=True)
+            compressor.record_result(results, outcome)
+            
+            if outcome['success']:
+                for name in compressor.output_files(outcome):
+                    output_path = compressor.compressed_path / name
+                    zipf.write(output_path, name)
+                    output_path.unlink()
+            
+            data = sink.drain()
+            if data:
+                yield data
+        
+        results['skipped'] = archive.skipped
+        zipf.writestr('results.json', json.dumps(results, indent=2))
+    
+    yield sink.drain()
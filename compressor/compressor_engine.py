@@ -3,35 +3,149 @@
 Адаптированная версия HybridImageCompressor
 """
 
-from PIL import Image, ImageOps
+from PIL import Image, ImageSequence
 from pathlib import Path
+from .pipeline import Pipeline, Stage
+from .content_analysis import analyze_content, BUSY_EDGE_DENSITY, SMOOTH_EDGE_DENSITY
+from .normalize import orientation_transpose, prepare_for_resize, to_output_mode
+from .metadata import DEFAULT_METADATA_POLICY, METADATA_POLICIES, read_source, save_params, to_srgb
+from . import metrics
+from contextlib import nullcontext
+import io
+import shutil
+import threading
+import time
 import zipfile
 import json
 
 
+# Таблицы квантования N. Robidoux (по умолчанию в mozjpeg), естественный
+# порядок. Pillow масштабирует их по quality так же, как стандартные
+ROBIDOUX_QTABLE = [
+    16, 16, 16, 18, 25, 37, 56, 85,
+    16, 17, 20, 27, 34, 40, 53, 75,
+    16, 20, 24, 31, 43, 62, 91, 135,
+    18, 27, 31, 40, 53, 74, 106, 156,
+    25, 34, 43, 53, 69, 94, 131, 189,
+    37, 40, 62, 74, 94, 124, 169, 238,
+    56, 53, 91, 106, 131, 169, 226, 311,
+    85, 75, 135, 156, 189, 238, 311, 418,
+]
+
+# Пресеты кодировщика JPEG. Замер на фото 2400x1600, quality 60 / 85
+# (время кодирования, размер; PSNR одинаковый, у max -0.1 dB при 85):
+#   fast      16 / 17 ms   209 / 535 KB   baseline, без оптимизации Хаффмана
+#   balanced  26 / 30 ms   179 / 489 KB   оптимизированные таблицы Хаффмана
+#   max       44 / 67 ms   140 / 404 KB   progressive, 4:2:0, таблицы Robidoux
+ENCODER_PRESETS = {
+    'fast': {'optimize': False, 'progressive': False},
+    'balanced': {'optimize': True, 'progressive': False, 'subsampling': '4:2:0'},
+    'max': {
+        'optimize': True,
+        'progressive': True,
+        'subsampling': '4:2:0',
+        'qtables': [ROBIDOUX_QTABLE, ROBIDOUX_QTABLE],
+    },
+}
+
+
+# Форматы, многокадровые файлы которых сжимаются покадрово
+SEQUENCE_FORMATS = ('TIFF', 'WEBP')
+
+# Пресет кодировщика -> method кодировщика WebP (анимация): скорость
+# против размера, как optimize/progressive у JPEG
+WEBP_METHODS = {'fast': 2, 'balanced': 4, 'max': 6}
+
+# Пресет кодировщика -> уровень zlib для PNG без потерь (графика)
+PNG_COMPRESS_LEVELS = {'fast': 1, 'balanced': 6, 'max': 9}
+
+# Превью "до/после": длинная сторона и качество
+PREVIEW_SIZE = 320
+PREVIEW_QUALITY = 70
+
+
+class CompressionCanceled(Exception):
+    """Сжатие отменено пользователем"""
+
+
+class CancellationToken:
+    """
+    Флаг отмены сжатия.
+    
+    Внутри процесса - threading.Event, между процессами - файл-маркер:
+    отмена может прийти в другой worker, чем тот, что выполняет сжатие.
+    """
+    
+    def __init__(self, marker_path=None):
+        self._event = threading.Event()
+        self.marker_path = Path(marker_path) if marker_path else None
+    
+    def cancel(self):
+        self._event.set()
+        if self.marker_path:
+            self.marker_path.touch()
+    
+    def is_canceled(self):
+        if self._event.is_set():
+            return True
+        if self.marker_path and self.marker_path.exists():
+            self._event.set()
+            return True
+        return False
+
+
 class WebCompressor:
-    def __init__(self, session_path, prefix="", compression_settings=None):
+    def __init__(self, session_path, prefix="", compression_settings=None, output_path=None):
         """
         compression_settings = {
             'quality': int or None,  # None = auto
             'max_dimension': int or None,  # None = auto
-            'no_resize': bool  # True = keep original
+            'no_resize': bool,  # True = keep original
+            'preset': 'fast' | 'balanced' | 'max' or None,  # None = по категории
+            'metadata': 'strip' | 'srgb' | 'icc' | 'exif'  # см. metadata.py
         }
+        output_path - каталог для результатов вне структуры сессии
+        (compress_dir); по умолчанию session_path/compressed
         """
         self.session_path = Path(session_path)
         self.uploads_path = self.session_path / "uploads"
-        self.compressed_path = self.session_path / "compressed"
         self.archives_path = self.session_path / "archives"
         
-        self.compressed_path.mkdir(exist_ok=True)
-        self.archives_path.mkdir(exist_ok=True)
+        if output_path is not None:
+            self.compressed_path = Path(output_path)
+            self.compressed_path.mkdir(parents=True, exist_ok=True)
+        else:
+            self.compressed_path = self.session_path / "compressed"
+            self.compressed_path.mkdir(exist_ok=True)
+            self.archives_path.mkdir(exist_ok=True)
         
         self.prefix = prefix
+        self.compression_settings = compression_settings
+        
+        # Имена результатов с расширением исходника (photo_png_compressed.jpg):
+        # для каталогов, где photo.jpg и photo.png дали бы одно имя
+        self.keep_source_extension = False
         self.progress_callback = None
+        self.checkpoint_callback = None
+        self.cancel_token = None
+        self.slot_gate = None
+        
+        # Конвейер compress_batch: потоки на этап и размер очередей между
+        # этапами (ограничивает число декодированных изображений в памяти)
+        self.pipeline_workers = {'read': 1, 'decode': 1, 'encode': 1}
+        self.pipeline_queue_size = 2
+        self.thread_setup = None
+        self.thread_cleanup = None
+        
+        # Пул процессов сжатия (worker_pool.WorkerPool): файл целиком
+        # сжимается в отдельном процессе вместо этапов в потоках
+        self.worker_pool = None
+        
+        # Каталог для превью до/после (None - превью не создаются)
+        self.previews_path = None
         
-        # Целевые размеры
+        # Целевой размер
         self.target_max_size_mb = 1.0
-        self.target_min_size_kb = 50
         
         # Применяем настройки пользователя
         settings = compression_settings or {}
@@ -47,6 +161,28 @@ class WebCompressor:
             self.override_max_dimension = settings['max_dimension']
         else:
             self.override_max_dimension = 'auto'
+        
+        if settings.get('preset') in ENCODER_PRESETS:
+            self.override_preset = settings['preset']
+        else:
+            self.override_preset = None
+        
+        if settings.get('metadata') in METADATA_POLICIES:
+            self.metadata_policy = settings['metadata']
+        else:
+            self.metadata_policy = DEFAULT_METADATA_POLICY
+    
+    def check_canceled(self):
+        """Прервать обработку, если сессия отменена (проверяется между этапами)"""
+        if self.cancel_token and self.cancel_token.is_canceled():
+            raise CompressionCanceled()
+    
+    def acquire_slot(self, finishing=False):
+        """
+        Слот CPU на сжатие одного файла (если задан планировщик);
+        finishing=True - на завершение уже начатого файла
+        """
+        return self.slot_gate(finishing=finishing) if self.slot_gate else nullcontext()
     
     def get_file_size_mb(self, file_path):
         """Получить размер файла в МБ"""
@@ -56,11 +192,15 @@ class WebCompressor:
         """Получить размер файла в КБ"""
         return file_path.stat().st_size / 1024
     
-    def analyze_image(self, image_path):
-        """Полный анализ изображения"""
+    def analyze_image(self, image_path, source=None, content=True):
+        """
+        Полный анализ изображения (source - файловый объект вместо пути).
+        
+        content=False - только заголовок, без анализа содержимого JPEG.
+        """
         file_size_mb = self.get_file_size_mb(image_path)
         
-        with Image.open(image_path) as img:
+        with Image.open(source or image_path) as img:
             width, height = img.size
             max_dimension = max(width, height)
             aspect_ratio = width / height
@@ -77,9 +217,15 @@ class WebCompressor:
                 'aspect_ratio': aspect_ratio,
                 'format': format_type,
                 'is_whatsapp': is_whatsapp,
-                'is_png_transparent': is_png_with_transparency
+                'is_png_transparent': is_png_with_transparency,
+                'frames': getattr(img, 'n_frames', 1)
             }
             
+            # JPEG анализируется по миниатюре, декодированной в уменьшенном
+            # масштабе; остальные форматы - после полного декодирования
+            if content and format_type == 'JPEG' and analysis['frames'] == 1:
+                analysis.update(analyze_content(img))
+            
         return analysis
     
     def determine_compression_category(self, analysis):
@@ -94,7 +240,8 @@ class WebCompressor:
                 'quality': 90,
                 'max_dimension': None,
                 'description': 'WhatsApp (already optimized)',
-                'aggressive': False
+                'aggressive': False,
+                'preset': 'balanced'
             }
         # Основная логика категоризации
         elif size_mb > 10 or max_dim > 3000:
@@ -103,7 +250,8 @@ class WebCompressor:
                 'quality': 60,
                 'max_dimension': 1200,
                 'description': 'Aggressive compression',
-                'aggressive': True
+                'aggressive': True,
+                'preset': 'max'
             }
         elif size_mb > 2 or max_dim > 2000:
             result = {
@@ -111,7 +259,8 @@ class WebCompressor:
                 'quality': 75,
                 'max_dimension': 1400,
                 'description': 'Medium compression',
-                'aggressive': False
+                'aggressive': False,
+                'preset': 'max'
             }
         elif size_mb > 0.5 or max_dim > 1000:
             result = {
@@ -119,7 +268,8 @@ class WebCompressor:
                 'quality': 85,
                 'max_dimension': 1600,
                 'description': 'Light compression',
-                'aggressive': False
+                'aggressive': False,
+                'preset': 'balanced'
             }
         else:
             result = {
@@ -127,14 +277,20 @@ class WebCompressor:
                 'quality': 90,
                 'max_dimension': None,
                 'description': 'Minimal compression',
-                'aggressive': False
+                'aggressive': False,
+                'preset': 'balanced'
             }
         
+        self.apply_content_analysis(result, analysis)
+        
         # Применяем override если заданы
         if self.override_quality is not None:
             result['quality'] = self.override_quality
             result['description'] = f"Custom quality {self.override_quality}%"
         
+        if self.override_preset is not None:
+            result['preset'] = self.override_preset
+        
         if self.override_max_dimension != 'auto':
             result['max_dimension'] = self.override_max_dimension
             if self.override_max_dimension is None:
@@ -144,6 +300,37 @@ class WebCompressor:
         
         return result
     
+    def apply_content_analysis(self, result, analysis):
+        """Поправки категории по содержимому (если анализ выполнен)"""
+        if 'edge_density' not in analysis:
+            return
+        
+        if analysis['is_graphic']:
+            # Скриншоты и графика: текст и резкие цветные границы - без
+            # субдискретизации цвета, выше качество, меньше уменьшение;
+            # кроме JPEG кодируется PNG без потерь, остается меньший
+            result['quality'] = max(result['quality'], 85)
+            result['subsampling'] = '4:4:4'
+            result['lossless'] = True
+            if result['max_dimension'] is not None:
+                result['max_dimension'] = max(result['max_dimension'], 1920)
+            result['aggressive'] = False
+            result['description'] += ', graphic'
+        elif analysis['edge_density'] >= BUSY_EDGE_DENSITY:
+            # Мелкие детали и шум маскируют артефакты; для итеративного
+            # сжатия сразу стартуем ниже, чтобы не тратить лишние попытки
+            result['quality'] = max(30, result['quality'] - (10 if result['aggressive'] else 5))
+            result['description'] += ', detailed'
+        elif analysis['edge_density'] <= SMOOTH_EDGE_DENSITY:
+            # На плавных градиентах при низком качестве видны блоки
+            result['quality'] = max(result['quality'], 70)
+            result['description'] += ', smooth'
+        
+        if analysis['is_grayscale']:
+            # Один канал вместо трех: меньше файл и быстрее кодирование
+            result['grayscale'] = True
+            result['description'] += ', grayscale'
+    
     def resize_proportional(self, image, max_dimension):
         """Строго пропорциональное изменение размера"""
         if max_dimension is None:
@@ -161,20 +348,22 @@ class WebCompressor:
         
         return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
     
-    def compress_iteratively(self, image, base_quality, output_path, target_size_mb):
+    def save_jpeg(self, image, output_path, quality, preset, subsampling=None, metadata=None):
+        """Сохранить JPEG с параметрами пресета кодировщика (metadata - icc_profile/exif)"""
+        params = dict(ENCODER_PRESETS[preset], **(metadata or {}))
+        if subsampling:
+            params['subsampling'] = subsampling
+        image.save(output_path, 'JPEG', quality=quality, **params)
+    
+    def compress_iteratively(self, image, base_quality, output_path, target_size_mb, preset='max', subsampling=None, metadata=None):
         """Итеративное сжатие"""
         quality = base_quality
         attempts = 0
         max_attempts = 5
         
         while attempts < max_attempts:
-            image.save(
-                output_path,
-                'JPEG',
-                quality=quality,
-                optimize=True,
-                progressive=True
-            )
+            self.check_canceled()
+            self.save_jpeg(image, output_path, quality, preset, subsampling, metadata)
             
             current_size_mb = self.get_file_size_mb(output_path)
             
@@ -183,132 +372,566 @@ class WebCompressor:
                 
             quality = max(30, quality - 10)
             attempts += 1
+            metrics.ITERATIVE_RETRIES.inc()
             
         return current_size_mb, quality
     
     def compress_image(self, input_path):
         """Сжать одно изображение"""
+        outcome = self.compress_file(input_path)
+        return outcome['success'], outcome['original_mb'], outcome['compressed_mb'], outcome['category']
+    
+    def compress_file(self, input_path):
+        """Сжать одно изображение, результат - словарь с именем выходного файла"""
         try:
             analysis = self.analyze_image(input_path)
-            settings = self.determine_compression_category(analysis)
-            
-            with Image.open(input_path) as img:
-                # Автоповорот по EXIF
-                img = ImageOps.exif_transpose(img)
-                
-                # Обработка PNG с прозрачностью
-                if analysis['is_png_transparent']:
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Изменение размера
-                img = self.resize_proportional(img, settings['max_dimension'])
-                
-                # Имя выходного файла с префиксом
-                if self.prefix:
-                    output_name = f"{self.prefix}_{input_path.stem}_compressed.jpg"
-                else:
-                    output_name = f"{input_path.stem}_compressed.jpg"
-                
-                output_path = self.compressed_path / output_name
-                
-                # Сжатие
-                if settings['aggressive'] and analysis['file_size_mb'] > 5:
-                    final_size_mb, final_quality = self.compress_iteratively(
-                        img, settings['quality'], output_path, self.target_max_size_mb
-                    )
-                else:
-                    img.save(
-                        output_path,
-                        'JPEG',
-                        quality=settings['quality'],
-                        optimize=True,
-                        progressive=True
-                    )
-                    final_size_mb = self.get_file_size_mb(output_path)
-                
-                # Проверка: не стал ли файл больше
-                if final_size_mb > analysis['file_size_mb']:
-                    output_path.unlink()
-                    import shutil
-                    if self.prefix:
-                        final_output_path = self.compressed_path / f"{self.prefix}_{input_path.stem}_original{input_path.suffix}"
-                    else:
-                        final_output_path = self.compressed_path / f"{input_path.stem}_original{input_path.suffix}"
-                    shutil.copy2(input_path, final_output_path)
-                    final_size_mb = analysis['file_size_mb']
-                
-                return True, analysis['file_size_mb'], final_size_mb, settings['category']
-                
+            if self.is_sequence(analysis):
+                return self.compress_sequence(input_path, analysis)
+            img, analysis, settings = self.prepare_image(input_path, analysis=analysis)
+            return self.encode_image(input_path, img, analysis, settings)
+        except CompressionCanceled:
+            raise
         except Exception as e:
             print(f"Error compressing {input_path.name}: {e}")
-            return False, 0, 0, None
+            return self.failed_outcome(input_path)
     
-    def compress_batch(self, file_list):
-        """Сжать батч файлов с прогрессом"""
-        total = len(file_list)
-        results = {
+    def process_file(self, input_path):
+        """Сжать файл в пуле процессов, если он задан, иначе в текущем потоке"""
+        if self.worker_pool is None:
+            return self.compress_file(input_path)
+        try:
+            return self.worker_pool.compress(self, input_path)
+        except CompressionCanceled:
+            raise
+        except Exception as e:
+            print(f"Error compressing {input_path.name}: {e}")
+            return self.failed_outcome(input_path)
+    
+    def failed_outcome(self, input_path):
+        metrics.FILES.labels(result='failed').inc()
+        return {
+            'name': input_path.name,
+            'output_name': None,
+            'success': False,
+            'original_mb': 0,
+            'compressed_mb': 0,
+            'category': None
+        }
+    
+    @staticmethod
+    def output_files(outcome):
+        """Имена всех выходных файлов результата (у многостраничных - несколько)"""
+        return outcome.get('output_names') or [outcome['output_name']]
+    
+    def output_name(self, input_path, suffix):
+        """Имя выходного файла с префиксом"""
+        stem = input_path.stem
+        if self.keep_source_extension:
+            stem = f"{stem}_{input_path.suffix.lstrip('.')}"
+        if self.prefix:
+            return f"{self.prefix}_{stem}{suffix}"
+        return f"{stem}{suffix}"
+    
+    def prepare_image(self, input_path, data=None, analysis=None):
+        """
+        Декодирование и преобразование (поворот, цвет, размер).
+        
+        data - уже прочитанное содержимое файла (этап предзагрузки конвейера).
+        Возвращает (изображение, анализ, настройки сжатия).
+        """
+        def source():
+            return io.BytesIO(data) if data is not None else input_path
+        
+        if analysis is None:
+            analysis = self.analyze_image(input_path, source())
+        
+        with Image.open(source()) as img:
+            img, settings = self.normalize_image(img, analysis)
+        
+        return img, analysis, settings
+    
+    def normalize_image(self, img, analysis):
+        """
+        Цвет, поворот, анализ содержимого, категория и размер одного кадра.
+        
+        Альфа, палитра и 16 бит переводятся до уменьшения одним проходом,
+        CMYK (по ICC-профилю), перевод в sRGB и поворот по EXIF - уже после,
+        над уменьшенным кадром. Метаданные для записи (settings['save_metadata'])
+        берутся из заголовка, прочитанного при декодировании.
+        """
+        source = img
+        transpose = orientation_transpose(img)
+        source_metadata = read_source(img)
+        img = prepare_for_resize(img)
+        self.check_canceled()
+        
+        # Анализ содержимого для форматов без уменьшенного декодирования
+        if 'edge_density' not in analysis:
+            analysis.update(analyze_content(img))
+        settings = self.determine_compression_category(analysis)
+        
+        # Изменение размера
+        img = self.resize_proportional(img, settings['max_dimension'])
+        self.check_canceled()
+        
+        img = to_output_mode(img)
+        if transpose is not None:
+            img = img.transpose(transpose)
+        if self.metadata_policy == 'srgb':
+            img = to_srgb(img, source_metadata)
+        if img is source:
+            # Исходный кадр закрывает вызывающий код
+            img = img.copy()
+        
+        # Превью "до" - из уже декодированного изображения, до перевода в ч/б
+        if self.previews_path is not None:
+            analysis['preview'] = self.preview_image(img)
+        
+        if settings.get('grayscale') and img.mode != 'L':
+            img = img.convert('L')
+        settings['save_metadata'], settings['metadata_saved_bytes'] = save_params(img, source_metadata, self.metadata_policy)
+        self.check_canceled()
+        
+        return img, settings
+    
+    def write_jpeg(self, img, output_path, analysis, settings):
+        """Записать JPEG по настройкам категории; возвращает размер в МБ"""
+        try:
+            if settings['aggressive'] and analysis['file_size_mb'] > 5:
+                final_size_mb, final_quality = self.compress_iteratively(
+                    img, settings['quality'], output_path, self.target_max_size_mb,
+                    settings['preset'], settings.get('subsampling'), settings.get('save_metadata')
+                )
+            else:
+                self.check_canceled()
+                self.save_jpeg(
+                    img, output_path, settings['quality'], settings['preset'],
+                    settings.get('subsampling'), settings.get('save_metadata')
+                )
+                final_size_mb = self.get_file_size_mb(output_path)
+        except CompressionCanceled:
+            # Не оставляем недописанный результат
+            output_path.unlink(missing_ok=True)
+            raise
+        return final_size_mb
+    
+    def write_png(self, img, jpeg_path, jpeg_size_mb, settings):
+        """
+        PNG без потерь для графики: остается вместо JPEG, если не больше его.
+        Возвращает (путь результата, размер в МБ).
+        """
+        png_path = jpeg_path.with_suffix('.png')
+        try:
+            self.check_canceled()
+            img.save(
+                png_path, 'PNG', compress_level=PNG_COMPRESS_LEVELS[settings['preset']],
+                **(settings.get('save_metadata') or {})
+            )
+        except CompressionCanceled:
+            png_path.unlink(missing_ok=True)
+            jpeg_path.unlink(missing_ok=True)
+            raise
+        
+        png_size_mb = self.get_file_size_mb(png_path)
+        if png_size_mb <= jpeg_size_mb:
+            jpeg_path.unlink()
+            return png_path, png_size_mb
+        png_path.unlink()
+        return jpeg_path, jpeg_size_mb
+    
+    def encode_image(self, input_path, img, analysis, settings):
+        """
+        Кодирование в JPEG (графика - JPEG или PNG, что меньше); если
+        результат больше оригинала - копия оригинала
+        """
+        output_path = self.compressed_path / self.output_name(input_path, "_compressed.jpg")
+        started = time.monotonic()
+        
+        final_size_mb = self.write_jpeg(img, output_path, analysis, settings)
+        if settings.get('lossless'):
+            output_path, final_size_mb = self.write_png(img, output_path, final_size_mb, settings)
+        
+        metrics.ENCODE_SECONDS.labels(category=settings['category']).observe(time.monotonic() - started)
+        
+        return self.finish_outcome(input_path, [output_path], final_size_mb, analysis, settings)
+    
+    def finish_outcome(self, input_path, output_paths, final_size_mb, analysis, settings):
+        """Итог файла; если результат больше оригинала - вместо него копия оригинала"""
+        metadata_saved_bytes = settings.get('metadata_saved_bytes', 0)
+        
+        # Проверка: не стал ли файл больше
+        if final_size_mb > analysis['file_size_mb']:
+            for output_path in output_paths:
+                output_path.unlink()
+            final_output_path = self.compressed_path / self.output_name(input_path, f"_original{input_path.suffix}")
+            shutil.copy2(input_path, final_output_path)
+            output_paths = [final_output_path]
+            final_size_mb = analysis['file_size_mb']
+            metadata_saved_bytes = 0
+            metrics.ORIGINAL_FALLBACKS.inc()
+        
+        metrics.record_file(input_path.stat().st_size, sum(p.stat().st_size for p in output_paths))
+        
+        if self.previews_path is not None:
+            self.write_previews(input_path, output_paths[0], analysis.pop('preview', None))
+        
+        outcome = {
+            'name': input_path.name,
+            'output_name': output_paths[0].name,
+            'success': True,
+            'original_mb': analysis['file_size_mb'],
+            'compressed_mb': final_size_mb,
+            'category': settings['category'],
+            'preset': settings['preset'],
+            'metadata_saved_bytes': metadata_saved_bytes
+        }
+        if len(output_paths) > 1:
+            outcome['output_names'] = [p.name for p in output_paths]
+        if analysis.get('frames', 1) > 1:
+            outcome['frames'] = analysis['frames']
+        return outcome
+    
+    def preview_image(self, img):
+        """Уменьшенная копия для превью (из декодированного изображения)"""
+        scale = PREVIEW_SIZE / max(img.size)
+        if scale >= 1:
+            return img.copy()
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        return img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    
+    def preview_from_file(self, file_path):
+        """Превью из файла: JPEG декодируется сразу в уменьшенном масштабе"""
+        with Image.open(file_path) as img:
+            img.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+            transpose = orientation_transpose(img)
+            preview = to_output_mode(self.preview_image(prepare_for_resize(img)))
+            return preview.transpose(transpose) if transpose is not None else preview
+    
+    def write_previews(self, input_path, output_path, before=None):
+        """
+        Записать превью до/после в previews_path.
+        
+        before - уже готовое превью исходника; без него исходник
+        декодируется заново.
+        """
+        name = input_path.name
+        try:
+            if before is None:
+                before = self.preview_from_file(input_path)
+            self.write_preview(name, 'before', before)
+            self.write_preview(name, 'after', self.preview_from_file(output_path))
+        except Exception as e:
+            # Без превью результат сжатия остается валидным
+            print(f"Preview for {name} failed: {e}")
+    
+    def write_preview(self, name, kind, preview):
+        """Сохранить превью (kind - before или after); возвращает путь"""
+        self.previews_path.mkdir(exist_ok=True)
+        preview_path = self.previews_path / f"{name}.{kind}.jpg"
+        self.save_jpeg(preview, preview_path, PREVIEW_QUALITY, 'fast')
+        return preview_path
+    
+    def is_sequence(self, analysis):
+        """Многостраничный TIFF или анимированный WebP"""
+        return analysis.get('frames', 1) > 1 and analysis['format'] in SEQUENCE_FORMATS
+    
+    def compress_sequence(self, input_path, analysis, data=None):
+        """
+        Сжать многокадровый файл.
+        
+        Страницы TIFF становятся отдельными JPEG (_p001, _p002, ...) и
+        кодируются по одной - в памяти одна страница. Анимированный WebP
+        перекодируется в анимированный WebP (см. encode_animation). Кадры
+        читаются по одному через ImageSequence.
+        """
+        started = time.monotonic()
+        output_paths = []
+        
+        try:
+            with Image.open(io.BytesIO(data) if data is not None else input_path) as img:
+                if analysis['format'] == 'WEBP':
+                    settings = self.determine_compression_category(analysis)
+                    if self.previews_path is not None:
+                        analysis['preview'] = to_output_mode(self.preview_image(prepare_for_resize(img)))
+                    output_paths.append(self.encode_animation(input_path, img, settings))
+                else:
+                    settings = None
+                    for page_no, frame in enumerate(ImageSequence.Iterator(img), start=1):
+                        self.check_canceled()
+                        # Категория и анализ содержимого - по каждой странице
+                        page_analysis = dict(
+                            analysis,
+                            width=frame.width,
+                            height=frame.height,
+                            max_dimension=max(frame.size),
+                            file_size_mb=analysis['file_size_mb'] / analysis['frames']
+                        )
+                        page, page_settings = self.normalize_image(frame, page_analysis)
+                        if page_no == 1:
+                            settings = page_settings
+                            analysis['preview'] = page_analysis.pop('preview', None)
+                        
+                        output_path = self.compressed_path / self.output_name(input_path, f"_p{page_no:03d}_compressed.jpg")
+                        output_paths.append(output_path)
+                        self.write_jpeg(page, output_path, page_analysis, page_settings)
+                        page.close()
+        except Exception:
+            # Отмена или ошибка на одном из кадров - без частичных результатов
+            for output_path in output_paths:
+                output_path.unlink(missing_ok=True)
+            raise
+        
+        metrics.ENCODE_SECONDS.labels(category=settings['category']).observe(time.monotonic() - started)
+        
+        final_size_mb = sum(self.get_file_size_mb(p) for p in output_paths)
+        return self.finish_outcome(input_path, output_paths, final_size_mb, analysis, settings)
+    
+    def encode_animation(self, input_path, img, settings):
+        """
+        Перекодировать анимированный WebP. Каждый кадр декодируется один
+        раз и сразу уменьшается до max_dimension категории; кодировщик
+        WebP принимает кадры списком, поэтому в памяти все кадры, но уже
+        в размере результата. Пресет категории задает method кодировщика
+        WebP. Цвета кадров не переводятся: при политике srgb профиль
+        сохраняется, как при icc.
+        """
+        output_path = self.compressed_path / self.output_name(input_path, "_compressed.webp")
+        policy = 'icc' if self.metadata_policy == 'srgb' else self.metadata_policy
+        metadata, settings['metadata_saved_bytes'] = save_params(img, read_source(img), policy)
+        
+        size = img.size
+        if settings['max_dimension'] and max(img.size) > settings['max_dimension']:
+            scale = settings['max_dimension'] / max(img.size)
+            size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        
+        # Длительности кадров могут различаться (WebP заполняет duration
+        # только после декодирования кадра)
+        frames = []
+        durations = []
+        for frame in ImageSequence.Iterator(img):
+            self.check_canceled()
+            frame.load()
+            durations.append(frame.info.get('duration', 0))
+            if frame.size != size:
+                frames.append(frame.resize(size, Image.Resampling.LANCZOS))
+            else:
+                frames.append(frame.copy())
+        
+        try:
+            frames[0].save(
+                output_path,
+                'WEBP',
+                save_all=True,
+                append_images=frames[1:],
+                duration=durations,
+                loop=img.info.get('loop', 0),
+                quality=settings['quality'],
+                method=WEBP_METHODS[settings['preset']],
+                **metadata
+            )
+        except Exception:
+            output_path.unlink(missing_ok=True)
+            raise
+        return output_path
+    
+    def new_results(self):
+        """Пустая структура результатов батча"""
+        return {
             'successful': 0,
             'failed': 0,
             'total_original_mb': 0,
             'total_compressed_mb': 0,
             'files': [],
-            'categories': {}
+            'failed_files': [],
+            'categories': {},
+            'metadata_saved_bytes': 0
         }
+    
+    def record_result(self, results, outcome):
+        """Учесть результат одного файла в статистике батча"""
+        if not outcome['success']:
+            results['failed'] += 1
+            results.setdefault('failed_files', []).append(outcome['name'])
+            return
         
-        for idx, file_path in enumerate(file_list):
-            # Уведомляем о прогрессе
-            if self.progress_callback:
-                self.progress_callback({
-                    'progress': int((idx / total) * 100),
-                    'current_file': file_path.name,
-                    'stage': 'compressing',
-                    'index': idx + 1,
-                    'total': total
-                })
-            
-            # Сжимаем файл
-            success, orig_mb, comp_mb, category = self.compress_image(file_path)
-            
-            if success:
-                results['successful'] += 1
-                results['total_original_mb'] += orig_mb
-                results['total_compressed_mb'] += comp_mb
+        orig_mb = outcome['original_mb']
+        comp_mb = outcome['compressed_mb']
+        category = outcome['category']
+        
+        results['successful'] += 1
+        results['total_original_mb'] += orig_mb
+        results['total_compressed_mb'] += comp_mb
+        results['metadata_saved_bytes'] = results.get('metadata_saved_bytes', 0) + outcome.get('metadata_saved_bytes', 0)
+        
+        results['files'].append({
+            'name': outcome['name'],
+            'output_name': outcome['output_name'],
+            'original_mb': round(orig_mb, 2),
+            'compressed_mb': round(comp_mb, 2),
+            'savings': round((1 - comp_mb/orig_mb) * 100, 1) if orig_mb > 0 else 0,
+            'category': category,
+            'preset': outcome.get('preset'),
+            'metadata_saved_bytes': outcome.get('metadata_saved_bytes', 0)
+        })
+        if outcome.get('output_names'):
+            results['files'][-1]['output_names'] = outcome['output_names']
+        
+        # Статистика по категориям
+        if category:
+            if category not in results['categories']:
+                results['categories'][category] = {'count': 0, 'orig': 0, 'comp': 0}
+            results['categories'][category]['count'] += 1
+            results['categories'][category]['orig'] += orig_mb
+            results['categories'][category]['comp'] += comp_mb
+    
+    def compress_batch(self, file_list, completed=None, total=None, archive_name=None, delete_inputs=False):
+        """
+        Сжать батч файлов с прогрессом.
+        
+        Файлы проходят конвейер этапов: чтение с диска -> декодирование и
+        преобразование -> кодирование -> добавление в архив (если задан
+        archive_name). Этапы работают параллельно в своих потоках, поэтому
+        чтение следующего файла идет одновременно с кодированием текущего.
+        С пулом процессов (worker_pool) файл целиком сжимается одним этапом
+        в свободном процессе пула. Загрузка этапов пишется в results['pipeline'].
+        
+        file_list может быть генератором (например, файлы из архива,
+        извлекаемые по одному) - тогда общее число передается в total.
+        completed - результаты уже обработанных файлов (по имени) из чекпоинта
+        прерванного запуска: такие файлы не сжимаются повторно.
+        Исходные файлы удаляются только при delete_inputs=True (после записи
+        чекпоинта), иначе это делает вызывающий код после завершения батча.
+        """
+        completed = completed or {}
+        if total is None:
+            total = len(file_list)
+        results = self.new_results()
+        
+        self.archive_path = None
+        zipf = None
+        if archive_name:
+            self.archives_path.mkdir(exist_ok=True)
+            self.archive_path = self.archives_path / f"{self.sanitize_archive_name(archive_name)}.zip"
+            zipf = zipfile.ZipFile(self.archive_path, 'w', zipfile.ZIP_STORED)
+        
+        def items():
+            for file_path in file_list:
+                yield {'path': file_path, 'outcome': completed.get(file_path.name)}
+        
+        def read_stage(item):
+            if item['outcome'] is None:
+                self.check_canceled()
+                item['data'] = item['path'].read_bytes()
+            return item
+        
+        def decode_stage(item):
+            if item['outcome'] is None:
+                data = item.pop('data')
+                with self.acquire_slot():
+                    try:
+                        analysis = self.analyze_image(item['path'], io.BytesIO(data))
+                        if self.is_sequence(analysis):
+                            # Многокадровый файл сжимается здесь целиком, по кадру
+                            item['outcome'] = self.compress_sequence(item['path'], analysis, data)
+                        else:
+                            item['image'] = self.prepare_image(item['path'], data, analysis)
+                    except CompressionCanceled:
+                        raise
+                    except Exception as e:
+                        print(f"Error compressing {item['path'].name}: {e}")
+                        item['outcome'] = self.failed_outcome(item['path'])
+            return item
+        
+        def encode_stage(item):
+            if item['outcome'] is None:
+                img, analysis, settings = item.pop('image')
+                with self.acquire_slot(finishing=True):
+                    try:
+                        item['outcome'] = self.encode_image(item['path'], img, analysis, settings)
+                    except CompressionCanceled:
+                        raise
+                    except Exception as e:
+                        print(f"Error compressing {item['path'].name}: {e}")
+                        item['outcome'] = self.failed_outcome(item['path'])
+                    finally:
+                        img.close()
+            return item
+        
+        def pooled_stage(item):
+            if item['outcome'] is None:
+                self.check_canceled()
+                with self.acquire_slot():
+                    item['outcome'] = self.process_file(item['path'])
+            return item
+        
+        def archive_stage(item):
+            outcome = item['outcome']
+            if zipf is not None and outcome['success']:
+                for name in self.output_files(outcome):
+                    zipf.write(self.compressed_path / name, name)
+            return item
+        
+        workers = self.pipeline_workers
+        if self.worker_pool is not None:
+            # Чтение, декодирование и кодирование - в процессах пула
+            stages = [Stage('compress', pooled_stage, self.worker_pool.size)]
+        else:
+            stages = [
+                Stage('read', read_stage, workers.get('read', 1)),
+                Stage('decode', decode_stage, workers.get('decode', 1)),
+                Stage('encode', encode_stage, workers.get('encode', 1)),
+            ]
+        if zipf is not None:
+            stages.append(Stage('archive', archive_stage, 1))
+        
+        pipeline = Pipeline(
+            stages, self.pipeline_queue_size,
+            on_thread_exit=self.thread_cleanup, on_thread_start=self.thread_setup
+        )
+        
+        if self.progress_callback:
+            self.progress_callback({
+                'progress': 0,
+                'current_file': '',
+                'stage': 'compressing',
+                'index': 0,
+                'total': total
+            })
+        
+        try:
+            for done, item in enumerate(pipeline.run(items()), start=1):
+                outcome = item['outcome']
+                is_new = item['path'].name not in completed
                 
-                if self.prefix:
-                    output_name = f"{self.prefix}_{file_path.stem}_compressed.jpg"
-                else:
-                    output_name = f"{file_path.stem}_compressed.jpg"
+                if is_new and self.checkpoint_callback:
+                    self.checkpoint_callback(outcome)
+                if is_new and delete_inputs:
+                    item['path'].unlink(missing_ok=True)
                 
-                results['files'].append({
-                    'name': file_path.name,
-                    'output_name': output_name,
-                    'original_mb': round(orig_mb, 2),
-                    'compressed_mb': round(comp_mb, 2),
-                    'savings': round((1 - comp_mb/orig_mb) * 100, 1) if orig_mb > 0 else 0,
-                    'category': category
-                })
+                self.record_result(results, outcome)
                 
-                # Статистика по категориям
-                if category:
-                    if category not in results['categories']:
-                        results['categories'][category] = {'count': 0, 'orig': 0, 'comp': 0}
-                    results['categories'][category]['count'] += 1
-                    results['categories'][category]['orig'] += orig_mb
-                    results['categories'][category]['comp'] += comp_mb
-            else:
-                results['failed'] += 1
-            
-            # Удаляем исходный файл после сжатия
-            try:
-                file_path.unlink()
-            except:
-                pass
+                # Уведомляем о прогрессе
+                if self.progress_callback:
+                    self.progress_callback({
+                        'progress': int((done / total) * 100),
+                        'current_file': item['path'].name,
+                        'stage': 'compressing',
+                        'index': done,
+                        'total': total
+                    })
+        finally:
+            if zipf is not None:
+                zipf.close()
+        
+        results['pipeline'] = pipeline.utilization()
+        if zipf is not None:
+            metrics.ARCHIVE_SECONDS.observe(stages[-1].busy_seconds)
+        
+        # Сжатые файлы уже в архиве
+        if zipf is not None:
+            for entry in results['files']:
+                for name in self.output_files(entry):
+                    (self.compressed_path / name).unlink(missing_ok=True)
         
         # Финальный прогресс
         if self.progress_callback:
@@ -320,24 +943,11 @@ class WebCompressor:
         
         return results
     
-    def create_archive(self, archive_name=None):
-        """Создать ZIP архив"""
+    @staticmethod
+    def sanitize_archive_name(archive_name):
+        """Безопасное имя архива (без расширения)"""
         if not archive_name:
-            archive_name = "Archive"
+            return "Archive"
         
-        # Санитизация имени
         archive_name = "".join(c for c in archive_name if c.isalnum() or c in (' ', '-', '_')).strip()
-        if not archive_name:
-            archive_name = "Archive"
-        
-        archive_path = self.archives_path / f"{archive_name}.zip"
-        
-        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file in self.compressed_path.glob('*'):
-                zipf.write(file, file.name)
-        
-        # Удаляем сжатые файлы после архивации
-        for file in self.compressed_path.glob('*'):
-            file.unlink()
-        
-        return archive_path
\ No newline at end of file
+        return archive_name or "Archive"
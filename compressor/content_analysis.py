@@ -0,0 +1,92 @@
+"""
+Анализ содержимого изображения по маленькой миниатюре (NumPy).
+
+Миниатюра JPEG декодируется сразу в уменьшенном масштабе (draft);
+остальные форматы декодируются полностью, и анализируется уменьшенная
+копия уже декодированного кадра.
+"""
+
+import numpy as np
+
+from .normalize import prepare_for_resize, to_output_mode
+
+
+# Сторона миниатюры для анализа
+THUMBNAIL_SIZE = 256
+
+# Перепад яркости соседних пикселей, который считается границей
+EDGE_THRESHOLD = 24
+
+# Допуск "плоских" участков (шум JPEG у скриншотов, сохраненных в JPEG)
+FLAT_TOLERANCE = 2
+
+# Пороги классификации
+GRAPHIC_FLAT_SHARE = 0.6
+GRAPHIC_MAX_ENTROPY = 6.0
+GRAYSCALE_MAX_CHROMA = 10
+BUSY_EDGE_DENSITY = 0.2
+SMOOTH_EDGE_DENSITY = 0.03
+
+
+def draft_thumbnail(img):
+    """
+    Миниатюра для анализа.
+    
+    JPEG до загрузки декодируется сразу в уменьшенном масштабе (draft,
+    1/2..1/8 в DCT), поэтому полного декодирования не происходит.
+    Уменьшение - усреднением блоков (reduce), оно не размывает плоские
+    участки скриншотов.
+    """
+    if img.format == 'JPEG':
+        # У уже загруженного изображения draft ничего не делает
+        img.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    
+    img = prepare_for_resize(img)
+    factor = max(1, max(img.size) // THUMBNAIL_SIZE)
+    if factor > 1:
+        img = img.reduce(factor)
+    
+    # CMYK переводится уже у миниатюры
+    return to_output_mode(img)
+
+
+def analyze_content(img):
+    """
+    Оценки содержимого: плотность границ, энтропия яркости, доля плоских
+    участков, скриншот/графика, почти черно-белое изображение.
+    """
+    thumb = draft_thumbnail(img)
+    pixels = np.asarray(thumb, dtype=np.int32)
+    
+    if pixels.ndim == 2:
+        luma = pixels
+        chroma = np.zeros_like(pixels)
+    else:
+        rgb = pixels[..., :3]
+        luma = (rgb[..., 0] * 299 + rgb[..., 1] * 587 + rgb[..., 2] * 114) // 1000
+        chroma = rgb.max(axis=-1) - rgb.min(axis=-1)
+    
+    dx = np.abs(np.diff(luma, axis=1))[:-1, :]
+    dy = np.abs(np.diff(luma, axis=0))[:, :-1]
+    
+    if dx.size:
+        edge_density = float(np.mean((dx + dy) > EDGE_THRESHOLD))
+        flat_share = float(np.mean((dx <= FLAT_TOLERANCE) & (dy <= FLAT_TOLERANCE)))
+    else:
+        edge_density = flat_share = 0.0
+    
+    histogram = np.bincount(luma.ravel(), minlength=256).astype(np.float64)
+    probabilities = histogram[histogram > 0] / luma.size
+    entropy = float(-(probabilities * np.log2(probabilities)).sum())
+    
+    # 99-й перцентиль, чтобы редкие цветные пиксели (подпись, логотип)
+    # не мешали считать фото черно-белым
+    max_chroma = float(np.percentile(chroma, 99))
+    
+    return {
+        'edge_density': round(edge_density, 3),
+        'entropy': round(entropy, 2),
+        'flat_share': round(flat_share, 3),
+        'is_graphic': flat_share >= GRAPHIC_FLAT_SHARE and entropy <= GRAPHIC_MAX_ENTROPY,
+        'is_grayscale': max_chroma <= GRAYSCALE_MAX_CHROMA,
+    }
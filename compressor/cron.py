@@ -2,18 +2,24 @@
 Cron задачи для очистки и обслуживания
 """
 
-import os
 import shutil
-import time
 from datetime import timedelta
 from django.conf import settings
 from django.utils import timezone
 from pathlib import Path
 from .models import CompressionSession
+from .storage import enforce_watermarks, evict_session, iter_session_dirs
+from .tasks import stale_heartbeat_filter, resume_session
 
 
 def cleanup_old_sessions():
-    """Удаляет файлы сессий старше 24 часов"""
+    """
+    Удаляет файлы сессий старше 24 часов.
+    
+    Сессии выбираются по БД (created_at, evicted_at); каталоги без записи
+    в БД (прерванная потоковая пакетная сессия) - по шардам TEMP_ROOT и
+    SCRATCH_ROOT, без обхода содержимого сессий.
+    """
     print(f"[{timezone.now()}] Starting cleanup old sessions...")
     
     temp_root = Path(settings.TEMP_ROOT)
@@ -21,47 +27,57 @@ def cleanup_old_sessions():
         print("TEMP_ROOT does not exist")
         return
     
+    cutoff = timezone.now() - timedelta(hours=24)
     deleted_count = 0
-    cutoff_timestamp = time.time() - (24 * 3600)  # 24 часа назад
     
-    # Проходим по всем сессиям
-    for session_dir in temp_root.iterdir():
-        if not session_dir.is_dir():
+    old_sessions = CompressionSession.objects.filter(
+        evicted_at__isnull=True, created_at__lt=cutoff
+    ).exclude(status='processing')
+    for db_session in old_sessions:
+        evict_session(db_session)
+        deleted_count += 1
+        print(f"Deleted old session: {db_session.session_id}")
+    
+    known = set(CompressionSession.objects.filter(evicted_at__isnull=True).values_list('session_id', flat=True))
+    cutoff_timestamp = cutoff.timestamp()
+    for session_dir in iter_session_dirs():
+        if session_dir.name in known:
             continue
-        
-        # Проверяем время модификации
-        mtime = session_dir.stat().st_mtime
-        
-        if mtime < cutoff_timestamp:
-            try:
+        try:
+            if session_dir.stat().st_mtime < cutoff_timestamp:
                 shutil.rmtree(session_dir)
                 deleted_count += 1
-                print(f"Deleted old session: {session_dir.name}")
-            except Exception as e:
-                print(f"Error deleting {session_dir.name}: {e}")
+                print(f"Deleted orphaned session directory: {session_dir.name}")
+        except Exception as e:
+            print(f"Error deleting {session_dir.name}: {e}")
     
     print(f"Cleanup completed. Deleted {deleted_count} old sessions.")
 
 
+def enforce_storage_watermarks():
+    """Проверка порогов заполнения временных файлов (вытеснение сессий)"""
+    evicted = enforce_watermarks()
+    if evicted:
+        print(f"[{timezone.now()}] Evicted {evicted} sessions to free disk space")
+
+
 def reset_stuck_sessions():
-    """Сбрасывает зависшие сессии в статус error"""
+    """
+    Возобновляет сессии с просроченным heartbeat (или переводит в error).
+    
+    Сессии сжимаются параллельно в фоновых потоках, как обычные запуски;
+    процесс cron ждет их завершения, иначе потоки умрут вместе с ним.
+    """
     print(f"[{timezone.now()}] Checking for stuck sessions...")
     
-    # Сессии в статусе processing старше 30 минут
-    cutoff_time = timezone.now() - timedelta(minutes=30)
+    stuck_sessions = list(CompressionSession.objects.filter(stale_heartbeat_filter()))
     
-    stuck_sessions = CompressionSession.objects.filter(
-        status='processing',
-        created_at__lt=cutoff_time
-    )
+    if not stuck_sessions:
+        print("No stuck sessions found")
+        return
     
-    count = stuck_sessions.count()
+    threads = [thread for thread in map(resume_session, stuck_sessions) if thread is not None]
+    print(f"Found {len(stuck_sessions)} stuck sessions, resumed {len(threads)}")
     
-    if count > 0:
-        stuck_sessions.update(
-            status='error',
-            error_message='Session timed out - possible connection loss during processing'
-        )
-        print(f"Reset {count} stuck sessions to error status")
-    else:
-        print("No stuck sessions found")
\ No newline at end of file
+    for thread in threads:
+        thread.join()
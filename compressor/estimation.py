@@ -0,0 +1,279 @@
+"""
+Оценка результата сжатия без создания выходных файлов (dry-run)
+"""
+
+from PIL import Image
+from .content_analysis import analyze_content
+from .normalize import prepare_for_resize, to_output_mode
+import io
+import time
+
+
+# Пробное кодирование: мозаика 2x2 плиток TRIAL_TILE x TRIAL_TILE
+# в масштабе результата
+TRIAL_TILE = 256
+
+# Время на пробные кодирования батча; файлы, до которых не дошла
+# очередь, оцениваются по своей группе
+TRIAL_BUDGET_SECONDS = 0.3
+
+# Битов на пиксель результата, если пробного кодирования не было
+DEFAULT_BITS_PER_PIXEL = 2.0
+
+# Модель времени, секунд на мегапиксель (фото 2400x1800, одно ядро)
+DECODE_SECONDS_PER_MP = {'JPEG': 0.005, 'PNG': 0.026, 'WEBP': 0.018}
+DEFAULT_DECODE_SECONDS_PER_MP = 0.004
+RESIZE_SECONDS_PER_MP = 0.016
+FILE_OVERHEAD_SECONDS = 0.05  # анализ содержимого, превью, запись
+ENCODE_SECONDS_PER_MP = {'fast': 0.0045, 'balanced': 0.010, 'max': 0.020}
+
+# Поправка модели по замеру пробных кодирований на этой машине
+MIN_SPEED_FACTOR = 0.5
+MAX_SPEED_FACTOR = 4.0
+
+
+def output_size(analysis, settings):
+    """Размер результата после уменьшения (как resize_proportional)"""
+    width, height = analysis['width'], analysis['height']
+    max_dimension = settings['max_dimension']
+    if max_dimension is None or max(width, height) <= max_dimension:
+        return width, height
+    scale = max_dimension / max(width, height)
+    return int(width * scale), int(height * scale)
+
+
+def model_seconds(analysis, settings, size, frames):
+    """Время сжатия файла по модели (декодирование, уменьшение, кодирование)"""
+    input_mp = analysis['width'] * analysis['height'] / 1e6
+    output_mp = size[0] * size[1] / 1e6
+    
+    seconds = DECODE_SECONDS_PER_MP.get(analysis['format'], DEFAULT_DECODE_SECONDS_PER_MP) * input_mp
+    if size != (analysis['width'], analysis['height']):
+        seconds += RESIZE_SECONDS_PER_MP * input_mp
+    seconds += ENCODE_SECONDS_PER_MP[settings['preset']] * output_mp
+    return seconds * frames + FILE_OVERHEAD_SECONDS
+
+
+def trial_cost(analysis, size):
+    """Ожидаемое время декодирования для пробы (порядок проб - от дешевых)"""
+    input_mp = analysis['width'] * analysis['height'] / 1e6
+    if analysis['format'] == 'JPEG':
+        # draft декодирует сразу в масштабе не меньше результата
+        scale = 1
+        while scale < 8 and analysis['width'] / (scale * 2) >= size[0]:
+            scale *= 2
+        input_mp /= scale * scale
+    return DECODE_SECONDS_PER_MP.get(analysis['format'], DEFAULT_DECODE_SECONDS_PER_MP) * input_mp
+
+
+def decode_for_trial(input_path, size):
+    """Декодировать первый кадр; JPEG - сразу в масштабе не меньше результата"""
+    with Image.open(input_path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', size)
+        # Как у сжимаемого кадра: альфа на белом фоне, CMYK по ICC
+        rgb = to_output_mode(prepare_for_resize(img))
+        return rgb.convert('RGB') if rgb is img or rgb.mode != 'RGB' else rgb
+
+
+def trial_image(img, size, grayscale):
+    """
+    Изображение для пробного кодирования.
+    
+    Плитки из четырех частей кадра в масштабе результата: деталей на
+    пиксель в них столько же, сколько будет в результате (у уменьшенной
+    копии кадра целиком их больше). Маленький результат кодируется целиком.
+    """
+    if grayscale:
+        img = img.convert('L')
+    
+    if min(size) < 2 * TRIAL_TILE:
+        return img.resize(size, Image.Resampling.BILINEAR) if img.size != size else img
+    
+    # Сторона плитки в пикселях декодированного изображения
+    tile = round(TRIAL_TILE * img.width / size[0])
+    mosaic = Image.new(img.mode, (2 * TRIAL_TILE, 2 * TRIAL_TILE))
+    for index, (fx, fy) in enumerate(((0.25, 0.25), (0.75, 0.25), (0.25, 0.75), (0.75, 0.75))):
+        left = int(img.width * fx) - tile // 2
+        top = int(img.height * fy) - tile // 2
+        piece = img.crop((left, top, left + tile, top + tile))
+        if tile != TRIAL_TILE:
+            piece = piece.resize((TRIAL_TILE, TRIAL_TILE), Image.Resampling.BILINEAR)
+        mosaic.paste(piece, ((index % 2) * TRIAL_TILE, (index // 2) * TRIAL_TILE))
+    return mosaic
+
+
+class BatchEstimate:
+    """
+    Прогноз размера и времени сжатия батча.
+    
+    Категория и настройки - как при сжатии, но по заголовку файла
+    (analyze_image без анализа содержимого). Размер результата - по
+    пробному кодированию небольшого образца: сначала самый дешевый файл
+    каждой группы настроек, затем остальные, пока не истечет
+    TRIAL_BUDGET_SECONDS. У файлов с пробой настройки уточняются анализом
+    содержимого, файлы без пробы используют биты на пиксель своей группы.
+    """
+    
+    def __init__(self, compressor, parallelism=1):
+        self.compressor = compressor
+        self.parallelism = max(1, parallelism)
+        self._trials = {}
+        self._encode_seconds = 0.0
+        self._encode_model_seconds = 0.0
+    
+    def trial_bits_per_pixel(self, trial, settings, quality):
+        """Пробное кодирование в память"""
+        buffer = io.BytesIO()
+        started = time.perf_counter()
+        self.compressor.save_jpeg(trial, buffer, quality, settings['preset'], settings.get('subsampling'))
+        self._encode_seconds += time.perf_counter() - started
+        self._encode_model_seconds += ENCODE_SECONDS_PER_MP[settings['preset']] * trial.width * trial.height / 1e6
+        return buffer.tell() * 8 / (trial.width * trial.height)
+    
+    def group_bits_per_pixel(self, group, quality):
+        """Биты на пиксель для файла без пробы: своя группа, то же качество, любые пробы"""
+        samples = self._trials.get((group, quality))
+        if not samples:
+            samples = [value for (_, q), values in self._trials.items() if q == quality for value in values]
+        if not samples:
+            samples = [value for values in self._trials.values() for value in values]
+        return sum(samples) / len(samples) if samples else DEFAULT_BITS_PER_PIXEL
+    
+    def speed_factor(self):
+        if not self._encode_model_seconds:
+            return 1.0
+        factor = self._encode_seconds / self._encode_model_seconds
+        return min(MAX_SPEED_FACTOR, max(MIN_SPEED_FACTOR, factor))
+    
+    def plan(self, input_path):
+        """Категория, настройки и размер результата одного файла (по заголовку)"""
+        analysis = self.compressor.analyze_image(input_path, content=False)
+        settings = self.compressor.determine_compression_category(analysis)
+        size = output_size(analysis, settings)
+        return {
+            'path': input_path,
+            'analysis': analysis,
+            'settings': settings,
+            'group': (settings['quality'], settings['preset'], settings.get('grayscale', False)),
+            'frames': analysis['frames'] if self.compressor.is_sequence(analysis) else 1,
+            'size': size,
+            'trial': None,
+            'cost': trial_cost(analysis, size),
+        }
+    
+    def trial_order(self, plans):
+        """Порядок проб: по одному файлу на группу настроек, затем остальные"""
+        by_cost = sorted(plans, key=lambda plan: plan['cost'])
+        first, rest, covered = [], [], set()
+        for plan in by_cost:
+            if plan['group'] in covered:
+                rest.append(plan)
+            else:
+                covered.add(plan['group'])
+                first.append(plan)
+        return first + rest
+    
+    def run_trials(self, plans):
+        started = time.perf_counter()
+        for plan in self.trial_order(plans):
+            if time.perf_counter() - started > TRIAL_BUDGET_SECONDS:
+                break
+            try:
+                img = decode_for_trial(plan['path'], plan['size'])
+                
+                # Уже декодированное изображение уточняет настройки
+                plan['analysis'].update(analyze_content(img))
+                plan['settings'] = self.compressor.determine_compression_category(plan['analysis'])
+                plan['size'] = output_size(plan['analysis'], plan['settings'])
+                
+                plan['trial'] = trial_image(img, plan['size'], plan['settings'].get('grayscale'))
+            except Exception as e:
+                print(f"Trial encode for {plan['path'].name} failed: {e}")
+    
+    def estimate_file(self, plan):
+        """Прогноз для файла; повторяет итеративное сжатие и возврат оригинала"""
+        analysis, settings = plan['analysis'], plan['settings']
+        pixels = plan['size'][0] * plan['size'][1] * plan['frames']
+        
+        def estimated_mb(quality):
+            if plan['trial'] is not None:
+                bits_per_pixel = self.trial_bits_per_pixel(plan['trial'], settings, quality)
+                self._trials.setdefault((plan['group'], quality), []).append(bits_per_pixel)
+            else:
+                bits_per_pixel = self.group_bits_per_pixel(plan['group'], quality)
+            return bits_per_pixel * pixels / 8 / (1024 * 1024)
+
+        quality = settings['quality']
+        size_mb = estimated_mb(quality)
+        attempts = 1
+        if settings['aggressive'] and analysis['file_size_mb'] > 5:
+            # Как compress_iteratively: -10 качества до цели, не ниже 30
+            while size_mb > self.compressor.target_max_size_mb and quality > 30 and attempts < 5:
+                quality = max(30, quality - 10)
+                size_mb = estimated_mb(quality)
+                attempts += 1
+        
+        keeps_original = size_mb > analysis['file_size_mb']
+        if keeps_original:
+            size_mb = analysis['file_size_mb']
+        
+        seconds = model_seconds(analysis, settings, plan['size'], plan['frames'])
+        seconds += ENCODE_SECONDS_PER_MP[settings['preset']] * pixels / 1e6 * (attempts - 1)
+        
+        return {
+            'name': plan['path'].name,
+            'category': settings['category'],
+            'description': settings['description'],
+            'quality': quality,
+            'preset': settings['preset'],
+            'width': plan['size'][0],
+            'height': plan['size'][1],
+            'frames': plan['frames'],
+            'original_mb': round(analysis['file_size_mb'], 2),
+            'estimated_mb': round(size_mb, 2),
+            'savings': round((1 - size_mb / analysis['file_size_mb']) * 100, 1) if analysis['file_size_mb'] > 0 else 0,
+            'keeps_original': keeps_original,
+            'trial': plan['trial'] is not None,
+            'model_seconds': seconds,
+        }
+    
+    def run(self, input_paths):
+        started = time.perf_counter()
+        plans = []
+        errors = []
+        for input_path in input_paths:
+            try:
+                plans.append(self.plan(input_path))
+            except Exception as e:
+                errors.append({'name': input_path.name, 'error': str(e)})
+        
+        self.run_trials(plans)
+        
+        # Сначала файлы с пробой - их результаты нужны файлам без пробы
+        estimates = {}
+        for plan in sorted(plans, key=lambda plan: plan['trial'] is None):
+            estimates[plan['path']] = self.estimate_file(plan)
+        files = [estimates[plan['path']] for plan in plans]
+        
+        factor = self.speed_factor()
+        for estimate in files:
+            estimate['estimated_seconds'] = round(estimate.pop('model_seconds') * factor, 3)
+        
+        original_mb = sum(estimate['original_mb'] for estimate in files)
+        estimated_mb = sum(estimate['estimated_mb'] for estimate in files)
+        cpu_seconds = sum(estimate['estimated_seconds'] for estimate in files)
+        
+        return {
+            'files': files,
+            'errors': errors,
+            'total': {
+                'original_mb': round(original_mb, 2),
+                'estimated_mb': round(estimated_mb, 2),
+                'savings': round((1 - estimated_mb / original_mb) * 100, 1) if original_mb > 0 else 0,
+                'cpu_seconds': round(cpu_seconds, 2),
+                'estimated_seconds': round(cpu_seconds / self.parallelism, 2),
+            },
+            'sampled_files': sum(1 for estimate in files if estimate['trial']),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000),
+        }
@@ -0,0 +1,214 @@
+"""
+Сжатие дерева каталогов на сервере, без HTTP и без сессий
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from collections import Counter
+from multiprocessing import Pool
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+
+from compressor.bulk import ALLOWED_EXTENSIONS
+from compressor.compressor_engine import WebCompressor
+from compressor.worker_pool import warm_up
+
+
+MANIFEST_NAME = '.compress_manifest.json'
+
+
+def file_sha1(file_path):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compress_one(task):
+    """Сжать один файл (выполняется в процессе пула)"""
+    src, dst_dir, prefix, compression_settings, with_hash, keep_extension = task
+    src = Path(src)
+    stat = src.stat()
+    
+    compressor = WebCompressor(dst_dir, prefix=prefix, compression_settings=compression_settings, output_path=dst_dir)
+    compressor.keep_source_extension = keep_extension
+    outcome = compressor.compress_file(src)
+    
+    outcome['keep_extension'] = keep_extension
+    outcome['size'] = stat.st_size
+    outcome['mtime_ns'] = stat.st_mtime_ns
+    if with_hash:
+        outcome['sha1'] = file_sha1(src)
+    return str(src), outcome
+
+
+class Command(BaseCommand):
+    help = 'Recompress an image directory tree into a mirrored output tree using all CPU cores'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Source directory')
+        parser.add_argument('destination', help='Output directory (tree structure is mirrored)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--quality', type=int, default=None)
+        parser.add_argument('--max-dimension', type=int, default=None)
+        parser.add_argument('--no-resize', action='store_true')
+        parser.add_argument('--prefix', default='')
+        parser.add_argument('--hash', action='store_true',
+                            help='Store SHA1 in manifest; files with changed mtime but same content are skipped')
+        parser.add_argument('--force', action='store_true', help='Ignore manifest and recompress everything')
+        parser.add_argument('--report-every', type=float, default=5.0, help='Progress report interval, seconds')
+    
+    def handle(self, *args, **options):
+        source = Path(options['source']).resolve()
+        destination = Path(options['destination']).resolve()
+        
+        if not source.is_dir():
+            raise CommandError(f'{source} is not a directory')
+        if destination == source or source in destination.parents:
+            raise CommandError('Destination must not be inside source')
+        
+        destination.mkdir(parents=True, exist_ok=True)
+        manifest_path = destination / MANIFEST_NAME
+        manifest = {} if options['force'] else self.load_manifest(manifest_path)
+        
+        compression_settings = {
+            'quality': options['quality'],
+            'max_dimension': options['max_dimension'],
+            'no_resize': options['no_resize'],
+        }
+        
+        tasks, seen, skipped = self.collect_tasks(source, destination, manifest, compression_settings, options)
+        
+        # Исходники, которых больше нет: удаляем их результаты и записи
+        for rel_path in set(manifest) - seen:
+            for output in self.entry_outputs(manifest.pop(rel_path)):
+                (destination / output).unlink(missing_ok=True)
+        
+        self.stdout.write(f"Found {len(seen)} images: {len(tasks)} to compress, {skipped} up to date")
+        if not tasks:
+            self.save_manifest(manifest_path, manifest)
+            return
+        
+        stats = {'done': 0, 'failed': 0, 'orig_mb': 0.0, 'comp_mb': 0.0}
+        started = last_report = time.monotonic()
+        
+        with Pool(processes=max(1, options['workers']), initializer=warm_up) as pool:
+            for src, outcome in pool.imap_unordered(compress_one, tasks, chunksize=4):
+                rel_path = str(Path(src).relative_to(source))
+                stats['done'] += 1
+                
+                if outcome['success']:
+                    stats['orig_mb'] += outcome['original_mb']
+                    stats['comp_mb'] += outcome['compressed_mb']
+                    manifest[rel_path] = {
+                        'size': outcome['size'],
+                        'mtime_ns': outcome['mtime_ns'],
+                        'sha1': outcome.get('sha1'),
+                        'keep_extension': outcome['keep_extension'],
+                        'output': str(Path(rel_path).parent / outcome['output_name']),
+                        'outputs': [
+                            str(Path(rel_path).parent / name) for name in WebCompressor.output_files(outcome)
+                        ],
+                        'original_mb': round(outcome['original_mb'], 3),
+                        'compressed_mb': round(outcome['compressed_mb'], 3),
+                    }
+                else:
+                    stats['failed'] += 1
+                    manifest.pop(rel_path, None)
+                
+                now = time.monotonic()
+                if now - last_report >= options['report_every']:
+                    last_report = now
+                    self.report(stats, len(tasks), now - started)
+                    self.save_manifest(manifest_path, manifest)
+        
+        self.save_manifest(manifest_path, manifest)
+        self.report(stats, len(tasks), time.monotonic() - started)
+        self.stdout.write(self.style.SUCCESS('Done'))
+    
+    def collect_tasks(self, source, destination, manifest, compression_settings, options):
+        """Файлы для сжатия (с учетом манифеста)"""
+        tasks = []
+        seen = set()
+        skipped = 0
+        
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            images = [name for name in sorted(files) if Path(name).suffix.lower() in ALLOWED_EXTENSIONS]
+            
+            # photo.jpg и photo.png в одном каталоге дали бы один и тот же
+            # photo_compressed.jpg - таким файлам имя дается с расширением
+            stems = Counter(Path(name).stem for name in images)
+            
+            for name in images:
+                src = Path(root) / name
+                keep_extension = stems[src.stem] > 1
+                
+                rel_path = str(src.relative_to(source))
+                seen.add(rel_path)
+                entry = manifest.get(rel_path)
+                
+                if (entry and entry.get('keep_extension', False) == keep_extension
+                        and self.is_up_to_date(src, destination, entry, options['hash'])):
+                    skipped += 1
+                    continue
+                
+                # Имя результата могло измениться (_original <-> _compressed)
+                if entry:
+                    for output in self.entry_outputs(entry):
+                        (destination / output).unlink(missing_ok=True)
+                
+                dst_dir = destination / Path(rel_path).parent
+                tasks.append((str(src), str(dst_dir), options['prefix'], compression_settings, options['hash'], keep_extension))
+        
+        return tasks, seen, skipped
+    
+    def entry_outputs(self, entry):
+        """Выходные файлы записи манифеста (у многостраничных - несколько)"""
+        return entry.get('outputs') or ([entry['output']] if entry.get('output') else [])
+    
+    def is_up_to_date(self, src, destination, entry, with_hash):
+        outputs = self.entry_outputs(entry)
+        if not outputs or not all((destination / output).exists() for output in outputs):
+            return False
+        
+        stat = src.stat()
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        
+        # mtime изменился - сверяем содержимое, если есть хеш
+        if with_hash and entry.get('sha1') and file_sha1(src) == entry['sha1']:
+            entry['mtime_ns'] = stat.st_mtime_ns
+            return True
+        return False
+    
+    def load_manifest(self, manifest_path):
+        if not manifest_path.exists():
+            return {}
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            self.stderr.write(f"Manifest {manifest_path} is corrupted, starting from scratch")
+            return {}
+    
+    def save_manifest(self, manifest_path, manifest):
+        """Атомарная запись манифеста (прерванный запуск не портит его)"""
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    
+    def report(self, stats, total, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        savings = (1 - stats['comp_mb'] / stats['orig_mb']) * 100 if stats['orig_mb'] > 0 else 0
+        self.stdout.write(
+            f"{stats['done']}/{total} files ({stats['failed']} failed) | "
+            f"{stats['done'] / elapsed:.1f} files/s, {stats['orig_mb'] / elapsed:.1f} MB/s | "
+            f"{stats['orig_mb']:.1f} MB -> {stats['comp_mb']:.1f} MB ({savings:.1f}% saved)"
+        )
@@ -0,0 +1,443 @@
+"""
+Нагрузочный тест полного цикла: загрузка -> сжатие -> опрос статуса -> скачивание
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+from PIL import Image, ImageDraw, ImageFilter
+import http.client
+import io
+import json
+import random
+import secrets
+import threading
+import time
+import uuid
+
+from compressor.models import CompressionSession
+from compressor.storage import remove_session_files
+
+
+LOADTEST_USER_PREFIX = 'loadtest_'
+
+# Отметка учетных записей теста (last_name): чужой пользователь с тем же
+# именем не перезаписывается, после теста учетные записи удаляются
+LOADTEST_USER_MARKER = 'loadtest'
+
+# Смесь батчей по умолчанию: ФАЙЛЫxШИРИНАxВЫСОТА[:формат][@вес]
+DEFAULT_BATCHES = ['5x2400x1800:jpeg@3', '20x1280x960:jpeg@1', '3x1920x1080:png@1']
+
+FORMATS = {'jpeg': ('JPEG', '.jpg'), 'png': ('PNG', '.png'), 'webp': ('WEBP', '.webp')}
+
+
+def parse_batch(spec):
+    """'5x2400x1800:jpeg@3' -> {'files': 5, 'size': (2400, 1800), 'format': 'jpeg', 'weight': 3}"""
+    try:
+        spec, _, weight = spec.partition('@')
+        dimensions, _, fmt = spec.partition(':')
+        files, width, height = (int(value) for value in dimensions.lower().split('x'))
+        fmt = fmt.lower() or 'jpeg'
+        if fmt not in FORMATS or files < 1:
+            raise ValueError
+        return {'spec': spec, 'files': files, 'size': (width, height), 'format': fmt, 'weight': float(weight or 1)}
+    except ValueError:
+        raise CommandError(f"Invalid batch spec '{spec}' (expected FILESxWIDTHxHEIGHT[:jpeg|png|webp][@WEIGHT])")
+
+
+def sample_image(size, fmt):
+    """Синтетическое изображение: фото (шум с размытием) или графика (плоские блоки) для png"""
+    if fmt == 'png':
+        img = Image.new('RGB', size, (245, 245, 245))
+        draw = ImageDraw.Draw(img)
+        rng = random.Random(size[0] * size[1])
+        for _ in range(40):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.rectangle((x, y, x + rng.randrange(20, 300), y + rng.randrange(10, 80)), fill=color)
+    else:
+        img = Image.effect_noise(size, 60).convert('RGB').filter(ImageFilter.GaussianBlur(1.5))
+    
+    buffer = io.BytesIO()
+    img.save(buffer, FORMATS[fmt][0], **({'quality': 92} if fmt == 'jpeg' else {}))
+    return buffer.getvalue()
+
+
+def percentile(values, p):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadStats:
+    """Замеры всех виртуальных пользователей (общие для потоков)"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.error_samples = {}
+        self.sessions = []
+        self.failed_sessions = 0
+        self.files = 0
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
+    
+    def request(self, endpoint, seconds, error=None):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+        if error:
+            self.error(endpoint, error)
+    
+    def session(self, seconds, files, uploaded, downloaded):
+        with self._lock:
+            self.sessions.append(seconds)
+            self.files += files
+            self.uploaded_bytes += uploaded
+            self.downloaded_bytes += downloaded
+    
+    def error(self, endpoint, message):
+        """Ошибка без замера времени запроса (например, таймаут сессии)"""
+        with self._lock:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            samples = self.error_samples.setdefault(endpoint, [])
+            if len(samples) < 3 and message not in samples:
+                samples.append(message)
+    
+    def session_failed(self):
+        with self._lock:
+            self.failed_sessions += 1
+
+
+class VirtualUser:
+    """Клиент с собственным соединением и cookies, как браузер одного пользователя"""
+    
+    def __init__(self, host, port, stats, timeout):
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.timeout = timeout
+        self.cookies = {}
+        self.conn = None
+    
+    def request(self, method, path, body=None, headers=None, endpoint=None, sink=False):
+        """HTTP запрос; возвращает (код, тело). sink=True - тело читается и отбрасывается"""
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{name}={value}" for name, value in self.cookies.items())
+        
+        started = time.perf_counter()
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                break
+            except (ConnectionError, http.client.HTTPException) as e:
+                # Сервер мог закрыть keep-alive соединение - одна повторная попытка
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    self.stats.request(endpoint, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+                    raise
+        
+        size = 0
+        if sink:
+            while True:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+            data = b''
+        else:
+            data = response.read()
+        
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        if response.getheader('Connection', '').lower() == 'close' or response.version < 11:
+            self.conn.close()
+            self.conn = None
+        
+        error = None
+        if response.status >= 400:
+            error = f"HTTP {response.status}: {data[:200].decode('utf-8', 'replace')}"
+        if endpoint:
+            self.stats.request(endpoint, time.perf_counter() - started, error)
+        return response.status, data if not sink else size
+    
+    def login(self, username, password):
+        self.request('GET', '/login/')
+        body = urlencode({
+            'username': username,
+            'password': password,
+            'csrfmiddlewaretoken': self.cookies.get('csrftoken', ''),
+        })
+        status, _ = self.request('POST', '/login/', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 302:
+            raise CommandError(f"Login as {username} failed (HTTP {status})")
+    
+    def upload(self, batch, images):
+        boundary = uuid.uuid4().hex
+        parts = []
+        extension = FORMATS[batch['format']][1]
+        for index in range(batch['files']):
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="files"; '
+                f'filename="load_{index:03d}{extension}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode()
+            )
+            parts.append(images[batch['spec']])
+            parts.append(b'\r\n')
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="prefix"\r\n\r\nload\r\n'.encode())
+        parts.append(f'--{boundary}--\r\n'.encode())
+        body = b''.join(parts)
+        
+        status, data = self.request('POST', '/api/upload/', body, {
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'X-CSRFToken': self.cookies.get('csrftoken', ''),
+        }, endpoint='upload')
+        if status != 200:
+            return None, len(body)
+        return json.loads(data)['session_id'], len(body)
+    
+    def run_session(self, batch, images, poll_interval, session_timeout):
+        """Один цикл загрузка -> сжатие -> статус -> скачивание; True при успехе"""
+        started = time.perf_counter()
+        session_id, uploaded = self.upload(batch, images)
+        if session_id is None:
+            return False
+        
+        status, _ = self.request('POST', f'/api/compress/{session_id}/', b'', {
+            'X-CSRFToken': self.cookies.get('csrftoken', ''),
+        }, endpoint='compress')
+        if status != 200:
+            return False
+        
+        deadline = time.monotonic() + session_timeout
+        while True:
+            time.sleep(poll_interval)
+            status, data = self.request('GET', f'/api/status/{session_id}/', endpoint='status')
+            if status == 200:
+                progress = json.loads(data)
+                if progress.get('stage') == 'canceled':
+                    self.stats.error('status', "Session canceled")
+                    return False
+                # Итоги есть и у сессии с ошибкой - исход в их поле status
+                results = progress.get('results')
+                if results is not None:
+                    if results.get('status') != 'completed':
+                        self.stats.error('status', f"Session failed: {results.get('error', results.get('status'))}")
+                        return False
+                    break
+            if time.monotonic() > deadline:
+                self.stats.error('status', f"Session not completed in {session_timeout}s")
+                return False
+        
+        status, downloaded = self.request('GET', f'/api/download/{session_id}/', endpoint='download', sink=True)
+        if status != 200:
+            return False
+        
+        self.stats.session(time.perf_counter() - started, batch['files'], uploaded, downloaded)
+        return True
+
+
+class Command(BaseCommand):
+    help = ('Load-test the upload -> compress -> status -> download flow with N concurrent simulated users '
+            'against an in-process threaded server (requires DEBUG=True) or a running one (--url)')
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5, help='Concurrent simulated users')
+        parser.add_argument('--sessions', type=int, default=3, help='Sessions per user')
+        parser.add_argument('--batch', action='append', dest='batches',
+                            help=f'Batch mix entry FILESxWIDTHxHEIGHT[:jpeg|png|webp][@WEIGHT], repeatable '
+                                 f'(default: {" ".join(DEFAULT_BATCHES)})')
+        parser.add_argument('--ramp-up', type=float, default=2.0, help='Seconds over which users start')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Status polling interval, seconds')
+        parser.add_argument('--session-timeout', type=float, default=600.0)
+        parser.add_argument('--url', default=None,
+                            help='Test a running server (same database) instead of the in-process one')
+        parser.add_argument('--password', default=None,
+                            help='Password of the test accounts (default: random for this run)')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', dest='json_path', default=None, help='Also write the report as JSON')
+        parser.add_argument('--keep', action='store_true', help='Keep the test accounts and their sessions')
+    
+    def handle(self, *args, **options):
+        # Учетные записи и сессии теста пишутся в базу из настроек: без
+        # --url сервер поднимается в этом процессе, и это должна быть
+        # база разработки, а не рабочая
+        if not options['url'] and not settings.DEBUG:
+            raise CommandError(
+                "In-process mode writes test accounts and sessions to the configured database; "
+                "run it with DEBUG=True or point --url at a test server"
+            )
+        
+        batches = [parse_batch(spec) for spec in (options['batches'] or DEFAULT_BATCHES)]
+        rng = random.Random(options['seed'])
+        images = {batch['spec']: sample_image(batch['size'], batch['format']) for batch in batches}
+        
+        password = options['password'] or secrets.token_urlsafe(16)
+        users = [self.ensure_user(index, password) for index in range(options['users'])]
+        
+        server = None
+        if options['url']:
+            parts = urlsplit(options['url'])
+            host, port = parts.hostname, parts.port or 80
+        else:
+            server, host, port = self.start_server()
+            self.stdout.write(f"In-process server on http://{host}:{port}/")
+        
+        stats = LoadStats()
+        plans = [
+            [rng.choices(batches, weights=[batch['weight'] for batch in batches])[0] for _ in range(options['sessions'])]
+            for _ in users
+        ]
+        
+        def user_loop(index, user):
+            time.sleep(options['ramp_up'] * index / max(1, len(users)))
+            client = VirtualUser(host, port, stats, timeout=options['session_timeout'])
+            try:
+                client.login(user.username, password)
+            except Exception as e:
+                self.stderr.write(f"User {user.username} could not log in: {e}")
+                for _ in plans[index]:
+                    stats.session_failed()
+                return
+            
+            for batch in plans[index]:
+                try:
+                    completed = client.run_session(batch, images, options['poll_interval'], options['session_timeout'])
+                except Exception:
+                    # Ошибка соединения уже учтена в статистике запросов
+                    completed = False
+                if not completed:
+                    stats.session_failed()
+        
+        self.stdout.write(
+            f"{len(users)} users x {options['sessions']} sessions, batches: "
+            + ', '.join(f"{batch['spec']} (weight {batch['weight']:g})" for batch in batches)
+        )
+        wall_started = time.perf_counter()
+        threads = [threading.Thread(target=user_loop, args=(index, user), daemon=True) for index, user in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - wall_started
+        
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        
+        report = self.build_report(stats, wall)
+        self.print_report(report)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+        
+        if not options['keep']:
+            self.cleanup(users)
+    
+    def ensure_user(self, index, password):
+        """Учетная запись теста (только отмеченная LOADTEST_USER_MARKER)"""
+        user, created = User.objects.get_or_create(
+            username=f"{LOADTEST_USER_PREFIX}{index}",
+            defaults={'last_name': LOADTEST_USER_MARKER}
+        )
+        if not created and user.last_name != LOADTEST_USER_MARKER:
+            raise CommandError(f"User {user.username} exists and is not a load test account")
+        user.set_password(password)
+        user.save()
+        return user
+    
+    def start_server(self):
+        """Многопоточный WSGI сервер Django в этом процессе на свободном порту"""
+        if '127.0.0.1' not in settings.ALLOWED_HOSTS and '*' not in settings.ALLOWED_HOSTS:
+            settings.ALLOWED_HOSTS.append('127.0.0.1')
+        
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+        server.set_app(get_internal_wsgi_application())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, '127.0.0.1', server.server_address[1]
+    
+    def build_report(self, stats, wall):
+        wall = max(wall, 1e-6)
+        total_requests = sum(len(values) for values in stats.latencies.values())
+        total_errors = sum(stats.errors.values())
+        return {
+            'wall_seconds': round(wall, 2),
+            'sessions_completed': len(stats.sessions),
+            'sessions_failed': stats.failed_sessions,
+            'session_seconds': {
+                'p50': round(percentile(stats.sessions, 50), 2),
+                'p90': round(percentile(stats.sessions, 90), 2),
+                'p99': round(percentile(stats.sessions, 99), 2),
+                'max': round(max(stats.sessions, default=0), 2),
+            },
+            'throughput': {
+                'sessions_per_minute': round(len(stats.sessions) / wall * 60, 2),
+                'files_per_second': round(stats.files / wall, 2),
+                'upload_mb_per_second': round(stats.uploaded_bytes / wall / (1024 * 1024), 2),
+                'download_mb_per_second': round(stats.downloaded_bytes / wall / (1024 * 1024), 2),
+                'requests_per_second': round(total_requests / wall, 2),
+            },
+            'error_rate': round(total_errors / total_requests, 4) if total_requests else 0,
+            'endpoints': {
+                endpoint: {
+                    'requests': len(values),
+                    'errors': stats.errors.get(endpoint, 0),
+                    'p50_ms': round(percentile(values, 50) * 1000, 1),
+                    'p90_ms': round(percentile(values, 90) * 1000, 1),
+                    'p99_ms': round(percentile(values, 99) * 1000, 1),
+                    'max_ms': round(max(values) * 1000, 1),
+                    'error_samples': stats.error_samples.get(endpoint, []),
+                }
+                for endpoint, values in stats.latencies.items()
+            },
+        }
+    
+    def print_report(self, report):
+        self.stdout.write('')
+        self.stdout.write(f"{'endpoint':<10} {'requests':>8} {'errors':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for endpoint, row in report['endpoints'].items():
+            self.stdout.write(
+                f"{endpoint:<10} {row['requests']:>8} {row['errors']:>7} {row['p50_ms']:>9} "
+                f"{row['p90_ms']:>9} {row['p99_ms']:>9} {row['max_ms']:>9}"
+            )
+            for sample in row['error_samples']:
+                self.stdout.write(f"    {sample}")
+        
+        sessions = report['session_seconds']
+        throughput = report['throughput']
+        self.stdout.write('')
+        self.stdout.write(
+            f"Sessions: {report['sessions_completed']} completed, {report['sessions_failed']} failed | "
+            f"end-to-end p50 {sessions['p50']}s, p90 {sessions['p90']}s, p99 {sessions['p99']}s, max {sessions['max']}s"
+        )
+        self.stdout.write(
+            f"Throughput: {throughput['sessions_per_minute']} sessions/min, {throughput['files_per_second']} files/s, "
+            f"{throughput['requests_per_second']} req/s, upload {throughput['upload_mb_per_second']} MB/s, "
+            f"download {throughput['download_mb_per_second']} MB/s"
+        )
+        style = self.style.SUCCESS if not report['error_rate'] and not report['sessions_failed'] else self.style.WARNING
+        self.stdout.write(style(f"Error rate: {report['error_rate'] * 100:.2f}% over {report['wall_seconds']}s"))
+    
+    def cleanup(self, users):
+        """Удалить учетные записи теста и их сессии (записи в БД и файлы)"""
+        sessions = CompressionSession.objects.filter(user__in=users)
+        for session_id in sessions.values_list('session_id', flat=True):
+            remove_session_files(session_id)
+        User.objects.filter(pk__in=[user.pk for user in users], last_name=LOADTEST_USER_MARKER).delete()
+
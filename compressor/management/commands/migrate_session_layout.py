@@ -0,0 +1,67 @@
+"""
+Перенос каталогов сессий в шарды по префиксу UUID и запись манифестов
+"""
+
+from django.core.management.base import BaseCommand
+import uuid
+
+from compressor.manifest import MANIFEST_FILE, scan_manifest, write_manifest
+from compressor.models import CompressionSession
+from compressor.storage import iter_session_dirs, session_roots, shard_path
+
+
+def is_session_id(name):
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+class Command(BaseCommand):
+    help = (
+        'Move flat session directories into UUID-prefix shards and write missing manifests. '
+        'Sessions being compressed are skipped - run again once they finish.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+    
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        roots = set(session_roots())
+        processing = set(CompressionSession.objects.filter(status='processing').values_list('session_id', flat=True))
+        counts = {'moved': 0, 'manifests': 0, 'skipped': 0}
+        
+        # Список заранее: перенос меняет каталоги, которые обходятся
+        for session_dir in list(iter_session_dirs()):
+            session_id = session_dir.name
+            if not is_session_id(session_id):
+                # Недоделанные копии переноса из SCRATCH_ROOT (их удалит
+                # cron) и посторонние каталоги
+                continue
+            if session_id in processing:
+                self.stdout.write(f"Skipped {session_id}: compression in progress")
+                counts['skipped'] += 1
+                continue
+            
+            if not (session_dir / MANIFEST_FILE).exists():
+                if not dry_run:
+                    write_manifest(session_dir, scan_manifest(session_dir))
+                counts['manifests'] += 1
+            
+            if session_dir.parent not in roots:
+                continue
+            target = shard_path(session_dir.parent, session_id)
+            if target.exists():
+                self.stdout.write(self.style.WARNING(f"Skipped {session_id}: {target} already exists"))
+                counts['skipped'] += 1
+                continue
+            if not dry_run:
+                target.parent.mkdir(exist_ok=True)
+                session_dir.rename(target)
+            counts['moved'] += 1
+        
+        prefix = 'Would move' if dry_run else 'Moved'
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {counts['moved']} sessions, manifests written: {counts['manifests']}, skipped: {counts['skipped']}"
+        ))
@@ -0,0 +1,61 @@
+"""
+Манифест сессии: имена загруженных файлов, результатов и архива
+"""
+
+import json
+import os
+
+
+MANIFEST_FILE = 'manifest.json'
+
+# Раздел манифеста -> подкаталог сессии
+ARTIFACT_DIRS = {
+    'uploads': 'uploads',
+    'outputs': 'compressed',
+    'archives': 'archives',
+}
+
+
+def scan_manifest(session_path):
+    """Манифест по содержимому каталогов (сессии, созданные до манифестов)"""
+    manifest = {}
+    for kind, directory in ARTIFACT_DIRS.items():
+        path = session_path / directory
+        pattern = '*.zip' if kind == 'archives' else '*'
+        manifest[kind] = sorted(file.name for file in path.glob(pattern)) if path.exists() else []
+    return manifest
+
+
+def read_manifest(session_path):
+    """
+    Манифест сессии. Представления и сжатие берут пути файлов отсюда, а не
+    обходом каталогов; без manifest.json - по содержимому каталогов.
+    """
+    try:
+        with open(session_path / MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return scan_manifest(session_path)
+
+
+def write_manifest(session_path, manifest):
+    """Записать манифест атомарно (читатели видят старый или новый целиком)"""
+    temp_file = session_path / f'.{MANIFEST_FILE}.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_file, session_path / MANIFEST_FILE)
+
+
+def update_manifest(session_path, **changes):
+    manifest = read_manifest(session_path)
+    manifest.update(changes)
+    write_manifest(session_path, manifest)
+    return manifest
+
+
+def artifact_paths(session_path, kind, manifest=None):
+    """Пути файлов раздела kind (uploads, outputs, archives)"""
+    if manifest is None:
+        manifest = read_manifest(session_path)
+    directory = session_path / ARTIFACT_DIRS[kind]
+    return [directory / name for name in manifest.get(kind, [])]
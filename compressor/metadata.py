@@ -0,0 +1,147 @@
+"""
+Метаданные результата: EXIF, ICC-профиль и объем, сэкономленный их удалением
+"""
+
+from functools import lru_cache
+import io
+
+from PIL import ExifTags, Image, ImageCms
+
+
+# Политики (compression_settings['metadata']):
+#   strip - без метаданных, цвета не переводятся (быстрее всего)
+#   srgb  - не-sRGB профиль переводится в sRGB, метаданные удаляются
+#   icc   - ICC-профиль сохраняется как есть, EXIF удаляется
+#   exif  - ICC-профиль и минимальный EXIF (без миниатюры, GPS, MakerNote)
+METADATA_POLICIES = ('strip', 'srgb', 'icc', 'exif')
+DEFAULT_METADATA_POLICY = 'srgb'
+
+# Теги минимального EXIF: камера, дата съемки, автор. Orientation не
+# нужен - кадр уже повернут
+MINIMAL_IFD0_TAGS = (
+    ExifTags.Base.Make,
+    ExifTags.Base.Model,
+    ExifTags.Base.DateTime,
+    ExifTags.Base.Artist,
+    ExifTags.Base.Copyright,
+)
+MINIMAL_EXIF_IFD_TAGS = (
+    ExifTags.Base.DateTimeOriginal,
+    ExifTags.Base.OffsetTimeOriginal,
+)
+
+# Служебные сегменты JPEG, которые не считаются метаданными
+JPEG_STRUCTURAL_MARKERS = ('APP0', 'APP14')
+
+# Ключи Image.info с метаданными (XMP у PNG - XML:com.adobe.xmp)
+METADATA_KEYS = ('icc_profile', 'exif', 'xmp', 'XML:com.adobe.xmp')
+
+# Цветовое пространство профиля для режима результата
+PROFILE_COLOR_SPACES = {'RGB': 'RGB ', 'RGBA': 'RGB ', 'L': 'GRAY'}
+
+_srgb_profile = None
+
+
+def srgb_profile():
+    """Встроенный профиль sRGB (создается один раз)"""
+    global _srgb_profile
+    if _srgb_profile is None:
+        _srgb_profile = ImageCms.createProfile('sRGB')
+    return _srgb_profile
+
+
+def source_bytes(img):
+    """
+    Объем метаданных исходного файла по уже прочитанному заголовку: у JPEG -
+    сегменты APPn и COM (кроме JFIF и Adobe), у остальных - ICC, EXIF, XMP
+    и текстовые блоки PNG.
+    """
+    applist = getattr(img, 'applist', None)
+    if applist is not None:
+        # 4 байта - маркер и длина сегмента
+        return sum(len(data) + 4 for marker, data in applist if marker not in JPEG_STRUCTURAL_MARKERS)
+    
+    total = sum(len(img.info[key]) for key in METADATA_KEYS if isinstance(img.info.get(key), (bytes, str)))
+    if img.format == 'PNG':
+        # Текстовые блоки tEXt/zTXt/iTXt
+        total += sum(len(value) for key, value in img.info.items() if isinstance(value, str) and key not in METADATA_KEYS)
+    return total
+
+
+def read_source(img):
+    """Метаданные кадра до преобразований (после них info и теги TIFF теряются)"""
+    return {
+        'icc_profile': img.info.get('icc_profile'),
+        'exif': img.getexif(),
+        'bytes': source_bytes(img),
+    }
+
+
+@lru_cache(maxsize=16)
+def profile_info(icc_profile):
+    """(цветовое пространство, это sRGB) встроенного профиля"""
+    profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+    description = ImageCms.getProfileDescription(profile) or ''
+    return profile.profile.xcolor_space, 'srgb' in description.lower()
+
+
+@lru_cache(maxsize=16)
+def srgb_transform(icc_profile):
+    """Преобразование RGB-профиля в sRGB (строится один раз на профиль)"""
+    profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+    return ImageCms.buildTransform(profile, srgb_profile(), 'RGB', 'RGB', renderingIntent=ImageCms.Intent.PERCEPTUAL)
+
+
+def to_srgb(img, source):
+    """
+    Перевести RGB-кадр в sRGB по встроенному профилю (политика srgb).
+    Делается над уже уменьшенным кадром, без повторного декодирования.
+    """
+    icc_profile = source['icc_profile']
+    if not icc_profile or img.mode != 'RGB':
+        return img
+    try:
+        color_space, is_srgb = profile_info(icc_profile)
+        if color_space != 'RGB ' or is_srgb:
+            return img
+        return ImageCms.applyTransform(img, srgb_transform(icc_profile))
+    except (ImageCms.PyCMSError, OSError) as e:
+        print(f"sRGB conversion failed, keeping original colours: {e}")
+        return img
+
+
+def minimal_exif(exif):
+    """Минимальный EXIF (bytes) или None, если нужных тегов нет"""
+    result = Image.Exif()
+    for tag in MINIMAL_IFD0_TAGS:
+        if tag in exif:
+            result[tag] = exif[tag]
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    minimal_ifd = {tag: exif_ifd[tag] for tag in MINIMAL_EXIF_IFD_TAGS if tag in exif_ifd}
+    if minimal_ifd:
+        result[ExifTags.IFD.Exif] = minimal_ifd
+    return result.tobytes() if len(result) else None
+
+
+def save_params(img, source, policy):
+    """
+    Метаданные для записи результата: параметры save() и объем, на
+    который они меньше метаданных исходника.
+    """
+    params = {}
+    if policy in ('icc', 'exif') and source['icc_profile']:
+        try:
+            color_space, _ = profile_info(source['icc_profile'])
+        except (ImageCms.PyCMSError, OSError):
+            color_space = None
+        # Профиль другого пространства (CMYK после перевода, RGB у ч/б)
+        # к результату не подходит
+        if color_space == PROFILE_COLOR_SPACES.get(img.mode):
+            params['icc_profile'] = source['icc_profile']
+    if policy == 'exif':
+        exif = minimal_exif(source['exif'])
+        if exif:
+            params['exif'] = exif
+    
+    kept = sum(len(value) + 4 for value in params.values())
+    return params, max(0, source['bytes'] - kept)
@@ -0,0 +1,99 @@
+"""
+Метрики сервиса в формате Prometheus.
+
+При заданном PROMETHEUS_MULTIPROC_DIR значения пишутся в mmap-файлы
+каждого процесса, а /metrics собирает их со всех worker'ов gunicorn.
+Запись метрики - это запись в разделяемую память, без блокировок
+между процессами, поэтому ее можно делать в горячем пути.
+"""
+
+import os
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client import multiprocess
+
+
+FILES = Counter(
+    'compressor_files_total', 'Processed files', ['result']
+)
+INPUT_BYTES = Counter(
+    'compressor_input_bytes_total', 'Bytes of original images processed'
+)
+OUTPUT_BYTES = Counter(
+    'compressor_output_bytes_total', 'Bytes of compressed output produced'
+)
+ENCODE_SECONDS = Histogram(
+    'compressor_encode_seconds', 'Encode time per file', ['category'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    'compressor_queue_wait_seconds', 'Time waiting for a compression slot',
+    buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)
+)
+ITERATIVE_RETRIES = Counter(
+    'compressor_iterative_retries_total', 'Extra encodes made by iterative compression'
+)
+ORIGINAL_FALLBACKS = Counter(
+    'compressor_original_fallback_total', 'Outputs replaced by the original (compressed was larger)'
+)
+ARCHIVE_SECONDS = Histogram(
+    'compressor_archive_build_seconds', 'Archive build time per session (streamed: excluding client reads)',
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60)
+)
+SESSIONS_FINISHED = Counter(
+    'compressor_sessions_finished_total', 'Sessions finished by final status', ['status']
+)
+STORAGE_EVICTIONS = Counter(
+    'compressor_storage_evictions_total', 'Sessions whose files were evicted to free disk space', ['status']
+)
+COMPRESSION_SLOTS = Gauge(
+    'compressor_compression_slots', 'Concurrent compression slots chosen by the autoscaler',
+    multiprocess_mode='livesum'
+)
+AUTOSCALE_CHANGES = Counter(
+    'compressor_autoscale_changes_total', 'Slot count changes made by the autoscaler', ['reason']
+)
+
+
+class SessionStatusCollector:
+    """Текущее число сессий по статусам (считается из БД при опросе)"""
+    
+    def collect(self):
+        from django.db.models import Count
+        from .models import CompressionSession
+        
+        gauge = GaugeMetricFamily('compressor_sessions', 'Sessions by status', labels=['status'])
+        rows = CompressionSession.objects.values('status').annotate(count=Count('id'))
+        for row in rows:
+            gauge.add_metric([row['status']], row['count'])
+        yield gauge
+        
+        from .storage import tracked_bytes
+        yield GaugeMetricFamily('compressor_storage_bytes', 'Bytes of session files on disk', value=tracked_bytes())
+
+
+def record_file(original_bytes, output_bytes):
+    """Учесть успешно сжатый файл"""
+    FILES.labels(result='success').inc()
+    INPUT_BYTES.inc(original_bytes)
+    OUTPUT_BYTES.inc(output_bytes)
+
+
+def render():
+    """Текст метрик для ответа /metrics: (body, content_type)"""
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        from prometheus_client import REGISTRY
+        registry = REGISTRY
+    
+    body = generate_latest(registry) + generate_latest(_db_registry)
+    return body, CONTENT_TYPE_LATEST
+
+
+_db_registry = CollectorRegistry()
+_db_registry.register(SessionStatusCollector())
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionsession',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='compressionsession',
+            name='resume_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
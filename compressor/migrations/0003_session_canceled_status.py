@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0002_session_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='compressionsession',
+            name='status',
+            field=models.CharField(choices=[('uploaded', 'Uploaded'), ('processing', 'Processing'), ('completed', 'Completed'), ('error', 'Error'), ('downloaded', 'Downloaded'), ('canceled', 'Canceled')], default='uploaded', max_length=20),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:11
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0003_session_canceled_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionsession',
+            name='profiling',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ProfilingTarget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('note', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='profiling_target', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0004_session_profiling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionfile',
+            name='preset',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0005_file_encoder_preset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionsession',
+            name='evicted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='compressionsession',
+            name='storage_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
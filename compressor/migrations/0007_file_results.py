@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0006_session_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionfile',
+            name='error',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='compressionfile',
+            name='success',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='compressionfile',
+            index=models.Index(fields=['session', 'category'], name='compressor__session_0809ee_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='compressionfile',
+            index=models.Index(fields=['session', 'savings_percent'], name='compressor__session_6bc74f_idx'),
+        ),
+    ]
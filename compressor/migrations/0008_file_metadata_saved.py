@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0007_file_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionfile',
+            name='metadata_saved_bytes',
+            field=models.IntegerField(default=0),
+        ),
+    ]
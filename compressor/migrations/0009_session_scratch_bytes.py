@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0008_file_metadata_saved'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressionsession',
+            name='scratch_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
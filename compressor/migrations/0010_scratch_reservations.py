@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:38
+
+from django.db import migrations, models
+
+
+def create_lock_row(apps, schema_editor):
+    apps.get_model('compressor', 'ScratchLock').objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compressor', '0009_session_scratch_bytes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScratchLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScratchReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.CharField(max_length=64, unique=True)),
+                ('reserved_bytes', models.BigIntegerField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_lock_row, migrations.RunPython.noop),
+    ]
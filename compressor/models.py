@@ -16,6 +16,7 @@ class CompressionSession(models.Model):
         ('completed', 'Completed'),
         ('error', 'Error'),
         ('downloaded', 'Downloaded'),
+        ('canceled', 'Canceled'),
     ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='compression_sessions')
@@ -45,6 +46,20 @@ class CompressionSession(models.Model):
     completed_at = models.DateTimeField(null=True, blank=True)
     downloaded_at = models.DateTimeField(null=True, blank=True)
     
+    # Liveness фоновой обработки
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    resume_count = models.IntegerField(default=0)
+    
+    # Профилирование сжатия (cProfile + tracemalloc, отчеты в папке сессии)
+    profiling = models.BooleanField(default=False)
+    
+    # Временные файлы: объем на диске и когда удалены при нехватке места
+    storage_bytes = models.BigIntegerField(default=0)
+    # Сколько занято из бюджета SCRATCH_ROOT (0 - сессия на диске): до
+    # завершения сжатия - с запасом на рост, после - фактический объем
+    scratch_bytes = models.BigIntegerField(default=0)
+    evicted_at = models.DateTimeField(null=True, blank=True)
+    
     # Ошибки
     error_message = models.TextField(blank=True, default='')
     
@@ -61,7 +76,14 @@ class CompressionSession(models.Model):
         if self.status == 'completed':
             self.status = 'downloaded'
             self.downloaded_at = timezone.now()
-            self.save()
+            self.save(update_fields=['status', 'downloaded_at'])
+    
+    async def amark_as_downloaded(self):
+        """Отметить как скачанное (async)"""
+        if self.status == 'completed':
+            self.status = 'downloaded'
+            self.downloaded_at = timezone.now()
+            await self.asave(update_fields=['status', 'downloaded_at'])
     
     def get_duration(self):
         """Время обработки в секундах"""
@@ -83,9 +105,54 @@ class CompressionFile(models.Model):
     savings_percent = models.FloatField()
     
     category = models.CharField(max_length=50, blank=True, default='')
+    preset = models.CharField(max_length=20, blank=True, default='')
+    # Сколько байт метаданных исходника не попало в результат
+    metadata_saved_bytes = models.IntegerField(default=0)
+    
+    # Необработанные файлы: ошибка сжатия или пропущенные записи архива
+    success = models.BooleanField(default=True)
+    error = models.CharField(max_length=255, blank=True, default='')
     
     class Meta:
         ordering = ['original_name']
+        indexes = [
+            models.Index(fields=['session', 'category']),
+            models.Index(fields=['session', 'savings_percent']),
+        ]
     
     def __str__(self):
-        return f"{self.original_name} -> {self.output_name}"
\ No newline at end of file
+        return f"{self.original_name} -> {self.output_name}"
+
+
+class ProfilingTarget(models.Model):
+    """Пользователь, все сессии которого сжимаются с профилированием"""
+    
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profiling_target')
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f"Profiling: {self.user.username}"
+
+
+class ScratchReservation(models.Model):
+    """
+    Место в бюджете SCRATCH_ROOT под сессию, у которой еще нет записи в БД
+    (идет загрузка). Снимается record_usage или по истечении expires_at
+    (загрузка прервалась).
+    """
+    
+    session_id = models.CharField(max_length=64, unique=True)
+    reserved_bytes = models.BigIntegerField()
+    expires_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"{self.session_id}: {self.reserved_bytes} bytes"
+
+
+class ScratchLock(models.Model):
+    """
+    Единственная строка (pk=1), которую блокирует select_for_update на время
+    проверки и изменения бюджета SCRATCH_ROOT - общая блокировка для всех
+    процессов сервера
+    """
@@ -0,0 +1,139 @@
+"""
+Приведение декодированного кадра к RGB/L для кодирования в JPEG
+"""
+
+import io
+
+import numpy as np
+from PIL import ExifTags, Image, ImageCms
+
+from .metadata import srgb_profile
+
+
+# Полоса строк, обрабатываемая за раз при переводе 16 бит в 8: временные
+# массивы NumPy не больше STRIP_ROWS строк
+STRIP_ROWS = 256
+
+# Сдвиг до 8 бит по разрядности контейнера: 16 бит без знака, I - 32 бита
+# со знаком (отрицательные значения - черный)
+DEPTH_SHIFTS = {'I;16': 8, 'I;16B': 8, 'I;16L': 8, 'I;16N': 8, 'I': 23}
+
+# Фон, на который накладываются полупрозрачные пиксели
+BACKGROUND = 255
+
+# Режимы, которые уменьшаются как есть; CMYK переводится в RGB уже после
+# уменьшения. Альфа накладывается до: одно наложение по маске плюс
+# уменьшение трех каналов быстрее уменьшения RGBA с предумножением альфы
+RESIZABLE_MODES = ('RGB', 'L', 'CMYK')
+
+# Поворот по EXIF Orientation (как ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def orientation_transpose(img):
+    """
+    Поворот по EXIF. Читается до уменьшения (у копии нет тегов TIFF) и
+    после загрузки: TIFF Pillow поворачивает сам при декодировании и
+    убирает тег.
+    """
+    img.load()
+    return ORIENTATION_TRANSPOSE.get(img.getexif().get(ExifTags.Base.Orientation, 1))
+
+
+def strips(img):
+    """Полосы изображения по STRIP_ROWS строк: (верхняя строка, массив NumPy)"""
+    for top in range(0, img.height, STRIP_ROWS):
+        box = (0, top, img.width, min(img.height, top + STRIP_ROWS))
+        yield top, np.asarray(img.crop(box))
+
+
+def reduce_depth(img):
+    """
+    16/32-битное ч/б изображение в 8 бит по разрядности контейнера.
+    
+    convert('L') обрезал бы все выше 255 до белого, а масштаб по максимуму
+    самого изображения осветлял бы темные снимки: 1000 из 65535 остается
+    почти черным.
+    """
+    shift = DEPTH_SHIFTS.get(img.mode, 8)
+    result = Image.new('L', img.size)
+    for top, pixels in strips(img):
+        result.paste(Image.fromarray((np.clip(pixels, 0, None) >> shift).astype(np.uint8)), (0, top))
+    return result
+
+
+def reduce_float(img):
+    """
+    Float-изображение (F) в 8 бит: данные в 0..1 растягиваются до 0..255,
+    остальные обрезаются до 0..255, как у convert('L')
+    """
+    scale = 255 if img.getextrema()[1] <= 1.0 else 1
+    result = Image.new('L', img.size)
+    for top, pixels in strips(img):
+        result.paste(Image.fromarray(np.clip(np.rint(pixels * scale), 0, 255).astype(np.uint8)), (0, top))
+    return result
+
+
+def flatten_alpha(img):
+    """RGBA/LA -> RGB/L на белом фоне: одно наложение по маске альфы"""
+    color_mode = 'L' if img.mode == 'LA' else 'RGB'
+    alpha = img.getchannel('A')
+    if alpha.getextrema()[0] == 255:
+        # Альфа-канал есть, но прозрачных пикселей нет
+        return img.convert(color_mode)
+    result = Image.new(color_mode, img.size, BACKGROUND if color_mode == 'L' else (BACKGROUND,) * 3)
+    result.paste(img, mask=alpha)
+    return result
+
+
+def cmyk_to_rgb(img):
+    """CMYK -> sRGB по встроенному ICC-профилю (без профиля - формула Pillow)"""
+    icc_profile = img.info.get('icc_profile')
+    if icc_profile:
+        try:
+            return ImageCms.profileToProfile(
+                img, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)), srgb_profile(),
+                renderingIntent=ImageCms.Intent.PERCEPTUAL, outputMode='RGB'
+            )
+        except (ImageCms.PyCMSError, OSError) as e:
+            print(f"ICC conversion failed, using plain CMYK conversion: {e}")
+    return img.convert('RGB')
+
+
+def prepare_for_resize(img):
+    """
+    Режим, в котором кадр уменьшается с фильтром: RGB, L или CMYK.
+    
+    Альфа - на белый фон, палитра (resize уменьшает ее только ближайшим
+    соседом), 1 бит и 16/32 бита переводятся сразу.
+    """
+    if img.mode in RESIZABLE_MODES:
+        return img
+    if img.mode in ('RGBA', 'LA'):
+        return flatten_alpha(img)
+    if img.mode in ('P', 'PA'):
+        has_alpha = img.mode == 'PA' or 'transparency' in img.info
+        return flatten_alpha(img.convert('RGBA')) if has_alpha else img.convert('RGB')
+    if img.mode == '1':
+        return img.convert('L')
+    if img.mode.startswith('I'):
+        return reduce_depth(img)
+    if img.mode == 'F':
+        return reduce_float(img)
+    return img.convert('RGB')
+
+
+def to_output_mode(img):
+    """Перевод в RGB или L (CMYK - уже после уменьшения, по ICC-профилю)"""
+    img = prepare_for_resize(img)
+    if img.mode == 'CMYK':
+        return cmyk_to_rgb(img)
+    return img
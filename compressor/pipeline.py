@@ -0,0 +1,176 @@
+"""
+Конвейер этапов обработки, связанных ограниченными очередями
+"""
+
+import queue
+import threading
+import time
+
+
+# Сигнал конца потока элементов между этапами
+_END = object()
+
+# Период проверки флага остановки при ожидании очереди
+_POLL_SECONDS = 0.2
+
+
+class PipelineStopped(Exception):
+    """Конвейер остановлен (ошибка в одном из этапов)"""
+
+
+class Stage:
+    """Этап конвейера: функция элемент -> элемент и число потоков"""
+    
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.busy_seconds = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+    
+    def run(self, item):
+        started = time.monotonic()
+        try:
+            return self.func(item)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.busy_seconds += elapsed
+                self.items += 1
+
+
+class Pipeline:
+    """
+    Конвейер: каждый этап в своих потоках, между этапами очереди
+    ограниченного размера.
+    
+    Размер очереди ограничивает число элементов "в пути" между этапами -
+    например, сколько декодированных изображений ждут кодирования.
+    Ошибка любого этапа останавливает весь конвейер и пробрасывается
+    в поток, который читает результаты. on_thread_start и on_thread_exit
+    вызываются в каждом потоке конвейера при его запуске и перед завершением.
+    """
+    
+    def __init__(self, stages, queue_size=2, on_thread_exit=None, on_thread_start=None):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.on_thread_exit = on_thread_exit
+        self.on_thread_start = on_thread_start
+        self.wall_seconds = 0.0
+        self._stop = threading.Event()
+        self._error = None
+    
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+        raise PipelineStopped()
+    
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        raise PipelineStopped()
+    
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+    
+    def _thread_started(self):
+        if self.on_thread_start:
+            self.on_thread_start()
+    
+    def _thread_exiting(self):
+        # Например, закрыть соединения с БД, открытые в этом потоке
+        if self.on_thread_exit:
+            self.on_thread_exit()
+    
+    def _feed(self, items, out_q):
+        self._thread_started()
+        try:
+            for item in items:
+                self._put(out_q, item)
+            self._put(out_q, _END)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._thread_exiting()
+    
+    def _work(self, stage, in_q, out_q, finished):
+        self._thread_started()
+        try:
+            while True:
+                item = self._get(in_q)
+                if item is _END:
+                    # Возвращаем сигнал для остальных потоков этапа;
+                    # последний завершившийся передает его дальше
+                    self._put(in_q, _END)
+                    with finished['lock']:
+                        finished['count'] += 1
+                        last = finished['count'] == stage.workers
+                    if last:
+                        self._put(out_q, _END)
+                    return
+                self._put(out_q, stage.run(item))
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._thread_exiting()
+    
+    def run(self, items):
+        """Прогнать элементы через все этапы; результаты в порядке готовности"""
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        
+        for idx, stage in enumerate(self.stages):
+            finished = {'count': 0, 'lock': threading.Lock()}
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[idx], queues[idx + 1], finished),
+                    daemon=True
+                ))
+        
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        
+        try:
+            while True:
+                try:
+                    item = self._get(queues[-1])
+                except PipelineStopped:
+                    raise self._error
+                if item is _END:
+                    break
+                yield item
+        finally:
+            # Сюда попадаем и при ошибке у потребителя результатов
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall_seconds = time.monotonic() - started
+    
+    def utilization(self):
+        """Загрузка этапов: доля времени, когда потоки этапа были заняты"""
+        wall = max(self.wall_seconds, 1e-6)
+        return {
+            stage.name: {
+                'workers': stage.workers,
+                'items': stage.items,
+                'busy_seconds': round(stage.busy_seconds, 2),
+                'utilization': round(stage.busy_seconds / (wall * stage.workers), 2),
+            }
+            for stage in self.stages
+        }
@@ -0,0 +1,112 @@
+"""
+Профилирование сжатия отдельных сессий (включается в админке)
+"""
+
+import cProfile
+import io
+import pstats
+import threading
+import tracemalloc
+
+from .models import ProfilingTarget
+
+
+# Отчеты, которые пишутся в папку сессии рядом с results.json
+PROFILE_FILES = ('profile.prof', 'profile.txt', 'allocations.txt')
+
+# Сколько строк в текстовых отчетах
+TOP_ENTRIES = 40
+
+# tracemalloc глобален для процесса - одновременно профилируется одна сессия
+_tracing_lock = threading.Lock()
+
+
+def is_enabled(db_session):
+    """Включено ли профилирование для сессии (флаг сессии или пользователя)"""
+    if db_session.profiling:
+        return True
+    return ProfilingTarget.objects.filter(user_id=db_session.user_id).exists()
+
+
+class BatchProfiler:
+    """
+    cProfile и tracemalloc на время сжатия батча.
+    
+    cProfile видит только свой поток, поэтому у каждого потока конвейера
+    свой профиль (thread_start/thread_exit), при сохранении они
+    объединяются. Если другая сессия процесса уже профилируется, батч
+    сжимается без профилирования.
+    """
+    
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.active = False
+        self._profiles = []
+        self._profiles_lock = threading.Lock()
+        self._local = threading.local()
+        self._start_snapshot = None
+    
+    def thread_start(self):
+        if not self.active:
+            return
+        profile = cProfile.Profile()
+        self._local.profile = profile
+        with self._profiles_lock:
+            self._profiles.append(profile)
+        profile.enable()
+    
+    def thread_exit(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.disable()
+            self._local.profile = None
+    
+    def __enter__(self):
+        self.active = _tracing_lock.acquire(blocking=False)
+        if not self.active:
+            print(f"Profiling skipped for {self.output_path.name}: another session is being profiled")
+            return self
+        
+        tracemalloc.start()
+        self._start_snapshot = tracemalloc.take_snapshot()
+        self.thread_start()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if not self.active:
+            return False
+        
+        self.thread_exit()
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            self.active = False
+            _tracing_lock.release()
+        
+        # После отмены папки сессии уже нет - отчеты некуда сохранить
+        if self.output_path.exists():
+            self.save(snapshot, current, peak)
+        return False
+    
+    def save(self, snapshot, current, peak):
+        stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(self.output_path / 'profile.prof')
+        
+        text = io.StringIO()
+        pstats.Stats(*self._profiles, stream=text).sort_stats('cumulative').print_stats(TOP_ENTRIES)
+        with open(self.output_path / 'profile.txt', 'w') as f:
+            f.write(text.getvalue())
+        
+        with open(self.output_path / 'allocations.txt', 'w') as f:
+            f.write(f"Peak traced memory: {peak / (1024*1024):.1f} MB\n")
+            f.write(f"Still allocated at the end: {current / (1024*1024):.1f} MB\n\n")
+            
+            f.write(f"Top {TOP_ENTRIES} allocation sites at the end of the batch:\n")
+            for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]:
+                f.write(f"{stat}\n")
+            
+            f.write(f"\nTop {TOP_ENTRIES} growth since the start of the batch:\n")
+            for stat in snapshot.compare_to(self._start_snapshot, 'lineno')[:TOP_ENTRIES]:
+                f.write(f"{stat}\n")
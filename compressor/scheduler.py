@@ -0,0 +1,221 @@
+"""
+Справедливое распределение CPU между сессиями сжатия
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+
+# Как часто ожидающая сессия получает on_wait (heartbeat, проверка отмены)
+WAIT_TICK_SECONDS = 2.0
+
+
+class FairScheduler:
+    """
+    Слоты сжатия, выдаваемые пофайлово.
+    
+    Каждая сессия берет слот на время сжатия одного файла. Освободившийся
+    слот получает ожидающая сессия, которая обслужила меньше всего файлов
+    (round-robin между активными сессиями); при равенстве - маленький батч,
+    затем более ранняя. Новые и маленькие батчи поэтому не ждут окончания
+    чужих больших. У одного пользователя одновременно не больше
+    per_user_limit слотов.
+    
+    Конвейер берет слот на декодирование и отдельно на кодирование файла,
+    чтобы файл в очереди между этапами не держал слот. Кодирование
+    (finishing=True) не считается новым файлом и идет вне очереди: уже
+    декодированное изображение не ждет в памяти чужих файлов.
+    
+    Расписание и лимиты - в пределах процесса: при N процессах (gunicorn
+    workers) у пользователя может быть до N x per_user_limit слотов.
+    
+    Число слотов меняется на ходу (set_slots, см. autoscale); take_window
+    отдает статистику сжатых файлов с прошлого вызова.
+    """
+    
+    def __init__(self, slots, per_user_limit, small_batch_files):
+        self.slots = slots
+        self.per_user_limit = per_user_limit
+        self.small_batch_files = small_batch_files
+        
+        self._cond = threading.Condition()
+        self._sessions = {}
+        self._active = 0
+        self._user_active = defaultdict(int)
+        self._order = itertools.count()
+        self._avg_file_seconds = 2.0
+        self._window = {'files': 0, 'busy_seconds': 0.0, 'saturated': False}
+    
+    def register(self, session_id, user_id, total_files):
+        """Добавить сессию в расписание"""
+        with self._cond:
+            self._sessions[session_id] = {
+                'user_id': user_id,
+                'total': total_files,
+                'served': 0,
+                'waiting': 0,
+                'finishing': 0,
+                'order': next(self._order),
+            }
+    
+    def unregister(self, session_id):
+        with self._cond:
+            self._sessions.pop(session_id, None)
+            self._cond.notify_all()
+    
+    def _priority(self, state):
+        is_large = state['total'] > self.small_batch_files
+        return (not state['finishing'], state['served'], is_large, state['order'])
+    
+    def _waiting(self):
+        """Ожидающие сессии в порядке очереди"""
+        waiting = [(sid, st) for sid, st in self._sessions.items() if st['waiting'] > 0]
+        waiting.sort(key=lambda item: self._priority(item[1]))
+        return waiting
+    
+    def _next_session(self):
+        """Сессия, которая получит следующий свободный слот"""
+        if self._active >= self.slots:
+            return None
+        for session_id, state in self._waiting():
+            if self._user_active[state['user_id']] < self.per_user_limit:
+                return session_id
+        return None
+    
+    @contextmanager
+    def slot(self, session_id, on_wait=None, finishing=False):
+        """
+        Занять слот на время сжатия одного файла.
+        
+        finishing=True - завершение уже начатого файла (кодирование после
+        декодирования): не считается обслуженным файлом и выдается раньше
+        новых. Пока слот не выдан, on_wait вызывается сразу и затем каждые
+        WAIT_TICK_SECONDS; исключение из on_wait снимает сессию с ожидания.
+        """
+        wait_started = time.monotonic()
+        with self._cond:
+            state = self._sessions[session_id]
+            # Слот могут ждать несколько потоков одной сессии (этапы конвейера)
+            state['waiting'] += 1
+            if finishing:
+                state['finishing'] += 1
+            try:
+                ticked = False
+                # Внутри сессии слот тоже сначала получает завершение файла
+                while self._next_session() != session_id or (state['finishing'] and not finishing):
+                    if self._active >= self.slots:
+                        self._window['saturated'] = True
+                    if on_wait:
+                        if ticked:
+                            self._cond.wait(WAIT_TICK_SECONDS)
+                        ticked = True
+                        # on_wait пишет в БД и на диск - не держим блокировку
+                        self._cond.release()
+                        try:
+                            on_wait()
+                        finally:
+                            self._cond.acquire()
+                    else:
+                        self._cond.wait()
+            finally:
+                state['waiting'] -= 1
+                if finishing:
+                    state['finishing'] -= 1
+            
+            if not finishing:
+                state['served'] += 1
+            self._active += 1
+            self._user_active[state['user_id']] += 1
+        
+        started = time.monotonic()
+        metrics.QUEUE_WAIT_SECONDS.observe(started - wait_started)
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._user_active[state['user_id']] -= 1
+                self._avg_file_seconds = 0.8 * self._avg_file_seconds + 0.2 * elapsed
+                self._window['files'] += 1
+                self._window['busy_seconds'] += elapsed
+                self._cond.notify_all()
+    
+    def set_slots(self, slots):
+        """
+        Изменить число слотов. Уже занятые слоты не отзываются: при
+        уменьшении новые файлы ждут, пока занятых не станет меньше.
+        """
+        with self._cond:
+            self.slots = slots
+            self._cond.notify_all()
+        metrics.COMPRESSION_SLOTS.set(slots)
+    
+    def take_window(self):
+        """
+        Статистика с прошлого вызова: сжато файлов, суммарное время их
+        сжатия и были ли ожидающие при занятых слотах (спрос больше слотов).
+        """
+        with self._cond:
+            window = self._window
+            if self._active >= self.slots and any(state['waiting'] for state in self._sessions.values()):
+                window['saturated'] = True
+            self._window = {'files': 0, 'busy_seconds': 0.0, 'saturated': False}
+            return window
+    
+    def queue_info(self, session_id):
+        """Позиция сессии в очереди и оценка ожидания слота"""
+        with self._cond:
+            if session_id not in self._sessions:
+                return None
+            
+            waiting_ids = [sid for sid, _ in self._waiting()]
+            position = waiting_ids.index(session_id) if session_id in waiting_ids else 0
+            busy = self._active >= self.slots
+            if busy or position:
+                estimated_wait = self._avg_file_seconds * (position + 1) / self.slots
+            else:
+                estimated_wait = 0
+            
+            return {
+                'position': position,
+                'waiting_sessions': len(waiting_ids),
+                'active_slots': self._active,
+                'slots': self.slots,
+                'estimated_wait_seconds': round(estimated_wait, 1),
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Планировщик процесса (создается при первом обращении)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler(
+                slots=settings.COMPRESSION_SLOTS,
+                per_user_limit=settings.COMPRESSION_SLOTS_PER_USER,
+                small_batch_files=settings.SMALL_BATCH_FILES,
+            )
+            metrics.COMPRESSION_SLOTS.set(_scheduler.slots)
+            if settings.COMPRESSION_AUTOSCALE:
+                from .autoscale import SlotController
+                SlotController(
+                    _scheduler,
+                    min_slots=settings.COMPRESSION_MIN_SLOTS,
+                    max_slots=settings.COMPRESSION_MAX_SLOTS,
+                    interval=settings.AUTOSCALE_INTERVAL,
+                    cpu_target=settings.AUTOSCALE_CPU_TARGET,
+                    min_available_memory=settings.AUTOSCALE_MIN_AVAILABLE_MEMORY,
+                ).start()
+        return _scheduler
@@ -366,6 +366,9 @@ function monitorProgress() {
                 // на всякий случай скрываем upload-прогресс
                 if (uploadProgressSection) uploadProgressSection.classList.add('hidden');
                 showResults(data.results);
+            } else if (data.stage === 'canceled') {
+                clearInterval(interval);
+                resetApp();
             } else if (data.results && data.results.status === 'error') {
                 clearInterval(interval);
                 alert('Error: ' + data.results.error);
@@ -388,7 +391,10 @@ function updateProgressBar(data) {
     progressBar.style.width = progress + '%';
     progressPercent.textContent = progress + '%';
 
-    if (data.stage === 'compressing') {
+    if (data.stage === 'queued' && data.queue) {
+        progressText.textContent = `Waiting in queue (position ${data.queue.position + 1})`;
+        currentFile.textContent = `Estimated wait: ~${Math.ceil(data.queue.estimated_wait_seconds)}s`;
+    } else if (data.stage === 'compressing') {
         progressText.textContent = `Processing file ${data.index || 0} of ${data.total || 0}`;
         currentFile.textContent = `Current: ${data.current_file || ''}`;
     } else if (data.stage === 'archiving') {
@@ -436,6 +442,30 @@ function showResults(results) {
     }
 
     summary.innerHTML = html;
+
+    showPreviews(summary);
+}
+
+// Превью до/после первых файлов (список файлов - постранично из api/results)
+async function showPreviews(container) {
+    try {
+        const response = await fetch(`/api/results/${sessionId}/?failed=0&page_size=12`);
+        const data = await response.json();
+        if (!data.files || data.files.length === 0) return;
+
+        let html = '<div class="mt-4"><p class="font-semibold text-gray-700 mb-2">Before / after:</p><div class="grid grid-cols-2 gap-2">';
+        for (const file of data.files) {
+            const name = encodeURIComponent(file.name);
+            html += `
+                <img loading="lazy" class="w-full rounded border" alt="${file.name} (before)" src="/api/preview/${sessionId}/before/${name}">
+                <img loading="lazy" class="w-full rounded border" alt="${file.name} (after)" src="/api/preview/${sessionId}/after/${name}">
+            `;
+        }
+        html += '</div></div>';
+        container.insertAdjacentHTML('beforeend', html);
+    } catch (error) {
+        // Превью необязательны
+    }
 }
 
 // Кнопка скачивания
@@ -0,0 +1,155 @@
+"""
+Пакетная запись heartbeat и прогресса сессий
+"""
+
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import CompressionSession
+
+
+def write_progress(progress_file, data):
+    """Записать progress.json атомарно; каталог сессии мог быть уже удален (отмена)"""
+    temp_file = progress_file.with_name(f'.{progress_file.name}.tmp')
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_file, progress_file)
+    except FileNotFoundError:
+        pass
+
+
+class StatusWriter:
+    """
+    Накопление heartbeat и прогресса сжимающих потоков и запись пачкой.
+    
+    Потоки конвейера обновляют heartbeat и progress.json после каждого
+    файла, этапа и проверки очереди; каждый heartbeat - отдельная запись в
+    SQLite, которая ждет общую блокировку записи вместе с запросами. Здесь
+    обновления копятся в памяти и раз в interval секунд пишутся из
+    отдельного потока: heartbeat - одной короткой транзакцией, прогресс -
+    только последний по каждой сессии. Конечные состояния (результаты,
+    error, canceled) пишутся сразу, мимо StatusWriter; отложенный прогресс
+    запуска перед ними записывается flush_progress.
+    
+    Если запись не прошла (сессию перехватил другой запуск), следующий
+    heartbeat этого запуска возвращает False. Обновления хранятся по паре
+    (сессия, запуск): heartbeat старого запуска не вытесняет heartbeat
+    нового.
+    """
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = set()
+        self._progress = {}
+        self._superseded = set()
+        self._lock = threading.Lock()
+        # Порядок записей progress.json: поток записи и flush_progress
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def heartbeat(self, db_session, generation):
+        """Отложить heartbeat; False - сессия уже перехвачена другим запуском"""
+        with self._lock:
+            if (db_session.pk, generation) in self._superseded:
+                return False
+            self._pending.add((db_session.pk, generation))
+            self._ensure_thread()
+        return True
+    
+    def progress(self, db_session, generation, progress_file, data):
+        """Отложить запись progress.json (пишется последнее состояние)"""
+        with self._lock:
+            self._progress[(db_session.pk, generation)] = (progress_file, data)
+            self._ensure_thread()
+    
+    def _ensure_thread(self):
+        if self._thread is None and not self._stop.is_set():
+            self._thread = threading.Thread(target=self._run, name='status-writer', daemon=True)
+            self._thread.start()
+    
+    def flush_progress(self, db_session, generation):
+        """Записать отложенный прогресс запуска сейчас, в вызывающем потоке"""
+        with self._write_lock:
+            with self._lock:
+                pending = self._progress.pop((db_session.pk, generation), None)
+            if pending is not None:
+                write_progress(*pending)
+    
+    def forget(self, db_session, generation):
+        """
+        Запуск generation завершен: отложенный прогресс записывается,
+        отложенный heartbeat больше не нужен
+        """
+        self.flush_progress(db_session, generation)
+        key = (db_session.pk, generation)
+        with self._lock:
+            self._pending.discard(key)
+            self._superseded.discard(key)
+    
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, set()
+                progress, self._progress = self._progress, {}
+            
+            # Прогресс нового запуска сессии пишется после прогресса старого
+            for key in sorted(progress):
+                write_progress(*progress[key])
+        if not pending:
+            return
+        
+        now = timezone.now()
+        superseded = []
+        with transaction.atomic():
+            for pk, generation in pending:
+                updated = CompressionSession.objects.filter(
+                    pk=pk,
+                    status='processing',
+                    resume_count=generation
+                ).update(heartbeat_at=now)
+                if not updated:
+                    superseded.append((pk, generation))
+        
+        if superseded:
+            with self._lock:
+                self._superseded.update(superseded)
+    
+    def stop(self):
+        """Остановить поток записи и записать накопленное"""
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self.flush()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # Heartbeat повторится при следующей записи
+                print(f"Status writer flush failed: {e}")
+                connections.close_all()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_status_writer():
+    """Общий StatusWriter процесса; None, если heartbeat пишется сразу"""
+    global _writer
+    if not settings.STATUS_FLUSH_SECONDS:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = StatusWriter(settings.STATUS_FLUSH_SECONDS)
+        return _writer
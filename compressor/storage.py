@@ -0,0 +1,329 @@
+"""
+Размещение временных файлов сессий, учет их объема и вытеснение по
+порогам заполнения
+"""
+
+import os
+import shutil
+import threading
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import metrics
+from .models import CompressionSession, ScratchLock, ScratchReservation
+
+
+# Одновременно вытеснение выполняет один поток процесса
+_enforce_lock = threading.Lock()
+
+# Выбор места для новой сессии: бюджет SCRATCH_ROOT проверяется и
+# занимается в одной транзакции под блокировкой ScratchLock - атомарно для
+# всех процессов сервера. Пока у сессии нет записи в БД, место держит
+# ScratchReservation - до record_usage, но не дольше
+# SCRATCH_RESERVATION_SECONDS (загрузка прервалась); дальше - поле
+# CompressionSession.scratch_bytes
+SCRATCH_RESERVATION_SECONDS = 300
+
+# Каталог сессии - ROOT/<первые SHARD_CHARS символов UUID>/<UUID>: в корне
+# не больше 256 подкаталогов при любом числе сессий. Сессии, созданные до
+# разбиения, лежат прямо в корне до переноса (migrate_session_layout)
+SHARD_CHARS = 2
+
+
+def session_roots():
+    """Каталоги с сессиями: SCRATCH_ROOT (если включен) и TEMP_ROOT"""
+    roots = [Path(settings.TEMP_ROOT)]
+    if settings.SCRATCH_ROOT:
+        roots.insert(0, Path(settings.SCRATCH_ROOT))
+    return roots
+
+
+def shard_path(root, session_id):
+    """Каталог сессии в корне root (с разбиением по префиксу UUID)"""
+    return Path(root) / session_id[:SHARD_CHARS] / session_id
+
+
+def session_locations(session_id):
+    """
+    Возможные каталоги сессии в порядке поиска.
+    
+    TEMP_ROOT проверяется первым: при переносе сессии из SCRATCH_ROOT
+    каталог появляется в TEMP_ROOT уже целиком. Каталоги без разбиения -
+    в конце (сессии, еще не перенесенные migrate_session_layout).
+    """
+    roots = session_roots()[::-1]
+    return [shard_path(root, session_id) for root in roots] + [root / session_id for root in roots]
+
+
+def get_session_path(session_id):
+    """Каталог сессии (для новой сессии - в TEMP_ROOT)"""
+    locations = session_locations(session_id)
+    for path in locations:
+        if path.exists():
+            return path
+    return locations[0]
+
+
+def iter_session_dirs():
+    """
+    Каталоги всех сессий (в шардах и без разбиения) без обхода их
+    содержимого. Сюда же попадают недоделанные копии переноса (.<id>.spill).
+    """
+    for root in session_roots():
+        if not root.exists():
+            continue
+        for entry in root.iterdir():
+            if not entry.is_dir():
+                continue
+            if len(entry.name) == SHARD_CHARS:
+                yield from (path for path in entry.iterdir() if path.is_dir())
+            else:
+                yield entry
+
+
+def is_scratch(path):
+    return bool(settings.SCRATCH_ROOT) and Path(settings.SCRATCH_ROOT) in path.parents
+
+
+def scratch_bytes():
+    """
+    Занятая часть бюджета SCRATCH_ROOT: сумма scratch_bytes сессий и резервы
+    еще не записанных в БД. Агрегирующие запросы, без обхода файлов.
+    """
+    used = CompressionSession.objects.filter(
+        evicted_at__isnull=True, scratch_bytes__gt=0
+    ).aggregate(total=Sum('scratch_bytes'))['total'] or 0
+    reserved = ScratchReservation.objects.filter(
+        expires_at__gt=timezone.now()
+    ).aggregate(total=Sum('reserved_bytes'))['total'] or 0
+    return used + reserved
+
+
+def lock_scratch_budget():
+    """
+    Заблокировать бюджет SCRATCH_ROOT до конца текущей транзакции.
+    
+    Другие СУБД блокируют строку ScratchLock (select_for_update); SQLite
+    его не поддерживает, но транзакции в настройках IMMEDIATE - блокировка
+    записи берется уже в начале транзакции.
+    """
+    ScratchLock.objects.select_for_update().get_or_create(pk=1)
+
+
+def release_reservation(session_id):
+    """Снять резерв сессии, которая так и не получила запись в БД"""
+    ScratchReservation.objects.filter(session_id=session_id).delete()
+
+
+def create_session_path(session_id, expected_bytes):
+    """
+    Создать каталог новой сессии.
+    
+    Небольшие сессии (с учетом роста: сжатые файлы, архив, превью) целиком
+    живут в SCRATCH_ROOT (tmpfs) в пределах SCRATCH_BUDGET_MB - загрузка,
+    сжатие и архив обходятся без диска. Остальные - в TEMP_ROOT.
+    Место в бюджете занимается до записи файлов.
+    """
+    need = expected_bytes * settings.SCRATCH_GROWTH_FACTOR
+    budget = settings.SCRATCH_BUDGET_MB * 1024 * 1024
+    if settings.SCRATCH_ROOT and need <= budget:
+        with transaction.atomic():
+            lock_scratch_budget()
+            ScratchReservation.objects.filter(expires_at__lte=timezone.now()).delete()
+            reserved = scratch_bytes() + need <= budget
+            if reserved:
+                ScratchReservation.objects.create(
+                    session_id=session_id,
+                    reserved_bytes=need,
+                    expires_at=timezone.now() + timedelta(seconds=SCRATCH_RESERVATION_SECONDS)
+                )
+        if reserved:
+            path = shard_path(settings.SCRATCH_ROOT, session_id)
+            path.mkdir(parents=True, exist_ok=True)
+            return path
+    
+    path = shard_path(settings.TEMP_ROOT, session_id)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def spill_session(db_session, path):
+    """
+    Перенести сессию из SCRATCH_ROOT в TEMP_ROOT, если SCRATCH_ROOT
+    превысил бюджет (файлы выросли больше ожидаемого). Возвращает
+    актуальный каталог сессии.
+    
+    Запас на рост сессии заменяется ее фактическим объемом (обходится
+    только каталог этой сессии). Файлы переносятся по одному в каталог с
+    временным именем, который затем переименовывается: в памяти и на диске
+    одновременно лишь один файл, а другие запросы находят каталог в
+    TEMP_ROOT только целиком. После сбоя во время переноса часть файлов
+    уже во временном каталоге - следующий перенос сессии дополняет его.
+    """
+    if not is_scratch(path):
+        return path
+    used = directory_bytes(path)
+    with transaction.atomic():
+        lock_scratch_budget()
+        CompressionSession.objects.filter(pk=db_session.pk).update(scratch_bytes=used)
+        if scratch_bytes() <= settings.SCRATCH_BUDGET_MB * 1024 * 1024:
+            return path
+        CompressionSession.objects.filter(pk=db_session.pk).update(scratch_bytes=0)
+    
+    disk_path = shard_path(settings.TEMP_ROOT, path.name)
+    disk_path.parent.mkdir(parents=True, exist_ok=True)
+    staging_path = disk_path.parent / f'.{path.name}.spill'
+    move_files(path, staging_path)
+    staging_path.rename(disk_path)
+    shutil.rmtree(path, ignore_errors=True)
+    print(f"Scratch storage over budget: session {path.name} moved to disk")
+    return disk_path
+
+
+def move_files(source, target):
+    """
+    Перенести содержимое каталога source в target по одному файлу
+    (копия и удаление, если это разные файловые системы). Подкаталоги -
+    раньше файлов верхнего уровня: progress.json и итоги остаются на
+    месте, пока переносятся результаты.
+    """
+    target.mkdir(parents=True, exist_ok=True)
+    entries = sorted(os.scandir(source), key=lambda entry: not entry.is_dir(follow_symlinks=False))
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            move_files(Path(entry.path), target / entry.name)
+        else:
+            shutil.move(entry.path, target / entry.name)
+
+
+def directory_bytes(path):
+    """Объем файлов каталога (рекурсивно)"""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_bytes(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def record_usage(db_session, session_path):
+    """
+    Записать объем файлов сессии в БД и проверить пороги.
+    
+    Вызывается, когда набор файлов сессии меняется (загрузка, завершение
+    сжатия) - обходится только каталог этой сессии. Сессия в SCRATCH_ROOT
+    после загрузки занимает бюджет с запасом на рост (резерв), после
+    завершения - фактический объем.
+    """
+    storage_bytes = directory_bytes(session_path)
+    with transaction.atomic():
+        # Резерв и scratch_bytes сессии меняются вместе - место не
+        # учитывается дважды и не пропадает из бюджета между запросами
+        reservation = ScratchReservation.objects.filter(session_id=db_session.session_id).first()
+        if reservation is not None:
+            reservation.delete()
+        if is_scratch(session_path):
+            scratch = max(storage_bytes, reservation.reserved_bytes) if reservation else storage_bytes
+        else:
+            scratch = 0
+        CompressionSession.objects.filter(pk=db_session.pk).update(storage_bytes=storage_bytes, scratch_bytes=scratch)
+    db_session.storage_bytes = storage_bytes
+    db_session.scratch_bytes = scratch
+    enforce_watermarks()
+
+
+def release_usage(db_session):
+    """Файлы сессии удалены (отмена, ошибка загрузки)"""
+    CompressionSession.objects.filter(pk=db_session.pk).update(storage_bytes=0, scratch_bytes=0)
+    db_session.storage_bytes = 0
+    db_session.scratch_bytes = 0
+
+
+def tracked_bytes():
+    """Объем файлов сессий в TEMP_ROOT по данным БД (SCRATCH_ROOT - отдельный бюджет)"""
+    total = CompressionSession.objects.filter(
+        evicted_at__isnull=True, scratch_bytes=0
+    ).aggregate(total=Sum('storage_bytes'))['total']
+    return total or 0
+
+
+def capacity_bytes(tracked):
+    """
+    Емкость хранилища: STORAGE_QUOTA_MB, но не больше, чем доступно на
+    диске. Свободное место учитывает и еще не записанные в БД файлы
+    (идущее сжатие, потоковые пакетные сессии).
+    """
+    quota = settings.STORAGE_QUOTA_MB * 1024 * 1024
+    try:
+        free = shutil.disk_usage(settings.TEMP_ROOT).free
+    except OSError:
+        return quota
+    return min(quota, tracked + free)
+
+
+def eviction_candidates():
+    """
+    Сессии TEMP_ROOT в порядке вытеснения: скачанные, затем самые старые
+    завершенные (сессии SCRATCH_ROOT место на диске не освобождают)
+    """
+    alive = CompressionSession.objects.filter(evicted_at__isnull=True, scratch_bytes=0)
+    yield from alive.filter(status='downloaded').order_by('downloaded_at')
+    yield from alive.filter(status__in=('completed', 'error')).order_by('created_at')
+
+
+def remove_session_files(session_id):
+    """Удалить каталог сессии во всех корнях"""
+    for path in session_locations(session_id):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def evict_session(db_session):
+    """Удалить файлы сессии; запись в БД остается с отметкой evicted_at"""
+    remove_session_files(db_session.session_id)
+    CompressionSession.objects.filter(pk=db_session.pk).update(storage_bytes=0, scratch_bytes=0, evicted_at=timezone.now())
+
+
+def enforce_watermarks():
+    """
+    Если файлы сессий занимают больше STORAGE_HIGH_WATERMARK емкости,
+    вытеснять сессии, пока не останется STORAGE_LOW_WATERMARK.
+    
+    Обычная проверка - один агрегирующий запрос и statvfs. Возвращает
+    число вытесненных сессий.
+    """
+    if not _enforce_lock.acquire(blocking=False):
+        return 0
+    try:
+        tracked = tracked_bytes()
+        capacity = capacity_bytes(tracked)
+        if tracked <= capacity * settings.STORAGE_HIGH_WATERMARK:
+            return 0
+        
+        target = capacity * settings.STORAGE_LOW_WATERMARK
+        evicted = 0
+        for db_session in eviction_candidates():
+            if tracked <= target:
+                break
+            evict_session(db_session)
+            metrics.STORAGE_EVICTIONS.labels(status=db_session.status).inc()
+            tracked -= db_session.storage_bytes
+            evicted += 1
+        
+        print(f"Storage over high watermark: evicted {evicted} sessions, "
+              f"{tracked / (1024*1024):.0f} of {capacity / (1024*1024):.0f} MB in use")
+        return evicted
+    finally:
+        _enforce_lock.release()
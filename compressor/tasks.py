@@ -0,0 +1,531 @@
+"""
+Фоновый запуск сжатия: heartbeat, чекпоинты и возобновление прерванных сессий
+"""
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Q
+from django.utils import timezone
+from contextlib import nullcontext
+from datetime import timedelta
+import json
+import shutil
+import threading
+
+from .compressor_engine import WebCompressor, CancellationToken, CompressionCanceled
+from .bulk import ImageArchive
+from .manifest import artifact_paths, update_manifest
+from . import metrics
+from .profiling import BatchProfiler, is_enabled as profiling_enabled
+from .models import CompressionSession, CompressionFile
+from .scheduler import get_scheduler
+from .status_writer import get_status_writer, write_progress
+from .storage import get_session_path, record_usage, release_usage, spill_session
+from .worker_pool import get_worker_pool
+from .zip_stream import ZipStream
+
+
+# Записи по файлам в results.json; в статус сессии не попадают
+PER_FILE_KEYS = ('files', 'failed_files', 'skipped')
+
+
+class SessionSuperseded(Exception):
+    """Сессию перехватил другой запуск (heartbeat этого потока просрочен)"""
+
+
+# Токены отмены сессий, которые сжимаются в этом процессе
+_cancel_tokens = {}
+_cancel_tokens_lock = threading.Lock()
+
+
+def cancel_marker(session_path):
+    """Файл-маркер отмены (виден worker'ам в других процессах)"""
+    return session_path / 'cancel'
+
+
+def read_checkpoint(session_path):
+    """Результаты уже обработанных файлов из checkpoint.jsonl"""
+    checkpoint_file = session_path / 'checkpoint.jsonl'
+    completed = {}
+    if not checkpoint_file.exists():
+        return completed
+    
+    with open(checkpoint_file, 'r') as f:
+        for line in f:
+            try:
+                outcome = json.loads(line)
+            except ValueError:
+                # Недописанная строка при падении процесса
+                continue
+            completed[outcome['name']] = outcome
+    return completed
+
+
+def write_meta(session_path, meta):
+    with open(session_path / 'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def touch_heartbeat(db_session, generation, immediate=False):
+    """
+    Обновить heartbeat сессии.
+    
+    generation - номер запуска (resume_count); если сессию уже перехватил
+    другой запуск, heartbeat не обновляется и текущий поток останавливается.
+    Обычно обновление откладывается и пишется пачкой (StatusWriter);
+    immediate=True - проверить владение сессией сразу (перед записью
+    результатов).
+    """
+    writer = None if immediate else get_status_writer()
+    if writer:
+        if not writer.heartbeat(db_session, generation):
+            raise SessionSuperseded(db_session.session_id)
+        return
+    
+    updated = CompressionSession.objects.filter(
+        pk=db_session.pk,
+        status='processing',
+        resume_count=generation
+    ).update(heartbeat_at=timezone.now())
+    
+    if not updated:
+        raise SessionSuperseded(db_session.session_id)
+
+
+class HeartbeatTicker:
+    """
+    Heartbeat запуска из отдельного потока раз в interval секунд.
+    
+    Остальные heartbeat идут из колбэков прогресса, то есть раз на файл;
+    файл дольше HEARTBEAT_TIMEOUT (многостраничный TIFF, долгое ожидание
+    слота) иначе сделал бы сессию просроченной, и опрос запустил бы второй
+    параллельный запуск. Если сессию перехватили, поток просто завершается -
+    сжатие остановится на своем следующем heartbeat.
+    """
+    
+    def __init__(self, db_session, generation, interval):
+        self.db_session = db_session
+        self.generation = generation
+        self.interval = interval
+        self._stop = threading.Event()
+    
+    def start(self):
+        thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+        thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    touch_heartbeat(self.db_session, self.generation)
+                except SessionSuperseded:
+                    return
+                except Exception as e:
+                    print(f"Heartbeat of session {self.db_session.session_id} failed: {e}")
+        finally:
+            connections.close_all()
+
+
+def run_compression(db_session, session_path, generation):
+    """Сжатие сессии (выполняется в фоновом потоке)"""
+    meta_file = session_path / 'meta.json'
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    
+    token = CancellationToken(cancel_marker(session_path))
+    with _cancel_tokens_lock:
+        _cancel_tokens[db_session.session_id] = token
+    
+    ticker = HeartbeatTicker(db_session, generation, settings.HEARTBEAT_INTERVAL)
+    ticker.start()
+    
+    try:
+        compressor = WebCompressor(
+            session_path,
+            prefix=meta['prefix'],
+            compression_settings=meta['compression_settings']
+        )
+        compressor.cancel_token = token
+        compressor.pipeline_workers = settings.PIPELINE_WORKERS
+        compressor.pipeline_queue_size = settings.PIPELINE_QUEUE_SIZE
+        compressor.thread_cleanup = connections.close_all
+        # Профилировщик видит только потоки этого процесса - профилируемая
+        # сессия сжимается без пула
+        compressor.worker_pool = None if profiling_enabled(db_session) else get_worker_pool(
+            settings.WORKER_POOL_SIZE, settings.WORKER_MAX_TASKS, settings.WORKER_MAX_RSS_MB
+        )
+        if settings.PREVIEWS_ENABLED:
+            compressor.previews_path = session_path / 'previews'
+        
+        last_progress = {}
+        scheduler = get_scheduler()
+        
+        progress_file = session_path / 'progress.json'
+        
+        def report_progress(data):
+            writer = get_status_writer()
+            if writer:
+                writer.progress(db_session, generation, progress_file, data)
+            else:
+                write_progress(progress_file, data)
+        
+        def progress_update(data):
+            touch_heartbeat(db_session, generation)
+            last_progress.clear()
+            last_progress.update(data)
+            # Текущее число слотов сжатия (меняется autoscale)
+            report_progress(dict(data, slots=scheduler.slots))
+        
+        def wait_for_slot():
+            # Ожидание слота: сессия жива, отмена срабатывает и в очереди
+            compressor.check_canceled()
+            touch_heartbeat(db_session, generation)
+            report_progress(dict(last_progress, stage='queued', queue=scheduler.queue_info(db_session.session_id)))
+        
+        compressor.slot_gate = lambda finishing=False: scheduler.slot(
+            db_session.session_id, on_wait=wait_for_slot, finishing=finishing
+        )
+        
+        checkpoint_file = session_path / 'checkpoint.jsonl'
+        
+        def checkpoint(outcome):
+            with open(checkpoint_file, 'a') as f:
+                f.write(json.dumps(outcome) + '\n')
+            touch_heartbeat(db_session, generation)
+        
+        compressor.progress_callback = progress_update
+        compressor.checkpoint_callback = checkpoint
+        
+        uploads_path = session_path / 'uploads'
+        completed = read_checkpoint(session_path)
+        archive = None
+        
+        if meta.get('source_archive'):
+            # Пакетная сессия: файлы извлекаются из архива по одному
+            archive = ImageArchive(session_path / meta['source_archive'], settings.MAX_UPLOAD_SIZE)
+            files = archive.iter_files(uploads_path, skip=completed)
+            total = len(archive)
+        else:
+            files = artifact_paths(session_path, 'uploads')
+            total = len(files)
+        
+        if not total:
+            raise Exception("No files to compress")
+        
+        # Сжимаем (уже обработанные файлы берутся из чекпоинта);
+        # без потоковой отдачи архив собирается последним этапом конвейера
+        archive_name = meta['prefix'] if meta['prefix'] else 'Archive'
+        
+        # Профилирование включается в админке; без него - никаких обвязок
+        if profiling_enabled(db_session):
+            profiler = BatchProfiler(session_path)
+            compressor.thread_setup = profiler.thread_start
+            compressor.thread_cleanup = lambda: (profiler.thread_exit(), connections.close_all())
+        else:
+            profiler = nullcontext()
+        
+        scheduler.register(db_session.session_id, db_session.user_id, total - len(completed))
+        try:
+            with profiler:
+                results = compressor.compress_batch(
+                    files,
+                    completed=completed,
+                    total=total,
+                    archive_name=None if settings.STREAMING_DOWNLOAD else archive_name,
+                    delete_inputs=archive is not None
+                )
+            if archive:
+                results['skipped'] = archive.skipped
+        finally:
+            scheduler.unregister(db_session.session_id)
+            if archive:
+                archive.close()
+        
+        # Размер архива (для потоковой отдачи - расчетный)
+        output_names = [name for entry in results['files'] for name in compressor.output_files(entry)]
+        if settings.STREAMING_DOWNLOAD:
+            stream = ZipStream(compressor.compressed_path / name for name in output_names)
+            results['archive_name'] = f"{compressor.sanitize_archive_name(archive_name)}.zip"
+            results['archive_size_mb'] = round(stream.content_length() / (1024*1024), 2)
+            archives = []
+        else:
+            results['archive_name'] = compressor.archive_path.name
+            results['archive_size_mb'] = round(compressor.archive_path.stat().st_size / (1024*1024), 2)
+            # Сжатые файлы уже в архиве и удалены
+            output_names, archives = [], [compressor.archive_path.name]
+        finalize_results(results)
+        
+        # До смены статуса: скачивание берет пути из манифеста
+        update_manifest(session_path, outputs=output_names, archives=archives)
+        
+        touch_heartbeat(db_session, generation, immediate=True)
+        
+        # Последний прогресс (100%) - до результатов и до переноса каталога
+        writer = get_status_writer()
+        if writer:
+            writer.flush_progress(db_session, generation)
+        write_results(session_path, results)
+        
+        # Сессия выросла больше места в SCRATCH_ROOT - переносим на диск,
+        # пока скачивание еще недоступно (статус не completed)
+        session_path = spill_session(db_session, session_path)
+        uploads_path = session_path / 'uploads'
+        
+        save_session_results(db_session, results)
+        
+        # Исходники больше не нужны - удаляем только после успешного завершения
+        shutil.rmtree(uploads_path, ignore_errors=True)
+        if archive:
+            (session_path / meta['source_archive']).unlink(missing_ok=True)
+        update_manifest(session_path, uploads=[])
+        
+        meta['status'] = 'completed'
+        write_meta(session_path, meta)
+        
+        record_usage(db_session, session_path)
+    
+    except CompressionCanceled:
+        finish_canceled(db_session, session_path)
+    
+    except SessionSuperseded:
+        if token.is_canceled():
+            finish_canceled(db_session, session_path)
+        else:
+            print(f"Session {db_session.session_id} was taken over by another run, stopping")
+    
+    except Exception as e:
+        if token.is_canceled():
+            finish_canceled(db_session, session_path)
+        else:
+            fail_session(db_session, session_path, str(e))
+    
+    finally:
+        ticker.stop()
+        writer = get_status_writer()
+        if writer:
+            writer.forget(db_session, generation)
+        with _cancel_tokens_lock:
+            if _cancel_tokens.get(db_session.session_id) is token:
+                del _cancel_tokens[db_session.session_id]
+
+
+def finish_canceled(db_session, session_path):
+    """Остановка после отмены: удалить частичные результаты, оставить статус canceled"""
+    print(f"Session {db_session.session_id} canceled, cleaning up")
+    shutil.rmtree(session_path, ignore_errors=True)
+    CompressionSession.objects.filter(pk=db_session.pk).update(status='canceled')
+    release_usage(db_session)
+    metrics.SESSIONS_FINISHED.labels(status='canceled').inc()
+
+
+def request_cancel(db_session, session_path):
+    """
+    Отменить обработку сессии.
+    
+    Сжатие останавливается в пределах одного этапа текущего файла;
+    частичные результаты удаляет сам поток сжатия. Если живого потока нет
+    (heartbeat просрочен), файлы сессии удаляются сразу.
+    """
+    stale = is_stale(db_session)
+    
+    CompressionSession.objects.filter(pk=db_session.pk).update(status='canceled')
+    db_session.status = 'canceled'
+    
+    with _cancel_tokens_lock:
+        token = _cancel_tokens.get(db_session.session_id)
+    
+    if token is not None:
+        token.cancel()
+    elif stale:
+        shutil.rmtree(session_path, ignore_errors=True)
+        release_usage(db_session)
+    elif session_path.exists():
+        # Сжатие идет в другом процессе - он увидит маркер
+        cancel_marker(session_path).touch()
+
+
+def finalize_results(results):
+    """Итоговая экономия по категориям"""
+    results['status'] = 'completed'
+    for cat, stats in results['categories'].items():
+        if stats['orig'] > 0:
+            stats['savings'] = round((1 - stats['comp'] / stats['orig']) * 100, 1)
+
+
+def save_session_results(db_session, results):
+    """Записать итоги сжатия сессии и информацию о файлах в БД"""
+    db_session.status = 'completed'
+    db_session.files_successful = results['successful']
+    db_session.files_failed = results['failed']
+    db_session.total_original_mb = round(results['total_original_mb'], 2)
+    db_session.total_compressed_mb = round(results['total_compressed_mb'], 2)
+    
+    if results['total_original_mb'] > 0:
+        db_session.savings_percent = round(
+            (1 - results['total_compressed_mb'] / results['total_original_mb']) * 100, 1
+        )
+    
+    db_session.completed_at = timezone.now()
+    db_session.save()
+    metrics.SESSIONS_FINISHED.labels(status='completed').inc()
+    
+    # Сохраняем информацию о файлах (для api/results/)
+    records = [
+        CompressionFile(
+            session=db_session,
+            original_name=file_info['name'],
+            output_name=file_info['output_name'],
+            original_size_mb=file_info['original_mb'],
+            compressed_size_mb=file_info['compressed_mb'],
+            savings_percent=file_info['savings'],
+            category=file_info.get('category', ''),
+            preset=file_info.get('preset') or '',
+            metadata_saved_bytes=file_info.get('metadata_saved_bytes', 0)
+        )
+        for file_info in results['files']
+    ]
+    failed = [(name, 'compression failed') for name in results.get('failed_files', [])]
+    failed += [(entry['name'], entry['reason']) for entry in results.get('skipped', [])]
+    records += [
+        CompressionFile(
+            session=db_session,
+            original_name=name[:255],
+            output_name='',
+            original_size_mb=0,
+            compressed_size_mb=0,
+            savings_percent=0,
+            success=False,
+            error=reason
+        )
+        for name, reason in failed
+    ]
+    CompressionFile.objects.bulk_create(records, batch_size=500)
+
+
+def session_summary(results):
+    """Итоги сессии без записей по файлам - размер не зависит от числа файлов"""
+    summary = {key: value for key, value in results.items() if key not in PER_FILE_KEYS}
+    if 'skipped' in results:
+        summary['skipped_count'] = len(results['skipped'])
+    return summary
+
+
+def write_results(session_path, results):
+    """results.json (полностью) и summary.json (для опроса статуса)"""
+    with open(session_path / 'results.json', 'w') as f:
+        json.dump(results, f, indent=2)
+    with open(session_path / 'summary.json', 'w') as f:
+        json.dump(session_summary(results), f)
+
+
+def read_summary(session_path):
+    """Итоги завершенной сессии (None, если сессия не завершена)"""
+    summary_file = session_path / 'summary.json'
+    if summary_file.exists():
+        with open(summary_file, 'r') as f:
+            return json.load(f)
+    
+    # Сессии, завершенные до появления summary.json
+    results_file = session_path / 'results.json'
+    if results_file.exists():
+        with open(results_file, 'r') as f:
+            return session_summary(json.load(f))
+    return None
+
+
+def fail_session(db_session, session_path, message):
+    """Перевести сессию в статус error (БД, results.json и meta.json)"""
+    write_results(session_path, {'status': 'error', 'error': message})
+    
+    db_session.status = 'error'
+    db_session.error_message = message
+    db_session.save()
+    metrics.SESSIONS_FINISHED.labels(status='error').inc()
+    
+    meta_file = session_path / 'meta.json'
+    if meta_file.exists():
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        meta['status'] = 'error'
+        meta['error'] = message
+        write_meta(session_path, meta)
+    
+    record_usage(db_session, session_path)
+
+
+def start_compression(db_session, session_path):
+    """Запустить сжатие сессии в отдельном потоке"""
+    thread = threading.Thread(
+        target=run_compression,
+        args=(db_session, session_path, db_session.resume_count)
+    )
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def has_inputs(session_path):
+    """Исходные файлы сессии еще на месте (загрузки или архив пакетной сессии)"""
+    if (session_path / 'uploads').exists():
+        return True
+    meta_file = session_path / 'meta.json'
+    if not meta_file.exists():
+        return False
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    return bool(meta.get('source_archive')) and (session_path / meta['source_archive']).exists()
+
+
+def stale_heartbeat_filter():
+    """Условие для сессий processing, чей heartbeat просрочен"""
+    cutoff = timezone.now() - timedelta(seconds=settings.HEARTBEAT_TIMEOUT)
+    return Q(status='processing') & (
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, created_at__lt=cutoff)
+    )
+
+
+def is_stale(db_session):
+    """Сессия в processing, но heartbeat давно не обновлялся"""
+    if db_session.status != 'processing':
+        return False
+    last_seen = db_session.heartbeat_at or db_session.created_at
+    return last_seen < timezone.now() - timedelta(seconds=settings.HEARTBEAT_TIMEOUT)
+
+
+def resume_session(db_session):
+    """
+    Возобновить прерванную сессию со следующего необработанного файла.
+    
+    Захват атомарный: из нескольких процессов, одновременно заметивших
+    просроченный heartbeat, сессию возобновит только один. Сжатие идет в
+    фоновом потоке, как обычный запуск (start_compression).
+    Возвращает поток сжатия или None, если сессия не возобновлена.
+    """
+    session_path = get_session_path(db_session.session_id)
+    
+    claimed = CompressionSession.objects.filter(
+        stale_heartbeat_filter(),
+        pk=db_session.pk,
+        resume_count=db_session.resume_count
+    ).update(heartbeat_at=timezone.now(), resume_count=F('resume_count') + 1)
+    
+    if not claimed:
+        return None
+    
+    db_session.refresh_from_db()
+    
+    if not has_inputs(session_path):
+        db_session.status = 'error'
+        db_session.error_message = 'Session timed out - session files are missing'
+        db_session.save()
+        return None
+    
+    if db_session.resume_count > settings.SESSION_MAX_RESUMES:
+        fail_session(db_session, session_path, 'Session timed out - processing was interrupted and could not be resumed')
+        return None
+    
+    print(f"Resuming session {db_session.session_id} (attempt {db_session.resume_count})")
+    return start_compression(db_session, session_path)
@@ -1,3 +1,1325 @@
-from django.test import TestCase
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from PIL import ExifTags, Image, ImageCms, ImageDraw, ImageFilter
+from prometheus_client import REGISTRY
+
+from . import async_views, cron, profiling, storage, worker_pool
+from .content_analysis import analyze_content
+from .estimation import BatchEstimate
+from .normalize import to_output_mode
+from .management.commands import loadtest
+from .compressor_engine import CancellationToken, CompressionCanceled, WebCompressor
+from .bulk import ImageArchive, safe_entry_name
+from .manifest import MANIFEST_FILE, artifact_paths, read_manifest, write_manifest
+from .pipeline import Pipeline, Stage
+from .models import CompressionFile, CompressionSession, ProfilingTarget, ScratchReservation
+from .scheduler import FairScheduler
+from .status_writer import StatusWriter
+from .storage import get_session_path, shard_path
+from .tasks import (
+    SessionSuperseded, cancel_marker, read_checkpoint, request_cancel, resume_session, run_compression,
+    touch_heartbeat,
+)
+from .zip_stream import ZipStream
+
+
+# Асинхронные views подключаются в urls.py только при ASYNC_API = True -
+# тесты обращаются к ним через собственный urlconf
+urlpatterns = [
+    path('status/<str:session_id>/', async_views.get_status),
+    path('summary/<str:session_id>/', async_views.get_summary),
+    path('download/<str:session_id>/', async_views.download_archive),
+    path('download/<str:session_id>/stream/', async_views.download_stream),
+]
+
+SESSION_ID = '0b5d8a1e-0000-4000-8000-000000000001'
+OTHER_SESSION_ID = '7f3c2a10-0000-4000-8000-000000000002'
+
+
+def jpeg_bytes(size=(64, 48), color=(200, 40, 40)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class TempDirMixin:
+    """Временный каталог на тест (self.tmp), удаляется после теста"""
+    
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.tmp = Path(temp_dir.name)
+
+
+class ZipStreamTests(TempDirMixin, SimpleTestCase):
+    def make_files(self, sizes):
+        files = []
+        for i, size in enumerate(sizes):
+            path = self.tmp / f'file_{i}.jpg'
+            path.write_bytes(bytes(range(256)) * (size // 256) + b'x' * (size % 256))
+            files.append(path)
+        return files
+    
+    def test_valid_archive_with_exact_length(self):
+        files = self.make_files([0, 1, 1000, 200 * 1024])
+        stream = ZipStream(files, chunk_size=4096)
+        body = b''.join(stream)
+        
+        self.assertEqual(len(body), stream.content_length())
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), sorted(path.name for path in files))
+            for path in files:
+                info = archive.getinfo(path.name)
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(archive.read(path.name), path.read_bytes())
+    
+    def test_empty_archive(self):
+        stream = ZipStream([])
+        body = b''.join(stream)
+        self.assertEqual(len(body), stream.content_length())
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.namelist(), [])
+    
+    def test_utf8_names(self):
+        path = self.tmp / 'фото_1.jpg'
+        path.write_bytes(b'data')
+        stream = ZipStream([path])
+        body = b''.join(stream)
+        self.assertEqual(len(body), stream.content_length())
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.namelist(), ['фото_1.jpg'])
+
+
+class SessionMixin(TempDirMixin):
+    """Сессия пользователя self.user с каталогом в TEMP_ROOT (self.tmp)"""
+    
+    def setUp(self):
+        super().setUp()
+        storage_settings = override_settings(TEMP_ROOT=str(self.tmp), SCRATCH_ROOT='')
+        storage_settings.enable()
+        self.addCleanup(storage_settings.disable)
+        self.user = User.objects.create_user('owner')
+    
+    def make_session(self, status='completed', outputs=(), session_id=SESSION_ID, **fields):
+        db_session = CompressionSession.objects.create(
+            user=self.user, session_id=session_id, status=status, archive_name='Photos', **fields
+        )
+        session_path = get_session_path(session_id)
+        (session_path / 'compressed').mkdir(parents=True)
+        for name in outputs:
+            (session_path / 'compressed' / name).write_bytes(jpeg_bytes())
+        write_manifest(session_path, {'uploads': [], 'outputs': list(outputs), 'archives': []})
+        return db_session, session_path
+
+
+@override_settings(ROOT_URLCONF='compressor.tests')
+class AsyncViewsTests(SessionMixin, TestCase):
+    async def read_body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+    
+    async def test_stream_download(self):
+        await self.async_client.aforce_login(self.user)
+        await sync_to_async(self.make_session)(outputs=['a_compressed.jpg', 'b_compressed.jpg'])
+        
+        response = await self.async_client.get(f'/download/{SESSION_ID}/stream/')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        body = await self.read_body(response)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.namelist(), ['a_compressed.jpg', 'b_compressed.jpg'])
+        db_session = await CompressionSession.objects.aget(session_id=SESSION_ID)
+        self.assertEqual(db_session.status, 'downloaded')
+    
+    async def test_evicted_download(self):
+        await self.async_client.aforce_login(self.user)
+        await sync_to_async(self.make_session)(evicted_at=timezone.now())
+        
+        response = await self.async_client.get(f'/download/{SESSION_ID}/')
+        self.assertEqual(response.status_code, 410)
+    
+    async def test_stale_status_is_reported_not_resumed(self):
+        await self.async_client.aforce_login(self.user)
+        await sync_to_async(self.make_session)(
+            status='processing', heartbeat_at=timezone.now() - timedelta(days=1)
+        )
+        
+        response = await self.async_client.get(f'/status/{SESSION_ID}/')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['stalled'])
+        db_session = await CompressionSession.objects.aget(session_id=SESSION_ID)
+        self.assertEqual(db_session.resume_count, 0)
+    
+    async def test_other_user_is_denied(self):
+        await sync_to_async(self.make_session)()
+        other = await sync_to_async(User.objects.create_user)('other')
+        await self.async_client.aforce_login(other)
+        
+        for url in (f'/status/{SESSION_ID}/', f'/summary/{SESSION_ID}/', f'/download/{SESSION_ID}/stream/'):
+            with self.subTest(url=url):
+                response = await self.async_client.get(url)
+                self.assertEqual(response.status_code, 403)
+
+
+class CheckpointTests(TempDirMixin, SimpleTestCase):
+    def make_session(self, names):
+        session_path = self.tmp / 'session'
+        uploads = session_path / 'uploads'
+        uploads.mkdir(parents=True)
+        for name in names:
+            (uploads / name).write_bytes(jpeg_bytes())
+        return session_path
+    
+    def test_truncated_line_is_ignored(self):
+        session_path = self.make_session([])
+        (session_path / 'checkpoint.jsonl').write_text(
+            json.dumps({'name': 'a.jpg', 'success': True}) + '\n{"name": "b.j'
+        )
+        self.assertEqual(list(read_checkpoint(session_path)), ['a.jpg'])
+    
+    def test_resume_skips_checkpointed_files(self):
+        session_path = self.make_session(['a.jpg', 'b.jpg'])
+        done = {
+            'name': 'a.jpg', 'output_name': 'a_compressed.jpg', 'success': True,
+            'original_mb': 1.0, 'compressed_mb': 0.5, 'category': 'B - Large',
+        }
+        checkpointed = []
+        
+        compressor = WebCompressor(session_path)
+        compressor.checkpoint_callback = checkpointed.append
+        results = compressor.compress_batch(
+            sorted((session_path / 'uploads').iterdir()), completed={'a.jpg': done}
+        )
+        
+        # Файл из чекпоинта не сжимается заново, но входит в результаты
+        self.assertEqual([outcome['name'] for outcome in checkpointed], ['b.jpg'])
+        self.assertEqual(results['successful'], 2)
+        self.assertIn(done['output_name'], [entry['output_name'] for entry in results['files']])
+        self.assertFalse((compressor.compressed_path / 'a_compressed.jpg').exists())
+
+
+@mock.patch('compressor.tasks.start_compression')
+class ResumeTests(SessionMixin, TestCase):
+    def make_stale(self, **fields):
+        db_session, session_path = self.make_session(
+            status='processing', heartbeat_at=timezone.now() - timedelta(minutes=5), **fields
+        )
+        (session_path / 'uploads').mkdir()
+        return db_session
+    
+    def test_stale_session_is_claimed_once(self, start_compression):
+        db_session = self.make_stale()
+        duplicate = CompressionSession.objects.get(pk=db_session.pk)
+        
+        self.assertIsNotNone(resume_session(db_session))
+        # Второй процесс видел ту же попытку - захват уже сделан
+        self.assertIsNone(resume_session(duplicate))
+        
+        start_compression.assert_called_once()
+        self.assertEqual(db_session.resume_count, 1)
+    
+    def test_live_session_is_not_resumed(self, start_compression):
+        db_session, _ = self.make_session(status='processing', heartbeat_at=timezone.now())
+        self.assertIsNone(resume_session(db_session))
+        start_compression.assert_not_called()
+    
+    def test_resume_limit_fails_session(self, start_compression):
+        with override_settings(SESSION_MAX_RESUMES=1):
+            db_session = self.make_stale(resume_count=1)
+            self.assertIsNone(resume_session(db_session))
+        
+        db_session.refresh_from_db()
+        self.assertEqual(db_session.status, 'error')
+        start_compression.assert_not_called()
+    
+    def test_superseded_run_stops(self, start_compression):
+        db_session = self.make_stale()
+        resume_session(db_session)
+        
+        # Heartbeat прежнего запуска (generation 0) больше не принимается
+        with override_settings(STATUS_FLUSH_SECONDS=0):
+            with self.assertRaises(SessionSuperseded):
+                touch_heartbeat(db_session, 0, immediate=True)
+            touch_heartbeat(db_session, 1, immediate=True)
+    
+    def test_cron_starts_all_resumes_before_waiting(self, start_compression):
+        session_ids = {self.make_stale().session_id, self.make_stale(session_id=OTHER_SESSION_ID).session_id}
+        started = set()
+        thread = mock.Mock()
+        # Один медленный запуск не задерживает остальные
+        thread.join.side_effect = lambda: self.assertEqual(started, session_ids)
+        start_compression.side_effect = lambda session, path: started.add(session.session_id) or thread
+        
+        cron.reset_stuck_sessions()
+        
+        self.assertEqual(thread.join.call_count, 2)
+
+
+class CancelTests(SessionMixin, TestCase):
+    def test_canceled_batch_checkpoints_nothing(self):
+        uploads = self.tmp / 'uploads'
+        uploads.mkdir()
+        for name in ('a.jpg', 'b.jpg'):
+            (uploads / name).write_bytes(jpeg_bytes())
+        checkpointed = []
+        
+        compressor = WebCompressor(self.tmp)
+        compressor.checkpoint_callback = checkpointed.append
+        compressor.cancel_token = CancellationToken(cancel_marker(self.tmp))
+        compressor.cancel_token.cancel()
+        
+        with self.assertRaises(CompressionCanceled):
+            compressor.compress_batch(sorted(uploads.iterdir()))
+        self.assertEqual(checkpointed, [])
+    
+    def test_marker_cancels_in_other_process(self):
+        token = CancellationToken(cancel_marker(self.tmp))
+        self.assertFalse(token.is_canceled())
+        cancel_marker(self.tmp).touch()
+        self.assertTrue(token.is_canceled())
+    
+    def test_cancel_stale_session_removes_files(self):
+        db_session, session_path = self.make_session(
+            status='processing', heartbeat_at=timezone.now() - timedelta(days=1)
+        )
+        
+        request_cancel(db_session, session_path)
+        
+        db_session.refresh_from_db()
+        self.assertEqual(db_session.status, 'canceled')
+        self.assertFalse(session_path.exists())
+    
+    def test_cancel_in_other_process_leaves_marker(self):
+        db_session, session_path = self.make_session(status='processing', heartbeat_at=timezone.now())
+        
+        request_cancel(db_session, session_path)
+        
+        self.assertTrue(cancel_marker(session_path).exists())
+        self.assertEqual(CompressionSession.objects.get(pk=db_session.pk).status, 'canceled')
+
+
+class FairSchedulerTests(TempDirMixin, SimpleTestCase):
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting for scheduler')
+            time.sleep(0.01)
+    
+    def grant_order(self, scheduler, holder, waiters, finishing=()):
+        """
+        Порядок выдачи слотов ожидающим: holder держит единственный слот,
+        пока все waiters не встанут в очередь (сессии из finishing - с
+        finishing=True).
+        """
+        order = []
+        lock = threading.Lock()
+        
+        def take(session_id):
+            with scheduler.slot(session_id, finishing=session_id in finishing):
+                with lock:
+                    order.append(session_id)
+        
+        with scheduler.slot(holder):
+            threads = [threading.Thread(target=take, args=(session_id,)) for session_id in waiters]
+            for thread in threads:
+                thread.start()
+            self.wait_until(lambda: sum(
+                state['waiting'] for state in scheduler._sessions.values()
+            ) == len(waiters))
+        for thread in threads:
+            thread.join(5)
+        return order
+    
+    def test_least_served_session_goes_first(self):
+        scheduler = FairScheduler(slots=1, per_user_limit=1, small_batch_files=0)
+        scheduler.register('big', user_id=1, total_files=100)
+        scheduler.register('new', user_id=2, total_files=100)
+        
+        # big уже обслужил файл (holder), new - нет
+        self.assertEqual(self.grant_order(scheduler, 'big', ['big', 'new']), ['new', 'big'])
+    
+    def test_small_batch_wins_tie(self):
+        scheduler = FairScheduler(slots=1, per_user_limit=1, small_batch_files=5)
+        scheduler.register('holder', user_id=1, total_files=1)
+        scheduler.register('large', user_id=2, total_files=50)
+        scheduler.register('small', user_id=3, total_files=2)
+        
+        self.assertEqual(self.grant_order(scheduler, 'holder', ['large', 'small']), ['small', 'large'])
+    
+    def test_finishing_file_goes_first(self):
+        scheduler = FairScheduler(slots=1, per_user_limit=2, small_batch_files=0)
+        scheduler.register('holder', user_id=1, total_files=1)
+        scheduler.register('started', user_id=2, total_files=10)
+        scheduler.register('new', user_id=3, total_files=10)
+        # started обслужил больше файлов, но ждет кодирования уже
+        # декодированного файла
+        for _ in range(3):
+            with scheduler.slot('started'):
+                pass
+        
+        order = self.grant_order(scheduler, 'holder', ['new', 'started'], finishing={'started'})
+        
+        self.assertEqual(order, ['started', 'new'])
+        self.assertEqual(scheduler._sessions['started']['served'], 3)
+    
+    def test_batch_charges_one_slot_per_file(self):
+        uploads = self.tmp / 'uploads'
+        uploads.mkdir()
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            (uploads / name).write_bytes(jpeg_bytes())
+        scheduler = FairScheduler(slots=1, per_user_limit=1, small_batch_files=0)
+        scheduler.register('batch', user_id=1, total_files=3)
+        
+        compressor = WebCompressor(self.tmp)
+        compressor.slot_gate = lambda finishing=False: scheduler.slot('batch', finishing=finishing)
+        results = compressor.compress_batch(sorted(uploads.iterdir()))
+        
+        self.assertEqual(results['successful'], 3)
+        self.assertEqual(scheduler._sessions['batch']['served'], 3)
+        self.assertEqual(scheduler._active, 0)
+    
+    def test_per_user_limit(self):
+        scheduler = FairScheduler(slots=2, per_user_limit=1, small_batch_files=0)
+        scheduler.register('a1', user_id=1, total_files=10)
+        scheduler.register('a2', user_id=1, total_files=10)
+        scheduler.register('b', user_id=2, total_files=10)
+        
+        with scheduler.slot('a1'):
+            info = scheduler.queue_info('a2')
+            self.assertEqual(info['active_slots'], 1)
+            # Второй слот свободен, но у пользователя 1 уже занят свой
+            scheduler._sessions['a2']['waiting'] += 1
+            self.assertIsNone(scheduler._next_session())
+            scheduler._sessions['b']['waiting'] += 1
+            self.assertEqual(scheduler._next_session(), 'b')
+
+
+class SafeEntryNameTests(TempDirMixin, SimpleTestCase):
+    def test_traversal_is_flattened(self):
+        used = set()
+        for entry in ('../../etc/passwd.jpg', '/abs/photo.JPG', 'a/../../b.png', '..\\..\\win.jpg'):
+            name = safe_entry_name(entry, used)
+            self.assertNotIn('/', name)
+            self.assertNotIn('\\', name)
+            self.assertFalse(name.startswith('.'), name)
+            self.assertEqual(Path(name).name, name)
+        self.assertIn('etc_passwd.jpg', used)
+        self.assertIn('abs_photo.jpg', used)
+    
+    def test_collisions_get_suffix(self):
+        used = set()
+        names = [safe_entry_name(entry, used) for entry in ('a.jpg', 'a.jpg', 'a.JPG', '???.jpg')]
+        self.assertEqual(names, ['a.jpg', 'a_2.jpg', 'a_3.jpg', 'file.jpg'])
+    
+    def test_archive_extracts_inside_scratch(self):
+        archive_path = self.tmp / 'source.zip'
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('../../evil.jpg', jpeg_bytes())
+            archive.writestr('dir/ok.jpg', jpeg_bytes())
+        scratch = self.tmp / 'scratch'
+        
+        images = ImageArchive(archive_path, max_entry_size=1024 * 1024)
+        try:
+            extracted = list(images.iter_files(scratch))
+        finally:
+            images.close()
+        
+        self.assertEqual(sorted(path.name for path in extracted), ['dir_ok.jpg', 'evil.jpg'])
+        for path in extracted:
+            self.assertEqual(path.parent, scratch)
+            self.assertTrue(path.exists())
+        self.assertFalse((self.tmp.parent / 'evil.jpg').exists())
+
+
+class BulkTests(SessionMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+    
+    def upload(self, names, **data):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zipf:
+            for name in names:
+                zipf.writestr(name, jpeg_bytes())
+        archive.seek(0)
+        archive.name = 'photos.zip'
+        return self.client.post('/api/bulk/', dict(data, archive=archive))
+    
+    def test_stream_mode_returns_zip(self):
+        response = self.upload(['a.jpg', 'dir/b.jpg', 'notes.txt'], mode='stream')
+        
+        self.assertEqual(response.status_code, 200)
+        body = b''.join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            names = archive.namelist()
+            results = json.loads(archive.read('results.json'))
+        # Однотонные тестовые изображения - графика, PNG без потерь меньше JPEG
+        self.assertEqual(sorted(names), ['a_compressed.png', 'dir_b_compressed.png', 'results.json'])
+        self.assertEqual(results['successful'], 2)
+        self.assertEqual(results['skipped'], [{'name': 'notes.txt', 'reason': 'unsupported format'}])
+    
+    def test_too_many_entries_rejected_before_processing(self):
+        with mock.patch('compressor.views.ZIP_MAX_ENTRIES', 3):
+            response = self.upload(['a.jpg', 'b.jpg', 'c.jpg'], mode='job')
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CompressionSession.objects.exists())
+    
+    def test_stream_download_over_limit_is_client_error(self):
+        self.make_session(outputs=['a_compressed.jpg', 'b_compressed.jpg'])
+        with mock.patch('compressor.zip_stream.ZIP_MAX_ENTRIES', 1):
+            response = self.client.get(f'/api/download/{SESSION_ID}/stream/')
+        self.assertEqual(response.status_code, 400)
+
+
+class CompressDirTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.source = self.tmp / 'source'
+        self.destination = self.tmp / 'out'
+        (self.source / 'album').mkdir(parents=True)
+        for name in ('album/photo.jpg', 'album/photo.png', 'album/other.jpg'):
+            Image.effect_noise((300, 200), 40).convert('RGB').save(self.source / name)
+    
+    def run_command(self):
+        output = io.StringIO()
+        call_command('compress_dir', str(self.source), str(self.destination), workers=1, stdout=output)
+        with open(self.destination / '.compress_manifest.json') as f:
+            return json.load(f), output.getvalue()
+    
+    def test_colliding_stems_get_distinct_outputs(self):
+        manifest, _ = self.run_command()
+        
+        self.assertEqual(sorted(manifest), ['album/other.jpg', 'album/photo.jpg', 'album/photo.png'])
+        self.assertFalse(manifest['album/other.jpg']['keep_extension'])
+        outputs = {manifest[name]['output'] for name in ('album/photo.jpg', 'album/photo.png')}
+        self.assertEqual(len(outputs), 2)
+        for entry in manifest.values():
+            self.assertTrue((self.destination / entry['output']).exists())
+    
+    def test_unchanged_files_are_skipped(self):
+        self.run_command()
+        _, output = self.run_command()
+        self.assertIn('0 to compress, 3 up to date', output)
+    
+    def test_removed_source_is_pruned(self):
+        manifest, _ = self.run_command()
+        (self.source / 'album' / 'photo.png').unlink()
+        
+        pruned, output = self.run_command()
+        
+        self.assertNotIn('album/photo.png', pruned)
+        self.assertFalse((self.destination / manifest['album/photo.png']['output']).exists())
+        # Коллизии больше нет - photo.jpg пересжимается с обычным именем
+        self.assertIn('1 to compress', output)
+        self.assertFalse(pruned['album/photo.jpg']['keep_extension'])
+        self.assertFalse((self.destination / manifest['album/photo.jpg']['output']).exists())
+        self.assertTrue((self.destination / pruned['album/photo.jpg']['output']).exists())
+
+
+class PipelineTests(SimpleTestCase):
+    def test_items_pass_all_stages(self):
+        pipeline = Pipeline([
+            Stage('double', lambda x: x * 2, workers=2),
+            Stage('inc', lambda x: x + 1),
+        ])
+        self.assertEqual(sorted(pipeline.run(range(20))), [x * 2 + 1 for x in range(20)])
+        self.assertEqual(pipeline.utilization()['double']['items'], 20)
+    
+    def test_stage_error_reaches_consumer(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError('bad item')
+            return x
+        
+        pipeline = Pipeline([Stage('check', fail_on_three), Stage('pass', lambda x: x)])
+        threads_before = threading.active_count()
+        
+        with self.assertRaisesMessage(ValueError, 'bad item'):
+            list(pipeline.run(range(100)))
+        # Потоки этапов остановлены до того, как ошибка дошла до потребителя
+        self.assertEqual(threading.active_count(), threads_before)
+    
+    def test_source_error_reaches_consumer(self):
+        def items():
+            yield 1
+            raise OSError('read failed')
+        
+        with self.assertRaisesMessage(OSError, 'read failed'):
+            list(Pipeline([Stage('pass', lambda x: x)]).run(items()))
+    
+    def test_queues_bound_items_in_flight(self):
+        started = []
+        pipeline = Pipeline([Stage('first', started.append), Stage('second', lambda x: x)], queue_size=1)
+        results = pipeline.run(range(50))
+        next(results)
+        time.sleep(0.3)
+        in_flight = len(started)
+        results.close()
+        
+        # Потребитель не читает - вперед ушло не больше, чем помещается в
+        # очередях и потоках этапов
+        self.assertLessEqual(in_flight, 6)
+    
+    def test_thread_hooks(self):
+        calls = []
+        lock = threading.Lock()
+        
+        def hook(name):
+            with lock:
+                calls.append(name)
+        
+        pipeline = Pipeline(
+            [Stage('a', lambda x: x, workers=2)],
+            on_thread_start=lambda: hook('start'), on_thread_exit=lambda: hook('exit'),
+        )
+        list(pipeline.run(range(5)))
+        
+        # Поток подачи элементов и два потока этапа
+        self.assertEqual(calls.count('start'), 3)
+        self.assertEqual(calls.count('exit'), 3)
+
+
+class MetricsTests(TestCase):
+    def test_requires_token_or_staff(self):
+        # Адрес клиента (в т.ч. loopback прокси) доступа не дает
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'compressor_archive_build_seconds', response.content)
+        
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+    
+    def test_streamed_archive_is_observed(self):
+        def observed():
+            return REGISTRY.get_sample_value('compressor_archive_build_seconds_count') or 0
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'a.jpg'
+            path.write_bytes(jpeg_bytes())
+            before = observed()
+            stream = iter(ZipStream([path]))
+            next(stream)
+            # Прерванная отдача не учитывается
+            self.assertEqual(observed(), before)
+            list(stream)
+            self.assertEqual(observed(), before + 1)
+
+
+class ProfilingTests(SessionMixin, TestCase):
+    def test_enabled_by_session_or_user(self):
+        db_session, session_path = self.make_session()
+        self.assertFalse(profiling.is_enabled(db_session))
+        
+        ProfilingTarget.objects.create(user=self.user)
+        self.assertTrue(profiling.is_enabled(db_session))
+        
+        ProfilingTarget.objects.all().delete()
+        db_session.profiling = True
+        self.assertTrue(profiling.is_enabled(db_session))
+    
+    def test_reports_include_pipeline_threads(self):
+        def busy_stage(item):
+            return sum(range(1000))
+        
+        profiler = profiling.BatchProfiler(self.tmp)
+        with profiler:
+            pipeline = Pipeline(
+                [Stage('busy', busy_stage)],
+                on_thread_start=profiler.thread_start, on_thread_exit=profiler.thread_exit,
+            )
+            list(pipeline.run(range(3)))
+        
+        for name in profiling.PROFILE_FILES:
+            self.assertTrue((self.tmp / name).exists(), name)
+        self.assertIn('busy_stage', (self.tmp / 'profile.txt').read_text())
+        self.assertIn('Peak traced memory', (self.tmp / 'allocations.txt').read_text())
+    
+    def test_one_session_per_process(self):
+        first = self.tmp / 'first'
+        second = self.tmp / 'second'
+        first.mkdir()
+        second.mkdir()
+        
+        with profiling.BatchProfiler(first):
+            with profiling.BatchProfiler(second) as skipped:
+                self.assertFalse(skipped.active)
+        
+        self.assertTrue((first / 'profile.prof').exists())
+        self.assertFalse((second / 'profile.prof').exists())
+    
+    def test_admin_download(self):
+        db_session, session_path = self.make_session()
+        with profiling.BatchProfiler(session_path):
+            pass
+        
+        admin_user = User.objects.create_superuser('admin')
+        self.client.force_login(admin_user)
+        url = f'/admin/compressor/compressionsession/{db_session.pk}/profile/'
+        self.assertEqual(self.client.get(url + 'profile.txt/').status_code, 200)
+        self.assertEqual(self.client.get(url + 'results.json/').status_code, 404)
+
+
+class WorkerPoolTests(TempDirMixin, SimpleTestCase):
+    def test_worker_module_does_not_import_django(self):
+        code = 'import sys, compressor.worker_pool; print(sorted(m for m in sys.modules if m.startswith("django")))'
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=Path(__file__).resolve().parent.parent,
+            capture_output=True, text=True, check=True
+        ).stdout
+        self.assertEqual(output.strip(), '[]')
+    
+    def test_warm_up_without_image_init(self):
+        with mock.patch.object(Image, 'init') as init:
+            worker_pool.warm_up()
+        init.assert_not_called()
+    
+    def test_disabled_by_default_size(self):
+        self.assertIsNone(worker_pool.get_worker_pool(0, 200, 1024))
+    
+    def test_worker_replaced_after_max_tasks(self):
+        pool = worker_pool.WorkerPool(size=1, max_tasks=1, max_rss_mb=1024)
+        self.addCleanup(pool.shutdown)
+        first_pid = pool._workers[0].process.pid
+        
+        compressor = WebCompressor(self.tmp)
+        source = self.tmp / 'photo.jpg'
+        source.write_bytes(jpeg_bytes())
+        outcome = pool.compress(compressor, source)
+        
+        self.assertTrue(outcome['success'])
+        self.assertTrue((compressor.compressed_path / outcome['output_name']).exists())
+        self.assertNotEqual(pool._workers[0].process.pid, first_pid)
+
+
+class PresetTests(TempDirMixin, SimpleTestCase):
+    def analysis(self, size_mb, max_dimension):
+        return {'file_size_mb': size_mb, 'max_dimension': max_dimension, 'is_whatsapp': False}
+    
+    def test_preset_by_category(self):
+        compressor = WebCompressor(self.tmp)
+        self.assertEqual(compressor.determine_compression_category(self.analysis(12, 4000))['preset'], 'max')
+        self.assertEqual(compressor.determine_compression_category(self.analysis(0.1, 800))['preset'], 'balanced')
+        
+        compressor = WebCompressor(self.tmp, compression_settings={'preset': 'fast'})
+        self.assertEqual(compressor.determine_compression_category(self.analysis(12, 4000))['preset'], 'fast')
+    
+    def test_encoder_parameters(self):
+        compressor = WebCompressor(self.tmp)
+        image = Image.effect_noise((128, 128), 40).convert('RGB')
+        for preset in ('fast', 'max'):
+            compressor.save_jpeg(image, self.tmp / f'{preset}.jpg', 80, preset)
+        
+        with Image.open(self.tmp / 'fast.jpg') as fast, Image.open(self.tmp / 'max.jpg') as best:
+            self.assertNotIn('progressive', fast.info)
+            self.assertTrue(best.info.get('progressive'))
+            self.assertNotEqual(fast.quantization[0], best.quantization[0])
+    
+    def test_outcome_records_preset(self):
+        source = self.tmp / 'photo.jpg'
+        source.write_bytes(jpeg_bytes())
+        compressor = WebCompressor(self.tmp, compression_settings={'preset': 'fast'})
+        self.assertEqual(compressor.compress_file(source)['preset'], 'fast')
+
+
+class ContentAnalysisTests(TempDirMixin, SimpleTestCase):
+    def screenshot(self):
+        img = Image.new('RGB', (800, 600), 'white')
+        draw = ImageDraw.Draw(img)
+        for y in range(20, 580, 24):
+            draw.text((20, y), 'Settings  Network  Display  0123456789 ' * 2, fill='black')
+        draw.rectangle((500, 100, 700, 300), fill=(30, 90, 200))
+        return img
+    
+    def test_graphic_is_kept_lossless_when_smaller(self):
+        source = self.tmp / 'screen.png'
+        self.screenshot().save(source)
+        compressor = WebCompressor(self.tmp)
+        outcome = compressor.compress_file(source)
+        
+        self.assertEqual(outcome['output_name'], 'screen_compressed.png')
+        self.assertEqual(sorted(p.name for p in compressor.compressed_path.iterdir()), ['screen_compressed.png'])
+        with Image.open(compressor.compressed_path / outcome['output_name']) as result:
+            self.assertEqual(list(result.getdata()), list(self.screenshot().getdata()))
+    
+    def test_photo_stays_jpeg(self):
+        source = self.tmp / 'photo.png'
+        Image.effect_noise((400, 300), 60).convert('RGB').save(source)
+        outcome = WebCompressor(self.tmp).compress_file(source)
+        self.assertEqual(outcome['output_name'], 'photo_compressed.jpg')
+    
+    def test_jpeg_is_analysed_from_draft(self):
+        buffer = io.BytesIO()
+        self.screenshot().resize((2400, 1800)).save(buffer, 'JPEG')
+        with Image.open(buffer) as img:
+            analysis = analyze_content(img)
+            # draft уменьшил масштаб декодирования, полного кадра не было
+            self.assertLess(img.size[0], 2400)
+        self.assertIn('is_graphic', analysis)
+
+
+class SequenceTests(TempDirMixin, SimpleTestCase):
+    def make_compressor(self):
+        (self.tmp / 'uploads').mkdir()
+        return WebCompressor(self.tmp)
+    
+    def test_animation_is_resized_to_category(self):
+        compressor = self.make_compressor()
+        input_path = self.tmp / 'uploads' / 'anim.webp'
+        frames = [Image.new('RGB', (3200, 1600), (i * 60, 0, 0)) for i in range(3)]
+        frames[0].save(input_path, save_all=True, append_images=frames[1:], duration=[40, 50, 60])
+        
+        outcome = compressor.compress_file(input_path)
+        
+        self.assertTrue(outcome['success'])
+        self.assertEqual(outcome['frames'], 3)
+        with Image.open(compressor.compressed_path / outcome['output_name']) as result:
+            self.assertEqual(result.n_frames, 3)
+            self.assertLessEqual(max(result.size), 1200)
+            durations = []
+            for index in range(result.n_frames):
+                result.seek(index)
+                result.load()
+                durations.append(result.info['duration'])
+        self.assertEqual(durations, [40, 50, 60])
+    
+    def test_failed_page_removes_partial_outputs(self):
+        compressor = self.make_compressor()
+        input_path = self.tmp / 'uploads' / 'pages.tiff'
+        pages = [Image.new('RGB', (200, 100), (0, i * 60, 0)) for i in range(3)]
+        pages[0].save(input_path, save_all=True, append_images=pages[1:])
+        
+        write_jpeg = compressor.write_jpeg
+        
+        def fail_on_second_page(img, output_path, *args):
+            if '_p002' in output_path.name:
+                raise OSError('No space left on device')
+            return write_jpeg(img, output_path, *args)
+        
+        compressor.write_jpeg = fail_on_second_page
+        outcome = compressor.compress_file(input_path)
+        
+        self.assertFalse(outcome['success'])
+        self.assertEqual(list(compressor.compressed_path.iterdir()), [])
+
+
+class PreviewTests(SessionMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        db_session, self.session_path = self.make_session(outputs=['a_compressed.jpg'])
+        (self.session_path / 'results.json').write_text(json.dumps(
+            {'files': [{'name': 'a.jpg', 'output_name': 'a_compressed.jpg'}]}
+        ))
+        self.client.force_login(self.user)
+    
+    def url(self, kind, name='a.jpg'):
+        return f'/api/preview/{SESSION_ID}/{kind}/{name}'
+    
+    def test_built_on_demand_and_revalidated_by_etag(self):
+        response = self.client.get(self.url('after'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue((self.session_path / 'previews' / 'a.jpg.after.jpg').exists())
+        self.assertIn('private', response['Cache-Control'])
+        etag = response['ETag']
+        
+        response = self.client.get(self.url('after'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        
+        response = self.client.get(self.url('after'), HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_unavailable_previews(self):
+        # Исходник уже удален - превью "до" не построить
+        self.assertEqual(self.client.get(self.url('before')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('after', 'missing.jpg')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('sideways')).status_code, 404)
+    
+    def test_other_user_is_denied(self):
+        self.client.force_login(User.objects.create_user('stranger'))
+        self.assertEqual(self.client.get(self.url('after')).status_code, 403)
+
+
+def photo(size, seed=0):
+    """Цветное "фото" без плоских участков (не графика)"""
+    channels = [Image.effect_noise(size, 30 + 10 * (seed + i)).filter(ImageFilter.GaussianBlur(1)) for i in range(3)]
+    return Image.merge('RGB', channels)
+
+
+class EstimateTests(SessionMixin, TestCase):
+    def write_uploads(self, session_path):
+        uploads = session_path / 'uploads'
+        uploads.mkdir()
+        names = []
+        for i, size in enumerate([(640, 480), (1200, 900), (1800, 1350)]):
+            name = f'photo_{i}.jpg'
+            photo(size, i).save(uploads / name, quality=95)
+            names.append(name)
+        write_manifest(session_path, {'uploads': names, 'outputs': [], 'archives': []})
+        (session_path / 'meta.json').write_text(json.dumps({'compression_settings': {}}))
+        return [uploads / name for name in names]
+    
+    def test_estimate_is_close_to_compression(self):
+        db_session, session_path = self.make_session(status='uploaded')
+        paths = self.write_uploads(session_path)
+        
+        estimate = BatchEstimate(WebCompressor(session_path)).run(paths)
+        self.assertEqual(list((session_path / 'compressed').iterdir()), [])
+        
+        compressor = WebCompressor(session_path)
+        actual_mb = sum(compressor.compress_file(path)['compressed_mb'] for path in paths)
+        
+        self.assertEqual(estimate['errors'], [])
+        self.assertEqual([f['name'] for f in estimate['files']], [p.name for p in paths])
+        self.assertGreater(estimate['sampled_files'], 0)
+        self.assertLess(abs(estimate['total']['estimated_mb'] - actual_mb) / actual_mb, 0.5)
+    
+    def test_view_uses_posted_settings(self):
+        db_session, session_path = self.make_session(status='uploaded')
+        self.write_uploads(session_path)
+        self.client.force_login(self.user)
+        
+        response = self.client.post(f'/api/estimate/{SESSION_ID}/', {'settings': json.dumps({'preset': 'fast'})})
+        
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['compression_settings'], {'preset': 'fast'})
+        self.assertEqual({f['preset'] for f in data['files']}, {'fast'})
+        self.assertEqual(list((session_path / 'compressed').iterdir()), [])
+
+
+MB = 1024 * 1024
+
+
+@override_settings(STORAGE_QUOTA_MB=100, STORAGE_HIGH_WATERMARK=0.9, STORAGE_LOW_WATERMARK=0.7)
+class WatermarkTests(SessionMixin, TestCase):
+    def add_session(self, status, storage_mb, age_minutes=0, **fields):
+        db_session, session_path = self.make_session(
+            status=status, session_id=str(uuid.uuid4()), storage_bytes=storage_mb * MB, **fields
+        )
+        CompressionSession.objects.filter(pk=db_session.pk).update(
+            created_at=timezone.now() - timedelta(minutes=age_minutes)
+        )
+        return db_session, session_path
+    
+    def evicted(self):
+        return set(CompressionSession.objects.filter(evicted_at__isnull=False).values_list('session_id', flat=True))
+    
+    def test_below_high_watermark_nothing_is_evicted(self):
+        self.add_session('completed', 80)
+        self.assertEqual(storage.enforce_watermarks(), 0)
+        self.assertEqual(self.evicted(), set())
+    
+    def test_downloaded_then_oldest_completed_until_low_watermark(self):
+        old, old_path = self.add_session('completed', 30, age_minutes=30)
+        new, _ = self.add_session('completed', 30, age_minutes=10)
+        downloaded, _ = self.add_session('downloaded', 20, age_minutes=5, downloaded_at=timezone.now())
+        processing, _ = self.add_session('processing', 20, age_minutes=60)
+        
+        # 100 МБ из 100: вытеснение до 70 МБ - скачанная и самая старая
+        self.assertEqual(storage.enforce_watermarks(), 2)
+        self.assertEqual(self.evicted(), {downloaded.session_id, old.session_id})
+        self.assertFalse(old_path.exists())
+        old.refresh_from_db()
+        self.assertEqual(old.storage_bytes, 0)
+        self.assertEqual(storage.tracked_bytes(), 50 * MB)
+    
+    def test_record_usage_measures_session_directory(self):
+        db_session, session_path = self.add_session('completed', 0)
+        (session_path / 'compressed' / 'big.jpg').write_bytes(b'x' * MB)
+        
+        storage.record_usage(db_session, session_path)
+        
+        db_session.refresh_from_db()
+        self.assertGreaterEqual(db_session.storage_bytes, MB)
+        self.assertEqual(db_session.scratch_bytes, 0)
+
+
+class ResultsTests(SessionMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        db_session, _ = self.make_session()
+        for i in range(7):
+            CompressionFile.objects.create(
+                session=db_session, original_name=f'{i}.jpg', output_name=f'{i}_compressed.jpg',
+                original_size_mb=1.0, compressed_size_mb=1.0 - i / 10, savings_percent=i * 10,
+                category='A - Huge' if i % 2 else 'D - Small',
+            )
+        CompressionFile.objects.create(
+            session=db_session, original_name='broken.jpg', output_name='', original_size_mb=0,
+            compressed_size_mb=0, savings_percent=0, success=False, error='cannot identify image file',
+        )
+        self.client.force_login(self.user)
+    
+    def get(self, **params):
+        return self.client.get(f'/api/results/{SESSION_ID}/', params)
+    
+    def names(self, response):
+        return [file['name'] for file in response.json()['files']]
+    
+    def test_pages(self):
+        data = self.get(page_size=3, page=3).json()
+        self.assertEqual((data['count'], data['pages'], data['page']), (8, 3, 3))
+        self.assertEqual(self.names(self.get(page_size=3, page=3)), ['6.jpg', 'broken.jpg'])
+        # Номер за пределами - последняя страница
+        self.assertEqual(self.get(page_size=3, page=99).json()['page'], 3)
+        
+        with override_settings(RESULTS_MAX_PAGE_SIZE=2):
+            self.assertEqual(self.get(page_size=500).json()['pages'], 4)
+    
+    def test_filters_and_ordering(self):
+        self.assertEqual(self.names(self.get(category='A - Huge')), ['1.jpg', '3.jpg', '5.jpg'])
+        self.assertEqual(self.names(self.get(failed=1)), ['broken.jpg'])
+        self.assertEqual(self.names(self.get(failed=0, min_savings=30, max_savings=50)), ['3.jpg', '4.jpg', '5.jpg'])
+        self.assertEqual(self.names(self.get(failed=0, ordering='-savings'))[:2], ['6.jpg', '5.jpg'])
+    
+    def test_invalid_parameters(self):
+        self.assertEqual(self.get(min_savings='lots').status_code, 400)
+        self.assertEqual(self.get(ordering='mtime').status_code, 400)
+    
+    def test_other_user_is_denied(self):
+        self.client.force_login(User.objects.create_user('stranger'))
+        self.assertEqual(self.get().status_code, 403)
+
+
+class LoadTestTests(SimpleTestCase):
+    def run_session(self, final_status):
+        stats = loadtest.LoadStats()
+        client = loadtest.VirtualUser('127.0.0.1', 0, stats, timeout=5)
+        client.upload = mock.Mock(return_value=(SESSION_ID, 100))
+        responses = {
+            'compress': (200, b'{}'),
+            'status': (200, json.dumps({'stage': 'completed', 'results': final_status}).encode()),
+            'download': (200, 2048),
+        }
+        client.request = mock.Mock(side_effect=lambda method, path, *args, endpoint=None, **kwargs: responses[endpoint])
+        batch = loadtest.parse_batch('2x64x48')
+        return client.run_session(batch, {}, poll_interval=0, session_timeout=5), stats
+    
+    def test_completed_session(self):
+        completed, stats = self.run_session({'status': 'completed', 'successful': 2})
+        self.assertTrue(completed)
+        self.assertEqual(stats.files, 2)
+    
+    def test_failed_session_is_not_counted_as_completed(self):
+        # Статус сессии с ошибкой тоже отдает итоги и stage=completed
+        completed, stats = self.run_session({'status': 'error', 'error': 'Disk full'})
+        self.assertFalse(completed)
+        self.assertEqual(stats.sessions, [])
+        self.assertEqual(stats.error_samples['status'], ['Session failed: Disk full'])
+    
+    def test_in_process_mode_requires_debug(self):
+        with self.assertRaisesMessage(CommandError, 'DEBUG=True'):
+            call_command('loadtest', users=1, sessions=1)
+    
+    def test_batch_spec(self):
+        self.assertEqual(
+            loadtest.parse_batch('5x2400x1800:png@3'),
+            {'spec': '5x2400x1800:png', 'files': 5, 'size': (2400, 1800), 'format': 'png', 'weight': 3.0}
+        )
+        with self.assertRaises(CommandError):
+            loadtest.parse_batch('5x2400:gif')
+
+
+class StatusWriterTests(SessionMixin, TestCase):
+    def make_writer(self):
+        # Поток записи за время теста не просыпается - записи только явные
+        writer = StatusWriter(interval=3600)
+        self.addCleanup(writer.stop)
+        return writer
+    
+    def test_forget_writes_pending_progress(self):
+        db_session, session_path = self.make_session(status='processing')
+        writer = self.make_writer()
+        progress_file = session_path / 'progress.json'
+        writer.progress(db_session, 0, progress_file, {'progress': 50})
+        writer.progress(db_session, 0, progress_file, {'progress': 100})
+        self.assertFalse(progress_file.exists())
+        
+        writer.forget(db_session, 0)
+        
+        self.assertEqual(json.loads(progress_file.read_text())['progress'], 100)
+    
+    def test_stop_ends_thread_and_flushes(self):
+        db_session, _ = self.make_session(status='processing')
+        writer = self.make_writer()
+        self.assertTrue(writer.heartbeat(db_session, 0))
+        thread = writer._thread
+        
+        writer.stop()
+        
+        self.assertFalse(thread.is_alive())
+        db_session.refresh_from_db()
+        self.assertIsNotNone(db_session.heartbeat_at)
+        # Запуск 1 сессию не получал - его heartbeat отвергается
+        writer.heartbeat(db_session, 1)
+        writer.flush()
+        self.assertFalse(writer.heartbeat(db_session, 1))
+    
+    def test_completed_session_reports_full_progress(self):
+        db_session, session_path = self.make_session(status='processing')
+        (session_path / 'uploads').mkdir()
+        (session_path / 'uploads' / 'a.jpg').write_bytes(jpeg_bytes())
+        write_manifest(session_path, {'uploads': ['a.jpg'], 'outputs': [], 'archives': []})
+        (session_path / 'meta.json').write_text(json.dumps({'prefix': '', 'compression_settings': {}}))
+        
+        with mock.patch('compressor.tasks.get_status_writer', return_value=self.make_writer()):
+            run_compression(db_session, session_path, db_session.resume_count)
+        
+        db_session.refresh_from_db()
+        self.assertEqual(db_session.status, 'completed')
+        self.assertEqual(json.loads((session_path / 'progress.json').read_text())['progress'], 100)
+
+
+class ScratchTests(SessionMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.scratch = self.tmp / 'scratch'
+        scratch_settings = override_settings(
+            SCRATCH_ROOT=str(self.scratch), SCRATCH_BUDGET_MB=1, SCRATCH_GROWTH_FACTOR=1
+        )
+        scratch_settings.enable()
+        self.addCleanup(scratch_settings.disable)
+    
+    def test_budget_counts_reservations_of_all_processes(self):
+        first = storage.create_session_path(SESSION_ID, 600 * 1024)
+        self.assertTrue(storage.is_scratch(first))
+        # Резерв другого процесса виден через БД
+        self.assertFalse(storage.is_scratch(storage.create_session_path(OTHER_SESSION_ID, 600 * 1024)))
+        
+        storage.release_reservation(SESSION_ID)
+        self.assertTrue(storage.is_scratch(storage.create_session_path(str(uuid.uuid4()), 600 * 1024)))
+    
+    def test_expired_reservation_frees_budget(self):
+        storage.create_session_path(SESSION_ID, 600 * 1024)
+        ScratchReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        
+        self.assertTrue(storage.is_scratch(storage.create_session_path(OTHER_SESSION_ID, 600 * 1024)))
+        self.assertEqual(list(ScratchReservation.objects.values_list('session_id', flat=True)), [OTHER_SESSION_ID])
+    
+    def test_record_usage_replaces_reservation(self):
+        session_path = storage.create_session_path(SESSION_ID, 600 * 1024)
+        (session_path / 'a.jpg').write_bytes(b'x' * 1024)
+        db_session = CompressionSession.objects.create(user=self.user, session_id=SESSION_ID)
+        
+        storage.record_usage(db_session, session_path)
+        
+        self.assertFalse(ScratchReservation.objects.exists())
+        db_session.refresh_from_db()
+        self.assertEqual(db_session.scratch_bytes, 600 * 1024)
+        self.assertEqual(storage.scratch_bytes(), 600 * 1024)
+    
+    def make_scratch_session(self, files):
+        session_path = storage.create_session_path(SESSION_ID, 0)
+        (session_path / 'compressed').mkdir()
+        for name, size in files.items():
+            (session_path / name).write_bytes(b'x' * size)
+        db_session = CompressionSession.objects.create(user=self.user, session_id=SESSION_ID)
+        storage.release_reservation(SESSION_ID)
+        return db_session, session_path
+    
+    def test_spill_moves_one_file_at_a_time(self):
+        files = {f'compressed/{i}.jpg': 300 * 1024 for i in range(5)}
+        files['summary.json'] = 100
+        db_session, session_path = self.make_scratch_session(files)
+        total = storage.directory_bytes(session_path)
+        staging_path = storage.shard_path(self.tmp, SESSION_ID).parent / f'.{SESSION_ID}.spill'
+        peaks = []
+        move = storage.shutil.move
+        
+        def tracked_move(source, target):
+            result = move(source, target)
+            peaks.append(storage.directory_bytes(session_path) + storage.directory_bytes(staging_path))
+            return result
+        
+        with mock.patch('compressor.storage.shutil.move', side_effect=tracked_move):
+            disk_path = storage.spill_session(db_session, session_path)
+        
+        self.assertEqual(disk_path, storage.shard_path(self.tmp, SESSION_ID))
+        self.assertEqual(max(peaks), total)
+        self.assertFalse(session_path.exists())
+        self.assertEqual(storage.directory_bytes(disk_path), total)
+        self.assertEqual(get_session_path(SESSION_ID), disk_path)
+        db_session.refresh_from_db()
+        self.assertEqual(db_session.scratch_bytes, 0)
+    
+    def test_spill_completes_interrupted_move(self):
+        db_session, session_path = self.make_scratch_session({'compressed/a.jpg': 600 * 1024, 'compressed/b.jpg': 600 * 1024})
+        staging_path = storage.shard_path(self.tmp, SESSION_ID).parent / f'.{SESSION_ID}.spill'
+        (staging_path / 'compressed').mkdir(parents=True)
+        (session_path / 'compressed' / 'a.jpg').rename(staging_path / 'compressed' / 'a.jpg')
+        (session_path / 'compressed' / 'c.jpg').write_bytes(b'x' * 600 * 1024)
+        
+        disk_path = storage.spill_session(db_session, session_path)
+        
+        self.assertEqual(sorted(p.name for p in (disk_path / 'compressed').iterdir()), ['a.jpg', 'b.jpg', 'c.jpg'])
+    
+    def test_session_within_budget_stays(self):
+        db_session, session_path = self.make_scratch_session({'compressed/a.jpg': 1024})
+        self.assertEqual(storage.spill_session(db_session, session_path), session_path)
+        db_session.refresh_from_db()
+        self.assertGreater(db_session.scratch_bytes, 0)
+
+
+class NormalizeTests(SimpleTestCase):
+    def assertWhite(self, img):
+        self.assertEqual(img.getpixel((0, 0)), 255 if img.mode == 'L' else (255, 255, 255))
+    
+    def test_mode_matrix(self):
+        size = (8, 6)
+        palette = Image.new('RGB', size, (10, 20, 30)).convert('P')
+        transparent_palette = palette.copy()
+        transparent_palette.info['transparency'] = transparent_palette.getpixel((0, 0))
+        
+        cases = {
+            'RGB': (Image.new('RGB', size, (1, 2, 3)), 'RGB'),
+            'L': (Image.new('L', size, 7), 'L'),
+            'CMYK': (Image.new('CMYK', size, (0, 0, 0, 0)), 'RGB'),
+            'RGBA': (Image.new('RGBA', size, (0, 0, 0, 0)), 'RGB'),
+            'LA': (Image.new('LA', size, (0, 0)), 'L'),
+            'P': (palette, 'RGB'),
+            'P+transparency': (transparent_palette, 'RGB'),
+            'PA': (Image.new('PA', size), 'RGB'),
+            '1': (Image.new('1', size, 1), 'L'),
+            'I;16': (Image.new('I;16', size, 4095), 'L'),
+            'I': (Image.new('I', size, 70000), 'L'),
+            'F': (Image.new('F', size, 3.0), 'L'),
+            'YCbCr': (Image.new('YCbCr', size), 'RGB'),
+        }
+        for name, (img, expected) in cases.items():
+            with self.subTest(mode=name):
+                result = to_output_mode(img)
+                self.assertEqual(result.mode, expected)
+                self.assertEqual(result.size, size)
+    
+    def test_transparent_pixels_become_white(self):
+        self.assertWhite(to_output_mode(Image.new('RGBA', (4, 4), (0, 0, 0, 0))))
+        self.assertWhite(to_output_mode(Image.new('LA', (4, 4), (0, 0))))
+    
+    def test_opaque_alpha_keeps_colors(self):
+        result = to_output_mode(Image.new('RGBA', (4, 4), (10, 20, 30, 255)))
+        self.assertEqual(result.getpixel((0, 0)), (10, 20, 30))
+    
+    def test_high_bit_depth_is_scaled_by_container(self):
+        # 16-битный контейнер: 65535 - белый, 1000 - почти черный
+        img = Image.new('I;16', (4, 4), 1000)
+        img.putpixel((0, 0), 65535)
+        result = to_output_mode(img)
+        self.assertEqual(result.getpixel((1, 1)), 3)
+        self.assertEqual(result.getpixel((0, 0)), 255)
+        
+        self.assertEqual(to_output_mode(Image.new('I', (4, 4), 2 ** 31 - 1)).getpixel((0, 0)), 255)
+        self.assertEqual(to_output_mode(Image.new('I', (4, 4), -5)).getpixel((0, 0)), 0)
+    
+    def test_float_images(self):
+        # Нормированные данные 0..1 не чернеют
+        self.assertEqual(to_output_mode(Image.new('F', (4, 4), 0.5)).getpixel((0, 0)), 128)
+        self.assertEqual(to_output_mode(Image.new('F', (4, 4), 1.0)).getpixel((0, 0)), 255)
+        self.assertEqual(to_output_mode(Image.new('F', (4, 4), 300.0)).getpixel((0, 0)), 255)
+        self.assertEqual(to_output_mode(Image.new('F', (4, 4), 3.0)).getpixel((0, 0)), 3)
+
+
+class MetadataTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        exif = Image.Exif()
+        exif[ExifTags.Base.Make] = 'Camera'
+        exif[ExifTags.Base.Model] = 'X100'
+        exif[ExifTags.Base.Orientation] = 1
+        exif[ExifTags.IFD.Exif] = {ExifTags.Base.DateTimeOriginal: '2024:05:01 10:00:00'}
+        exif[ExifTags.IFD.GPSInfo] = {ExifTags.GPS.GPSLatitudeRef: 'N'}
+        self.icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        self.source = self.tmp / 'photo.jpg'
+        photo((320, 240)).save(self.source, quality=95, exif=exif, icc_profile=self.icc_profile)
+    
+    def compress(self, policy):
+        compressor = WebCompressor(self.tmp, compression_settings={'metadata': policy})
+        outcome = compressor.compress_file(self.source)
+        with Image.open(compressor.compressed_path / outcome['output_name']) as result:
+            return outcome, result.info.get('icc_profile'), result.getexif()
+    
+    def test_strip_and_srgb_remove_everything(self):
+        for policy in ('strip', 'srgb'):
+            with self.subTest(policy=policy):
+                outcome, icc_profile, exif = self.compress(policy)
+                self.assertIsNone(icc_profile)
+                self.assertEqual(len(exif), 0)
+                self.assertGreater(outcome['metadata_saved_bytes'], len(self.icc_profile))
+    
+    def test_icc_keeps_profile_only(self):
+        outcome, icc_profile, exif = self.compress('icc')
+        self.assertEqual(icc_profile, self.icc_profile)
+        self.assertEqual(len(exif), 0)
+    
+    def test_exif_keeps_minimal_tags(self):
+        outcome, icc_profile, exif = self.compress('exif')
+        self.assertEqual(icc_profile, self.icc_profile)
+        self.assertEqual((exif[ExifTags.Base.Make], exif[ExifTags.Base.Model]), ('Camera', 'X100'))
+        self.assertEqual(exif.get_ifd(ExifTags.IFD.Exif)[ExifTags.Base.DateTimeOriginal], '2024:05:01 10:00:00')
+        self.assertNotIn(ExifTags.Base.Orientation, exif)
+        self.assertEqual(exif.get_ifd(ExifTags.IFD.GPSInfo), {})
+    
+    def test_unknown_policy_falls_back_to_default(self):
+        self.assertEqual(WebCompressor(self.tmp, compression_settings={'metadata': 'all'}).metadata_policy, 'srgb')
+
+
+class ManifestTests(TempDirMixin, SimpleTestCase):
+    def test_scan_without_manifest(self):
+        session_path = self.tmp / 'session'
+        (session_path / 'uploads').mkdir(parents=True)
+        (session_path / 'compressed').mkdir()
+        (session_path / 'uploads' / 'b.jpg').write_bytes(b'b')
+        (session_path / 'uploads' / 'a.jpg').write_bytes(b'a')
+        (session_path / 'compressed' / 'a_compressed.jpg').write_bytes(b'c')
+        
+        self.assertEqual(read_manifest(session_path), {
+            'uploads': ['a.jpg', 'b.jpg'],
+            'outputs': ['a_compressed.jpg'],
+            'archives': [],
+        })
+        self.assertEqual(
+            artifact_paths(session_path, 'outputs'), [session_path / 'compressed' / 'a_compressed.jpg']
+        )
+    
+    def test_manifest_takes_precedence(self):
+        session_path = self.tmp / 'session'
+        (session_path / 'uploads').mkdir(parents=True)
+        (session_path / 'uploads' / 'stray.jpg').write_bytes(b'x')
+        write_manifest(session_path, {'uploads': ['a.jpg'], 'outputs': [], 'archives': []})
+        
+        self.assertTrue((session_path / MANIFEST_FILE).exists())
+        self.assertEqual(artifact_paths(session_path, 'uploads'), [session_path / 'uploads' / 'a.jpg'])
+    
+    def test_unsharded_session_is_found(self):
+        session_id = OTHER_SESSION_ID
+        with override_settings(TEMP_ROOT=str(self.tmp), SCRATCH_ROOT=''):
+            self.assertEqual(get_session_path(session_id), shard_path(self.tmp, session_id))
+            (self.tmp / session_id).mkdir()
+            self.assertEqual(get_session_path(session_id), self.tmp / session_id)
@@ -2,8 +2,12 @@
 URL маршруты для compressor app
 """
 
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# Под ASGI опрос статуса и скачивание обслуживают async views
+api_views = async_views if settings.ASYNC_API else views
 
 app_name = 'compressor'
 
@@ -18,9 +22,17 @@ urlpatterns = [
     
     # API
     path('api/upload/', views.upload_files, name='upload'),
+    path('api/bulk/', views.bulk_compress, name='bulk'),
+    path('api/estimate/<str:session_id>/', views.estimate_compression, name='estimate'),
     path('api/compress/<str:session_id>/', views.compress_images, name='compress'),
-    path('api/status/<str:session_id>/', views.get_status, name='status'),
-    path('api/download/<str:session_id>/', views.download_archive, name='download'),
-    path('api/summary/<str:session_id>/', views.get_summary, name='summary'),
+    path('api/status/<str:session_id>/', api_views.get_status, name='status'),
+    path('api/download/<str:session_id>/', api_views.download_archive, name='download'),
+    path('api/download/<str:session_id>/stream/', api_views.download_stream, name='download_stream'),
+    path('api/summary/<str:session_id>/', api_views.get_summary, name='summary'),
+    path('api/results/<str:session_id>/', views.get_results, name='results'),
+    path('api/preview/<str:session_id>/<str:kind>/<str:file_name>', views.get_preview, name='preview'),
     path('api/session/<str:session_id>/cancel/', views.cancel_session, name='cancel_session'),
+    
+    # Monitoring
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -3,22 +3,40 @@ Views для веб-сервиса сжатия изображений с авт
 """
 
 from django.shortcuts import render, redirect
-from django.http import JsonResponse, FileResponse, HttpResponse
+from django.http import JsonResponse, FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.conf import settings
 from django.utils import timezone
+from django.urls import reverse
+from django.core.paginator import Paginator
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connections
 from pathlib import Path
+import tarfile
+import zipfile
 import uuid
+import hmac
 import json
-import threading
 import os
 import shutil
 
+from . import metrics
+from .bulk import ImageArchive, stream_compressed_zip
 from .compressor_engine import WebCompressor
-from .models import CompressionSession, CompressionFile
+from .estimation import BatchEstimate
+from .zip_stream import ZIP_MAX_ENTRIES, ZipLimitError, ZipStream, aiter_sync
+from .models import CompressionSession
+from .scheduler import get_scheduler
+from .manifest import artifact_paths, write_manifest
+from .storage import create_session_path, get_session_path, record_usage, release_reservation
+from .worker_pool import get_worker_pool
+from .tasks import (
+    start_compression, is_stale, resume_session, request_cancel,
+    finalize_results, save_session_results, read_checkpoint, read_summary
+)
 
 
 def login_view(request):
@@ -106,13 +124,14 @@ def upload_files(request):
         
         # Создаем сессию
         session_id = str(uuid.uuid4())
-        session_path = Path(settings.TEMP_ROOT) / session_id
+        session_path = create_session_path(session_id, sum(file.size for file in files))
         uploads_path = session_path / 'uploads'
         uploads_path.mkdir(parents=True, exist_ok=True)
         
         # Валидация и сохранение файлов
         allowed_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
         file_list = []
+        upload_names = []
         
         for file in files:
             ext = Path(file.name).suffix.lower()
@@ -134,6 +153,7 @@ def upload_files(request):
             with open(filepath, 'wb+') as destination:
                 for chunk in file.chunks():
                     destination.write(chunk)
+            upload_names.append(safe_filename)
             
             file_list.append({
                 'name': file.name,
@@ -166,6 +186,11 @@ def upload_files(request):
         with open(session_path / 'meta.json', 'w') as f:
             json.dump(session_meta, f, indent=2)
         
+        # Одинаковые безопасные имена - один файл (последний записанный)
+        write_manifest(session_path, {'uploads': list(dict.fromkeys(upload_names)), 'outputs': [], 'archives': []})
+        
+        record_usage(db_session, session_path)
+        
         return JsonResponse({
             'session_id': session_id,
             'uploaded_count': len(file_list),
@@ -177,6 +202,164 @@ def upload_files(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@csrf_exempt
+@login_required
+@require_http_methods(["POST"])
+def bulk_compress(request):
+    """
+    Пакетное сжатие: ZIP/TAR архив с изображениями -> ZIP со сжатыми файлами.
+    
+    Небольшие архивы обрабатываются сразу, результат отдается потоком по мере
+    сжатия файлов. Большие (или mode=job) запускаются как обычная сессия:
+    ответ 202 с session_id, дальше status/download API.
+    Лимит MAX_FILES_COUNT здесь не действует; изображений в архиве - меньше
+    ZIP_MAX_ENTRIES (результат без Zip64).
+    """
+    session_path = None
+    try:
+        upload = request.FILES.get('archive')
+        prefix = request.POST.get('prefix', '').strip()
+        mode = request.POST.get('mode', 'auto')
+        
+        try:
+            compression_settings = json.loads(request.POST.get('settings', '{}'))
+        except:
+            compression_settings = {}
+        
+        if not upload:
+            return JsonResponse({'error': 'No archive uploaded'}, status=400)
+        
+        if upload.size > settings.BULK_MAX_UPLOAD_SIZE:
+            return JsonResponse({
+                'error': f'Archive exceeds {settings.BULK_MAX_UPLOAD_SIZE // (1024*1024)}MB limit'
+            }, status=400)
+        
+        session_id = str(uuid.uuid4())
+        session_path = create_session_path(session_id, upload.size)
+        
+        source_path = session_path / 'source.archive'
+        with open(source_path, 'wb+') as destination:
+            for chunk in upload.chunks():
+                destination.write(chunk)
+        
+        try:
+            archive = ImageArchive(source_path, settings.MAX_UPLOAD_SIZE)
+        except (ValueError, zipfile.BadZipFile, tarfile.TarError) as e:
+            shutil.rmtree(session_path, ignore_errors=True)
+            release_reservation(session_id)
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        # Результат - ZIP без Zip64 (ZipStream в job-режиме): не больше
+        # ZIP_MAX_ENTRIES записей, одна из них - results.json потокового режима
+        if len(archive) >= ZIP_MAX_ENTRIES:
+            archive.close()
+            shutil.rmtree(session_path, ignore_errors=True)
+            release_reservation(session_id)
+            return JsonResponse({'error': f'Archive exceeds {ZIP_MAX_ENTRIES - 1} images limit'}, status=400)
+        
+        if not len(archive):
+            archive.close()
+            shutil.rmtree(session_path, ignore_errors=True)
+            release_reservation(session_id)
+            return JsonResponse({'error': 'No supported images in archive'}, status=400)
+        
+        db_session = CompressionSession(
+            user=request.user,
+            session_id=session_id,
+            prefix=prefix,
+            archive_name=prefix if prefix else 'Archive',
+            files_count=len(archive),
+            compression_quality=compression_settings.get('quality'),
+            compression_max_dimension=compression_settings.get('max_dimension'),
+            compression_no_resize=compression_settings.get('no_resize', False)
+        )
+        
+        use_job = mode == 'job' or (mode != 'stream' and (
+            len(archive) > settings.BULK_STREAM_MAX_FILES or upload.size > settings.BULK_STREAM_MAX_SIZE
+        ))
+        
+        if not use_job:
+            archive_name = WebCompressor.sanitize_archive_name(db_session.archive_name)
+            response = StreamingHttpResponse(
+                streaming_content(request, bulk_stream(db_session, session_path, archive, compression_settings)),
+                content_type='application/zip'
+            )
+            response['Content-Disposition'] = f'attachment; filename="{archive_name}.zip"'
+            return response
+        
+        archive.close()
+        
+        db_session.status = 'processing'
+        db_session.heartbeat_at = timezone.now()
+        db_session.save()
+        
+        session_meta = {
+            'session_id': session_id,
+            'prefix': prefix,
+            'compression_settings': compression_settings,
+            'source_archive': source_path.name,
+            'status': 'processing'
+        }
+        with open(session_path / 'meta.json', 'w') as f:
+            json.dump(session_meta, f, indent=2)
+        
+        record_usage(db_session, session_path)
+        start_compression(db_session, session_path)
+        
+        return JsonResponse({
+            'session_id': session_id,
+            'mode': 'job',
+            'files_count': db_session.files_count,
+            'status_url': reverse('compressor:status', args=[session_id]),
+            'download_url': reverse('compressor:download', args=[session_id])
+        }, status=202)
+        
+    except Exception as e:
+        if session_path is not None:
+            shutil.rmtree(session_path, ignore_errors=True)
+            release_reservation(session_id)
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+def bulk_stream(db_session, session_path, archive, compression_settings):
+    """
+    Генератор ответа bulk_compress: сжатие и отдача ZIP по одному файлу.
+    
+    Под ASGI каждая часть готовится в потоке из пула (streaming_content),
+    поэтому соединения с БД этого потока закрываются в конце.
+    """
+    scheduler = get_scheduler()
+    finished = False
+    try:
+        compressor = WebCompressor(
+            session_path,
+            prefix=db_session.prefix,
+            compression_settings=compression_settings
+        )
+        compressor.slot_gate = lambda finishing=False: scheduler.slot(db_session.session_id, finishing=finishing)
+        compressor.worker_pool = get_worker_pool(
+            settings.WORKER_POOL_SIZE, settings.WORKER_MAX_TASKS, settings.WORKER_MAX_RSS_MB
+        )
+        scheduler.register(db_session.session_id, db_session.user_id, len(archive))
+        
+        results = compressor.new_results()
+        yield from stream_compressed_zip(compressor, archive, session_path / 'uploads', results)
+        finished = True
+        
+        finalize_results(results)
+        save_session_results(db_session, results)
+        db_session.mark_as_downloaded()
+    finally:
+        # Сюда же попадаем при обрыве соединения клиентом
+        scheduler.unregister(db_session.session_id)
+        archive.close()
+        shutil.rmtree(session_path, ignore_errors=True)
+        release_reservation(db_session.session_id)
+        connections.close_all()
+        if not finished:
+            print(f"Bulk stream {db_session.session_id} aborted")
+
+
 @csrf_exempt
 @login_required
 @require_http_methods(["POST"])
@@ -189,7 +372,7 @@ def compress_images(request, session_id):
             user=request.user
         )
         
-        session_path = Path(settings.TEMP_ROOT) / session_id
+        session_path = get_session_path(session_id)
         
         if not session_path.exists():
             return JsonResponse({'error': 'Session not found'}, status=404)
@@ -202,10 +385,24 @@ def compress_images(request, session_id):
             meta = json.load(f)
         
         if db_session.status == 'processing':
+            # Прерванная обработка продолжается с чекпоинта
+            if is_stale(db_session) and resume_session(db_session):
+                return JsonResponse({'status': 'resumed', 'message': 'Compression resumed'})
             return JsonResponse({'error': 'Already processing'}, status=400)
         
+        # Настройки, подобранные после загрузки (api/estimate/)
+        if 'settings' in request.POST:
+            try:
+                meta['compression_settings'] = json.loads(request.POST['settings'])
+            except:
+                return JsonResponse({'error': 'Invalid settings'}, status=400)
+            db_session.compression_quality = meta['compression_settings'].get('quality')
+            db_session.compression_max_dimension = meta['compression_settings'].get('max_dimension')
+            db_session.compression_no_resize = meta['compression_settings'].get('no_resize', False)
+        
         # Обновляем статус
         db_session.status = 'processing'
+        db_session.heartbeat_at = timezone.now()
         db_session.save()
         
         meta['status'] = 'processing'
@@ -213,93 +410,7 @@ def compress_images(request, session_id):
             json.dump(meta, f, indent=2)
         
         # Запускаем сжатие в отдельном потоке
-        def compress_task():
-            try:
-                compressor = WebCompressor(
-                    session_path,
-                    prefix=meta['prefix'],
-                    compression_settings=meta['compression_settings']
-                )
-                
-                def progress_update(data):
-                    progress_file = session_path / 'progress.json'
-                    with open(progress_file, 'w') as f:
-                        json.dump(data, f, indent=2)
-                
-                compressor.progress_callback = progress_update
-                
-                uploads_path = session_path / 'uploads'
-                files = list(uploads_path.glob('*'))
-                
-                if not files:
-                    raise Exception("No files to compress")
-                
-                # Сжимаем
-                results = compressor.compress_batch(files)
-                
-                # Создаем архив
-                archive_name = meta['prefix'] if meta['prefix'] else 'Archive'
-                archive_path = compressor.create_archive(archive_name)
-                
-                results['archive_name'] = archive_path.name
-                results['archive_size_mb'] = round(archive_path.stat().st_size / (1024*1024), 2)
-                results['status'] = 'completed'
-                
-                for cat, stats in results['categories'].items():
-                    if stats['orig'] > 0:
-                        stats['savings'] = round((1 - stats['comp'] / stats['orig']) * 100, 1)
-                
-                with open(session_path / 'results.json', 'w') as f:
-                    json.dump(results, f, indent=2)
-                
-                # Обновляем БД
-                db_session.status = 'completed'
-                db_session.files_successful = results['successful']
-                db_session.files_failed = results['failed']
-                db_session.total_original_mb = round(results['total_original_mb'], 2)
-                db_session.total_compressed_mb = round(results['total_compressed_mb'], 2)
-                
-                if results['total_original_mb'] > 0:
-                    db_session.savings_percent = round(
-                        (1 - results['total_compressed_mb'] / results['total_original_mb']) * 100, 1
-                    )
-                
-                db_session.completed_at = timezone.now()
-                db_session.save()
-                
-                # Сохраняем информацию о файлах
-                for file_info in results['files']:
-                    CompressionFile.objects.create(
-                        session=db_session,
-                        original_name=file_info['name'],
-                        output_name=file_info['output_name'],
-                        original_size_mb=file_info['original_mb'],
-                        compressed_size_mb=file_info['compressed_mb'],
-                        savings_percent=file_info['savings'],
-                        category=file_info.get('category', '')
-                    )
-                
-                meta['status'] = 'completed'
-                with open(meta_file, 'w') as f:
-                    json.dump(meta, f, indent=2)
-                    
-            except Exception as e:
-                error_data = {'status': 'error', 'error': str(e)}
-                with open(session_path / 'results.json', 'w') as f:
-                    json.dump(error_data, f, indent=2)
-                
-                db_session.status = 'error'
-                db_session.error_message = str(e)
-                db_session.save()
-                
-                meta['status'] = 'error'
-                meta['error'] = str(e)
-                with open(meta_file, 'w') as f:
-                    json.dump(meta, f, indent=2)
-        
-        thread = threading.Thread(target=compress_task)
-        thread.daemon = True
-        thread.start()
+        start_compression(db_session, session_path)
         
         return JsonResponse({'status': 'started', 'message': 'Compression started'})
         
@@ -309,6 +420,48 @@ def compress_images(request, session_id):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@csrf_exempt
+@login_required
+@require_http_methods(["POST"])
+def estimate_compression(request, session_id):
+    """Прогноз размера и времени сжатия загруженных файлов (без сжатия)"""
+    try:
+        db_session = CompressionSession.objects.get(
+            session_id=session_id,
+            user=request.user
+        )
+        
+        session_path = get_session_path(session_id)
+        uploads_path = session_path / 'uploads'
+        meta_file = session_path / 'meta.json'
+        if not uploads_path.exists() or not meta_file.exists():
+            return JsonResponse({'error': 'Session files not found'}, status=404)
+        
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        
+        # Настройки для прогноза; без них - настройки загрузки
+        if 'settings' in request.POST:
+            try:
+                compression_settings = json.loads(request.POST['settings'])
+            except:
+                compression_settings = {}
+        else:
+            compression_settings = meta.get('compression_settings', {})
+        
+        compressor = WebCompressor(session_path, prefix=db_session.prefix, compression_settings=compression_settings)
+        parallelism = min(get_scheduler().slots, settings.COMPRESSION_SLOTS_PER_USER)
+        estimate = BatchEstimate(compressor, parallelism).run(artifact_paths(session_path, 'uploads'))
+        estimate['compression_settings'] = compression_settings
+        
+        return JsonResponse(estimate)
+        
+    except CompressionSession.DoesNotExist:
+        return JsonResponse({'error': 'Session not found or access denied'}, status=404)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
 @login_required
 @require_http_methods(["GET"])
 def get_status(request, session_id):
@@ -320,7 +473,10 @@ def get_status(request, session_id):
             user=request.user
         )
         
-        session_path = Path(settings.TEMP_ROOT) / session_id
+        if db_session.status == 'canceled':
+            return JsonResponse({'progress': 0, 'stage': 'canceled'})
+        
+        session_path = get_session_path(session_id)
         
         if not session_path.exists():
             return JsonResponse({'error': 'Session not found'}, status=404)
@@ -332,11 +488,15 @@ def get_status(request, session_id):
         else:
             progress_data = {'progress': 0, 'stage': 'waiting'}
         
-        results_file = session_path / 'results.json'
-        if results_file.exists():
-            with open(results_file, 'r') as f:
-                results = json.load(f)
-            progress_data['results'] = results
+        # Обработка прервана (heartbeat просрочен): возобновит cron
+        # reset_stuck_sessions или POST api/compress/, а не опрос статуса
+        if is_stale(db_session):
+            progress_data['stalled'] = True
+        
+        # Только итоги - записи по файлам отдает api/results/
+        summary = read_summary(session_path)
+        if summary is not None:
+            progress_data['results'] = summary
             progress_data['stage'] = 'completed'
         
         return JsonResponse(progress_data)
@@ -357,15 +517,12 @@ def download_archive(request, session_id):
             user=request.user
         )
         
-        session_path = Path(settings.TEMP_ROOT) / session_id
-        archives_path = session_path / 'archives'
-        
-        if not archives_path.exists():
-            return HttpResponse('Archive not found', status=404)
+        session_path = get_session_path(session_id)
         
-        archives = list(archives_path.glob('*.zip'))
+        archives = artifact_paths(session_path, 'archives')
         if not archives:
-            return HttpResponse('Archive not found', status=404)
+            # Архив не собирался - отдаем сжатые файлы потоком
+            return stream_archive_response(request, db_session, session_path)
         
         archive_path = archives[0]
         
@@ -385,6 +542,57 @@ def download_archive(request, session_id):
         return HttpResponse(f'Error: {str(e)}', status=500)
 
 
+def streaming_content(request, iterator):
+    """
+    Содержимое StreamingHttpResponse: под ASGI - асинхронный итератор
+    (синхронный Django буферизует целиком до первого байта ответа)
+    """
+    if isinstance(request, ASGIRequest):
+        return aiter_sync(iter(iterator))
+    return iterator
+
+
+def stream_archive_response(request, db_session, session_path):
+    """Ответ с ZIP архивом, собираемым на лету из сжатых файлов"""
+    files = artifact_paths(session_path, 'outputs')
+    if not files:
+        if db_session.evicted_at:
+            return HttpResponse('Archive was removed to free disk space', status=410)
+        return HttpResponse('Archive not found', status=404)
+    
+    try:
+        stream = ZipStream(files)
+    except ZipLimitError as e:
+        return HttpResponse(str(e), status=400)
+    archive_name = WebCompressor.sanitize_archive_name(db_session.archive_name)
+    
+    db_session.mark_as_downloaded()
+    
+    response = StreamingHttpResponse(streaming_content(request, stream), content_type='application/zip')
+    response['Content-Length'] = str(stream.content_length())
+    response['Content-Disposition'] = f'attachment; filename="{archive_name}.zip"'
+    return response
+
+
+@login_required
+@require_http_methods(["GET"])
+def download_stream(request, session_id):
+    """Скачать архив потоком, без сборки на диске"""
+    try:
+        db_session = CompressionSession.objects.get(
+            session_id=session_id,
+            user=request.user
+        )
+        
+        session_path = get_session_path(session_id)
+        return stream_archive_response(request, db_session, session_path)
+        
+    except CompressionSession.DoesNotExist:
+        return HttpResponse('Access denied', status=403)
+    except Exception as e:
+        return HttpResponse(f'Error: {str(e)}', status=500)
+
+
 @login_required
 @require_http_methods(["GET"])
 def get_summary(request, session_id):
@@ -395,16 +603,93 @@ def get_summary(request, session_id):
             user=request.user
         )
         
-        session_path = Path(settings.TEMP_ROOT) / session_id
-        results_file = session_path / 'results.json'
-        
-        if not results_file.exists():
+        summary = read_summary(get_session_path(session_id))
+        if summary is None:
             return JsonResponse({'error': 'Results not found'}, status=404)
         
-        with open(results_file, 'r') as f:
-            results = json.load(f)
+        return JsonResponse(summary)
+        
+    except CompressionSession.DoesNotExist:
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+# Сортировки списка файлов api/results/
+RESULTS_ORDERING = {
+    'name': 'original_name',
+    'savings': 'savings_percent',
+    'size': 'original_size_mb',
+    'compressed': 'compressed_size_mb',
+}
+
+
+@login_required
+@require_http_methods(["GET"])
+def get_results(request, session_id):
+    """
+    Результаты по файлам, постранично.
+    
+    Параметры: page, page_size (до RESULTS_MAX_PAGE_SIZE), category,
+    failed (1 - только необработанные, 0 - только сжатые), min_savings,
+    max_savings, ordering (name, savings, size, compressed; "-" - по убыванию).
+    """
+    try:
+        db_session = CompressionSession.objects.get(
+            session_id=session_id,
+            user=request.user
+        )
         
-        return JsonResponse(results)
+        files = db_session.files.all()
+        
+        category = request.GET.get('category')
+        if category:
+            files = files.filter(category=category)
+        
+        failed = request.GET.get('failed')
+        if failed in ('1', 'true'):
+            files = files.filter(success=False)
+        elif failed in ('0', 'false'):
+            files = files.filter(success=True)
+        
+        try:
+            if request.GET.get('min_savings'):
+                files = files.filter(savings_percent__gte=float(request.GET['min_savings']))
+            if request.GET.get('max_savings'):
+                files = files.filter(savings_percent__lte=float(request.GET['max_savings']))
+            page_size = min(int(request.GET.get('page_size', settings.RESULTS_PAGE_SIZE)), settings.RESULTS_MAX_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid filter value'}, status=400)
+        
+        ordering = request.GET.get('ordering', 'name')
+        field = RESULTS_ORDERING.get(ordering.lstrip('-'))
+        if field is None:
+            return JsonResponse({'error': f'Unknown ordering {ordering}'}, status=400)
+        files = files.order_by(f"-{field}" if ordering.startswith('-') else field, 'id')
+        
+        page = Paginator(files, max(1, page_size)).get_page(request.GET.get('page'))
+        
+        return JsonResponse({
+            'status': db_session.status,
+            'count': page.paginator.count,
+            'page': page.number,
+            'pages': page.paginator.num_pages,
+            'files': [
+                {
+                    'name': file.original_name,
+                    'output_name': file.output_name,
+                    'success': file.success,
+                    'error': file.error,
+                    'original_mb': file.original_size_mb,
+                    'compressed_mb': file.compressed_size_mb,
+                    'savings': file.savings_percent,
+                    'category': file.category,
+                    'preset': file.preset,
+                    'metadata_saved_bytes': file.metadata_saved_bytes,
+                }
+                for file in page
+            ]
+        })
         
     except CompressionSession.DoesNotExist:
         return JsonResponse({'error': 'Access denied'}, status=403)
@@ -412,14 +697,90 @@ def get_summary(request, session_id):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+@require_http_methods(["GET"])
+def get_preview(request, session_id, kind, file_name):
+    """Превью файла до/после сжатия (kind - before или after)"""
+    try:
+        db_session = CompressionSession.objects.get(
+            session_id=session_id,
+            user=request.user
+        )
+        
+        if kind not in ('before', 'after'):
+            return HttpResponse('Not found', status=404)
+        
+        session_path = get_session_path(session_id)
+        file_name = Path(file_name).name
+        preview_path = session_path / 'previews' / f"{file_name}.{kind}.jpg"
+        
+        if not preview_path.exists() and not build_preview(db_session, session_path, file_name, kind):
+            return HttpResponse('Preview not available', status=404)
+        
+        # Превью сессии не меняются - браузер может кэшировать их и
+        # перепроверять по ETag
+        stat = preview_path.stat()
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(preview_path, 'rb'), content_type='image/jpeg')
+        response['ETag'] = etag
+        response['Cache-Control'] = f'private, max-age={settings.PREVIEW_CACHE_SECONDS}'
+        return response
+        
+    except CompressionSession.DoesNotExist:
+        return HttpResponse('Access denied', status=403)
+    except Exception as e:
+        return HttpResponse(f'Error: {str(e)}', status=500)
+
+
+def build_preview(db_session, session_path, file_name, kind):
+    """
+    Создать превью по требованию (если при сжатии оно не создано).
+    
+    Превью "до" возможно, пока исходники не удалены (сессия не
+    завершена), превью "после" - пока есть результат сжатия.
+    """
+    outcome = read_checkpoint(session_path).get(file_name)
+    results_file = session_path / 'results.json'
+    if outcome is None and results_file.exists():
+        with open(results_file, 'r') as f:
+            files = json.load(f).get('files', [])
+        outcome = next((entry for entry in files if entry['name'] == file_name), None)
+    if not outcome or not outcome.get('output_name'):
+        return False
+    
+    if kind == 'before':
+        source_path = session_path / 'uploads' / file_name
+    else:
+        source_path = session_path / 'compressed' / outcome['output_name']
+    if not source_path.exists():
+        return False
+    
+    compressor = WebCompressor(session_path, prefix=db_session.prefix)
+    compressor.previews_path = session_path / 'previews'
+    compressor.write_preview(file_name, kind, compressor.preview_from_file(source_path))
+    return True
+
+
 @csrf_exempt
 @login_required
 @require_http_methods(["POST"])
 def cancel_session(request, session_id):
     """Отменить сессию: удалить временные файлы и запись в БД (если есть)"""
     try:
-        # Удалить папку сессии из TEMP_ROOT
-        session_path = Path(settings.TEMP_ROOT) / session_id
+        session_path = get_session_path(session_id)
+        
+        # Идет сжатие - останавливаем его, запись остается со статусом canceled
+        db_session = CompressionSession.objects.filter(
+            session_id=session_id, user=request.user, status='processing'
+        ).first()
+        if db_session:
+            request_cancel(db_session, session_path)
+            return JsonResponse({'status': 'canceled'})
+        
+        # Удалить папку сессии
         if session_path.exists() and session_path.is_dir():
             try:
                 shutil.rmtree(session_path)
@@ -435,4 +796,21 @@ def cancel_session(request, session_id):
 
         return JsonResponse({'status': 'canceled'})
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """
+    Метрики Prometheus: заголовок Authorization: Bearer METRICS_TOKEN или
+    staff. Адрес клиента не проверяется - за reverse proxy все запросы
+    приходят с адреса прокси.
+    """
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    has_token = bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+    if not has_token and not request.user.is_staff:
+        return HttpResponse('Access denied', status=403)
+    
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Пул заранее запущенных процессов сжатия.
+
+Процессы создаются через forkserver, в который этот модуль загружен
+заранее: каждый новый worker получает уже импортированный Pillow с
+нужными плагинами и не импортирует Django (параметры пула передаются
+аргументами get_worker_pool). Перед первым файлом worker прогревает
+кодеки, поэтому первый файл сессии не платит за холодный старт. Worker перезапускается после max_tasks файлов или
+при превышении лимита RSS.
+"""
+
+from pathlib import Path
+import io
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+
+from PIL import Image
+from PIL import BmpImagePlugin, JpegImagePlugin, PngImagePlugin, TiffImagePlugin, WebPImagePlugin  # noqa: F401
+
+from .compressor_engine import WebCompressor, CancellationToken, CompressionCanceled
+
+
+# Форматы, которые сервис принимает и отдает; плагины импортированы выше,
+# поэтому Image.init() (импорт всех плагинов Pillow) не нужен
+WARM_UP_FORMATS = ('JPEG', 'PNG', 'BMP', 'TIFF', 'WEBP')
+
+
+class WorkerCrashed(Exception):
+    """Процесс пула завершился, не вернув результат"""
+
+
+def warm_up():
+    """Прогреть кодеки: закодировать и декодировать маленькое изображение в каждом формате"""
+    sample = Image.new('RGB', (64, 64), (128, 128, 128))
+    for fmt in WARM_UP_FORMATS:
+        buffer = io.BytesIO()
+        sample.save(buffer, fmt)
+        buffer.seek(0)
+        with Image.open(buffer, formats=[fmt]) as img:
+            img.load()
+
+
+def current_rss():
+    """Текущий RSS процесса в байтах"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Нет /proc - пиковое значение (на Linux в КБ)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def compress_task(session_path, prefix, compression_settings, output_path, input_path, cancel_marker, previews_path):
+    """Сжать один файл (выполняется в процессе пула)"""
+    compressor = WebCompressor(session_path, prefix, compression_settings, output_path)
+    compressor.cancel_token = CancellationToken(cancel_marker)
+    compressor.previews_path = Path(previews_path) if previews_path else None
+    return compressor.compress_file(Path(input_path))
+
+
+def _worker_main(conn, max_tasks, max_rss_bytes):
+    warm_up()
+    tasks_done = 0
+    
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            return
+        
+        try:
+            reply = ('ok', compress_task(*args))
+        except CompressionCanceled:
+            reply = ('canceled', None)
+        except Exception as e:
+            reply = ('error', str(e))
+        
+        tasks_done += 1
+        retiring = tasks_done >= max_tasks or current_rss() > max_rss_bytes
+        conn.send(reply + (retiring,))
+        if retiring:
+            conn.close()
+            return
+
+
+class _Worker:
+    def __init__(self, ctx, max_tasks, max_rss_bytes):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, max_tasks, max_rss_bytes),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+    
+    def stop(self):
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class WorkerPool:
+    """
+    Процессы сжатия, которые живут между сессиями.
+    
+    compress() блокирует вызывающий поток до результата, поэтому пул
+    используется из потоков конвейера под слотами планировщика так же,
+    как сжатие в самом процессе. Свободные процессы ждут в очереди;
+    процесс, вышедший на покой (лимит задач или памяти) или упавший,
+    сразу заменяется новым.
+    """
+    
+    def __init__(self, size, max_tasks, max_rss_mb):
+        self.size = size
+        self.max_tasks = max_tasks
+        self.max_rss_bytes = max_rss_mb * 1024 * 1024
+        
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self._ctx = multiprocessing.get_context('forkserver')
+            self._ctx.set_forkserver_preload([__name__])
+        else:
+            self._ctx = multiprocessing.get_context('spawn')
+        
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+    
+    def _spawn(self):
+        worker = _Worker(self._ctx, self.max_tasks, self.max_rss_bytes)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+    
+    def _replace(self, worker):
+        with self._lock:
+            self._workers.remove(worker)
+        worker.stop()
+        return self._spawn()
+    
+    def compress(self, compressor, input_path):
+        """Сжать файл в свободном процессе пула; результат как у compress_file"""
+        cancel_marker = compressor.cancel_token.marker_path if compressor.cancel_token else None
+        args = (
+            str(compressor.session_path), compressor.prefix, compressor.compression_settings,
+            str(compressor.compressed_path), str(input_path),
+            str(cancel_marker) if cancel_marker else None,
+            str(compressor.previews_path) if compressor.previews_path else None
+        )
+        
+        worker = self._idle.get()
+        try:
+            worker.conn.send(args)
+            status, value, retiring = worker.conn.recv()
+        except (EOFError, OSError):
+            self._idle.put(self._replace(worker))
+            raise WorkerCrashed(f"Worker {worker.process.pid} died while compressing {Path(input_path).name}")
+        
+        self._idle.put(self._replace(worker) if retiring else worker)
+        
+        if status == 'canceled':
+            raise CompressionCanceled()
+        if status == 'error':
+            raise Exception(value)
+        return value
+    
+    def shutdown(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_worker_pool(size, max_tasks, max_rss_mb):
+    """
+    Пул процесса (создается при первом обращении, первая сессия ждет
+    запуска процессов); None, если size = 0 - пул отключен
+    """
+    global _pool
+    if not size:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(size=size, max_tasks=max_tasks, max_rss_mb=max_rss_mb)
+        return _pool
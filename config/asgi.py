@@ -5,6 +5,13 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+Запуск в ASGI-профиле (async API для статуса, итогов и скачивания):
+
+    ASYNC_API=True gunicorn config.asgi:application \
+        -k uvicorn.workers.UvicornWorker --workers 2
+
+ASYNC_API выставляется автоматически, если не задан явно.
 """
 
 import os
@@ -12,5 +19,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('ASYNC_API', 'True')
 
 application = get_asgi_application()
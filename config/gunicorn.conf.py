@@ -0,0 +1,34 @@
+"""
+Конфигурация gunicorn с поддержкой метрик Prometheus для нескольких worker'ов.
+
+    gunicorn config.wsgi:application -c config/gunicorn.conf.py
+
+Каждый worker пишет метрики в свои файлы в PROMETHEUS_MULTIPROC_DIR,
+/metrics в любом worker'е суммирует их. Каталог очищается при старте
+master-процесса, файлы завершившегося worker'а помечаются мертвыми.
+"""
+
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'temp', 'prometheus')
+)
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+
+def on_starting(server):
+    # Значения прошлого запуска не должны попасть в новые счетчики
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
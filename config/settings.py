@@ -66,6 +66,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+ASGI_APPLICATION = 'config.asgi.application'
+
+# Async версии status/summary/download (только при запуске через ASGI)
+ASYNC_API = os.environ.get('ASYNC_API', 'False') == 'True'
 
 
 # Database
@@ -75,6 +79,20 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # WAL: чтение статуса не ждет запись результатов, fsync только
+        # на контрольных точках журнала. IMMEDIATE берет блокировку записи
+        # в начале транзакции - без ошибки "database is locked" при
+        # повышении блокировки; timeout - сколько ждать чужую запись
+        'OPTIONS': {
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA cache_size=-16000'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -130,10 +148,104 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 TEMP_ROOT = os.path.join(BASE_DIR, 'temp', 'sessions')
 os.makedirs(TEMP_ROOT, exist_ok=True)
 
+# Небольшие сессии целиком в памяти (tmpfs): SCRATCH_BUDGET_MB на все такие
+# сессии, место под сессию - объем загрузки x SCRATCH_GROWTH_FACTOR
+# (сжатые файлы, архив, превью). Сессии больше бюджета - в TEMP_ROOT;
+# пустой SCRATCH_ROOT отключает
+SCRATCH_ROOT = os.environ.get('SCRATCH_ROOT', '/dev/shm/compressor-sessions' if os.path.isdir('/dev/shm') else '')
+SCRATCH_BUDGET_MB = int(os.environ.get('SCRATCH_BUDGET_MB', 256))
+SCRATCH_GROWTH_FACTOR = 3
+if SCRATCH_ROOT:
+    os.makedirs(SCRATCH_ROOT, exist_ok=True)
+
+# Объем временных файлов сессий: учитывается в БД, при заполнении больше
+# STORAGE_HIGH_WATERMARK емкости (STORAGE_QUOTA_MB, но не больше доступного
+# на диске) удаляются файлы скачанных, затем самых старых завершенных
+# сессий, пока не останется STORAGE_LOW_WATERMARK
+STORAGE_QUOTA_MB = int(os.environ.get('STORAGE_QUOTA_MB', 20 * 1024))
+STORAGE_HIGH_WATERMARK = 0.9
+STORAGE_LOW_WATERMARK = 0.7
+
 # Лимиты загрузки
 MAX_UPLOAD_SIZE = 100 * 1024 * 1024  # 100MB
 MAX_FILES_COUNT = 30
 
+# Пакетная загрузка архивом (api/bulk/): общий лимит размера архива и порог,
+# до которого результат отдается потоком в том же запросе
+BULK_MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
+BULK_STREAM_MAX_FILES = 50
+BULK_STREAM_MAX_SIZE = 200 * 1024 * 1024  # 200MB
+
+# Heartbeat обработки: сжимающий процесс обновляет его раз в
+# HEARTBEAT_INTERVAL секунд (отдельным потоком), сессия без обновления
+# три интервала подряд считается прерванной; сколько раз ее можно
+# возобновить с чекпоинта
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+SESSION_MAX_RESUMES = 3
+
+# Heartbeat и прогресс сжимающих потоков копятся в памяти и пишутся раз в
+# STATUS_FLUSH_SECONDS: heartbeat - одной транзакцией БД, прогресс - последнее
+# состояние в progress.json (0 - сразу при каждом обновлении). Конечные
+# состояния сессии пишутся сразу
+STATUS_FLUSH_SECONDS = float(os.environ.get('STATUS_FLUSH_SECONDS', 2))
+
+# Планировщик сжатия (в пределах одного процесса): число одновременно
+# сжимаемых файлов, лимит на пользователя и размер "маленького" батча,
+# который получает приоритет. Лимиты не общие для процессов: при N
+# воркерах gunicorn у пользователя до N x COMPRESSION_SLOTS_PER_USER слотов
+COMPRESSION_SLOTS = int(os.environ.get('COMPRESSION_SLOTS', os.cpu_count() or 1))
+COMPRESSION_SLOTS_PER_USER = 2
+SMALL_BATCH_FILES = 5
+
+# Автоподбор числа слотов (autoscale): от COMPRESSION_MIN_SLOTS до
+# COMPRESSION_MAX_SLOTS раз в AUTOSCALE_INTERVAL секунд - по загрузке CPU
+# (цель AUTOSCALE_CPU_TARGET), доле свободной памяти и времени сжатия файла.
+# COMPRESSION_SLOTS - начальное значение
+COMPRESSION_AUTOSCALE = os.environ.get('COMPRESSION_AUTOSCALE', 'True') == 'True'
+COMPRESSION_MIN_SLOTS = 1
+COMPRESSION_MAX_SLOTS = int(os.environ.get('COMPRESSION_MAX_SLOTS', 2 * (os.cpu_count() or 1)))
+AUTOSCALE_INTERVAL = 5
+AUTOSCALE_CPU_TARGET = 0.9
+AUTOSCALE_MIN_AVAILABLE_MEMORY = 0.15
+
+# Конвейер сжатия батча: потоки на этап (чтение, декодирование, кодирование)
+# и размер очередей между этапами - он ограничивает число декодированных
+# изображений в памяти одновременно
+PIPELINE_WORKERS = {'read': 1, 'decode': 1, 'encode': 1}
+PIPELINE_QUEUE_SIZE = 2
+
+# Пул процессов сжатия - экспериментальный, включается явно (по умолчанию
+# 0 - сжатие в потоках конвейера самого процесса). Процессы запускаются
+# при первой сессии worker'а сервера и живут между сессиями,
+# перезапускаются после WORKER_MAX_TASKS файлов или при RSS больше
+# WORKER_MAX_RSS_MB. С пулом файл целиком сжимается одним этапом (без
+# перекрытия чтения, декодирования и кодирования), метрики процессов пула
+# видны в /metrics только с PROMETHEUS_MULTIPROC_DIR, а профилируемые
+# сессии все равно сжимаются в потоках. Размер - не меньше, чем слотов
+# может выдать autoscale (COMPRESSION_MAX_SLOTS)
+WORKER_POOL_SIZE = int(os.environ.get('WORKER_POOL_SIZE', 0))
+WORKER_MAX_TASKS = 200
+WORKER_MAX_RSS_MB = 1024
+
+# Результаты по файлам (api/results/): размер страницы по умолчанию и максимум
+RESULTS_PAGE_SIZE = 50
+RESULTS_MAX_PAGE_SIZE = 500
+
+# Превью до/после для каждого файла (api/preview/): создаются при сжатии
+# и кэшируются браузером на PREVIEW_CACHE_SECONDS
+PREVIEWS_ENABLED = True
+PREVIEW_CACHE_SECONDS = 24 * 60 * 60
+
+# Не собирать ZIP на диске: архив отдается потоком при скачивании
+STREAMING_DOWNLOAD = os.environ.get('STREAMING_DOWNLOAD', 'True') == 'True'
+
+# Метрики Prometheus (/metrics): токен для сбора без входа
+# (Authorization: Bearer <METRICS_TOKEN>); пустой - только staff.
+# Для нескольких worker'ов gunicorn метрики пишутся в PROMETHEUS_MULTIPROC_DIR
+# (переменная окружения, см. config/gunicorn.conf.py)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 
@@ -142,6 +254,8 @@ LOGIN_REDIRECT_URL = '/'
 CRONJOBS = [
     # Очистка старых файлов каждый день в 2:00
     ('0 2 * * *', 'compressor.cron.cleanup_old_sessions', '>> /home/dannis/projects/ts-image-convertor/logs/cron.log'),
-    # Сброс зависших сессий каждые 30 минут
-    ('*/30 * * * *', 'compressor.cron.reset_stuck_sessions', '>> /home/dannis/projects/ts-image-convertor/logs/cron.log'),
+    # Возобновление прерванных сессий каждую минуту
+    ('* * * * *', 'compressor.cron.reset_stuck_sessions', '>> /home/dannis/projects/ts-image-convertor/logs/cron.log'),
+    # Проверка порогов заполнения временных файлов каждую минуту
+    ('* * * * *', 'compressor.cron.enforce_storage_watermarks', '>> /home/dannis/projects/ts-image-convertor/logs/cron.log'),
 ]
\ No newline at end of file